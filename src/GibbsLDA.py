@@ -4,53 +4,51 @@ IMPLEMENTED BY CHANG-UK, PARK
 DATA FORMAT: "DocID\t WordID\t FREQUENCY\n"
 """
 
-import random
 import sys
+from array import array
 
 from scipy.special import gammaln, psi
 
 import numpy as np
+from convergence import log_multi_beta_rows
+
+def LoadData(pathData, header = False):                             # STREAM THE RECORDS OF pathData ONE LINE AT A TIME
+    doc_to_index = {}                                               # MAP DOCUMENT INTO INDEX: doc_to_index = {DocID: INDEX}
+    word_to_index = {}                                              # MAP WORD INTO INDEX: word_to_index = {VocabID: INDEX}
+    docs = array("i")                                               # DOCUMENT INDEX OF EACH RECORD
+    words = array("i")                                              # WORD INDEX OF EACH RECORD
+    counts = array("i")                                             # FREQUENCY OF EACH RECORD, REPEATS ARE NOT EXPANDED
+    with open(pathData, "r") as data:
+        for record in data:                                         # FOR EACH RECORD
+            record = record.rstrip("\n")
+            if len(record) == 0:
+                continue
+            if header == True:
+                header = False
+                continue
+            r = record.split("\t")                                  # r[0] = DocID, r[1] = WordID, r[2] = Frequency
+            docs.append(doc_to_index.setdefault(r[0], len(doc_to_index)))
+            words.append(word_to_index.setdefault(r[1], len(word_to_index)))
+            counts.append(int(r[2]))
+    return (np.frombuffer(docs, dtype=np.int32), np.frombuffer(words, dtype=np.int32), np.frombuffer(counts, dtype=np.int32),
+            doc_to_index, word_to_index)
 
 class Sampler(object):
     def __init__(self, pathData, ntopics, alpha, beta, header = False):
-        self.header = header
         self.TOPICS = ntopics                                       # NUMBER OF TOPICS
-        self.documents = {}                                         # TRAINING DATA: {DocID: [WordID1, WordID1, WordID2, ...]}
-        self.doc_to_index = {}                                              # MAP DOCUMENT INTO INDEX: self.doc_to_index = {DocID: INDEX}
-        self.word_to_index = {}                                              # MAP WORD INTO INDEX: self.word_to_index = {VocabID: INDEX}
-        self.DOCS = 0                                               # NUMBER OF DOCUMENTS
-        self.VOCABS = 0                                             # NUMBER OF VOCABULARY WORDS
+        # TRAINING DATA: int32 ARRAYS WITH DOC INDEX, WORD INDEX AND FREQUENCY OF EACH RECORD
+        (self.recordDocs, self.recordWords, self.recordCounts, self.doc_to_index, self.word_to_index) = LoadData(pathData, header)
+        self.DOCS = len(self.doc_to_index)                          # NUMBER OF DOCUMENTS
+        self.VOCABS = len(self.word_to_index)                       # NUMBER OF VOCABULARY WORDS
         self.alpha = alpha                                # np.random.gamma(0.1, 1)
         self.beta = beta                                         # np.random.gamma(0.1, 1)
-        data = open(pathData, "r")
-        [self.LoadData(r) for r in data.read().split("\n")]         # LOAD TRAINING DATA INTO 'self.documents'
-        for doc in self.documents:
-            random.shuffle(self.documents[doc])                     # SHUFFLE WORDS IN EACH DOCUMENT
-        data.close()
         self.theta = np.zeros((self.DOCS, self.TOPICS))             # SPACE FOR THETA MATRIX WITH 0s
         self.phi = np.zeros((self.TOPICS, self.VOCABS))             # SPACE FOR PHI MATRIX WITH 0s
 
-    def LoadData(self, record):                                     # FOR EACH RECORD
-        if len(record) > 0:
-            if self.header == True:
-                self.header = False
-            else:
-                r = record.split("\t")                              # r[0] = DocID, r[1] = WordID, r[2] = Frequency
-                tmp = [r[1] for i in range(int(r[2]))]
-                if not r[0] in self.documents:                      # ADD DOCUMENT
-                    self.documents[r[0]] = tmp
-                    self.doc_to_index[r[0]] = self.DOCS
-                    self.DOCS += 1
-                else:
-                    self.documents[r[0]] += tmp
-                if not r[1] in self.word_to_index:                           # ADD WORD
-                    self.word_to_index[r[1]] = self.VOCABS
-                    self.VOCABS += 1
-
-    def assignTopics(self, doc, word, pos):                         # DRAW TOPIC SAMPLE FROM FULL-CONDITIONAL DISTRIBUTION
-        d = self.doc_to_index[doc]
-        w = self.word_to_index[word]
-        z = self.topicAssignments[d][pos]                           # TOPIC ASSIGNMENT OF WORDS FOR EACH DOCUMENT
+    def assignTopics(self, i):                                      # DRAW TOPIC SAMPLE FROM FULL-CONDITIONAL DISTRIBUTION FOR TOKEN i
+        d = self.tokenDocs[i]
+        w = self.tokenWords[i]
+        z = self.topicAssignments[i]                                # TOPIC ASSIGNMENT OF EACH TOKEN
         self.cntTW[z, w] -= 1
         self.cntDT[d, z] -= 1
         self.cntT[z] -= 1
@@ -63,38 +61,24 @@ class Sampler(object):
         prFullCond /= np.sum(prFullCond)                            # TO OBTAIN PROBABILITY
         # NOTE: 'prFullCond' is MULTINOMIAL DISTRIBUTION WITH THE LENGTH, NUMBER OF TOPICS, NOT A VALUE
         new_z = np.random.multinomial(1, prFullCond).argmax()       # RANDOM SAMPLING FROM FULL-CONDITIONAL DISTRIBUTION
-        self.topicAssignments[d][pos] = new_z
+        self.topicAssignments[i] = new_z
         self.cntTW[new_z, w] += 1
         self.cntDT[d, new_z] += 1
         self.cntT[new_z] += 1
+        self.lenD[d] += 1
 
     def LogLikelihood(self):                                        # FIND (JOINT) LOG-LIKELIHOOD VALUE
-        l = 0
-        for z in range(self.TOPICS):                                # log p(w|z,\beta)
-            l += gammaln(self.VOCABS * self.beta)
-            l -= self.VOCABS * gammaln(self.beta)
-            l += np.sum(gammaln(self.cntTW[z] + self.beta))
-            l -= gammaln(np.sum(self.cntTW[z] + self.beta))
-        for doc in self.documents:                                  # log p(z|\alpha)
-            d = self.doc_to_index[doc]
-            l += gammaln(np.sum(self.alpha))
-            l -= np.sum(gammaln(self.alpha))
-            l += np.sum(gammaln(self.cntDT[d] + self.alpha))
-            l -= gammaln(np.sum(self.cntDT[d] + self.alpha))
+        l = log_multi_beta_rows(self.cntTW, self.beta)              # log p(w|z,\beta)
+        l += log_multi_beta_rows(self.cntDT, self.alpha)            # log p(z|\alpha)
         return l
 
     def findThetaPhi(self):
-        th = np.zeros((self.DOCS, self.TOPICS))                     # SPACE FOR THETA
-        ph = np.zeros((self.TOPICS, self.VOCABS))                   # SPACE FOR PHI
-        for d in range(self.DOCS):
-            for z in range(self.TOPICS):
-                th[d][z] = (self.cntDT[d][z] + self.alpha[z]) / (self.lenD[d] + np.sum(self.alpha))
-        for z in range(self.TOPICS):
-            for w in range(self.VOCABS):
-                ph[z][w] = (self.cntTW[z][w] + self.beta) / (self.cntT[z] + self.beta * self.VOCABS)
+        th = (self.cntDT + self.alpha) / (self.lenD + np.sum(self.alpha))[:, np.newaxis]               # THETA
+        ph = (self.cntTW + self.beta) / (self.cntT + self.beta * self.VOCABS)[:, np.newaxis]          # PHI
         return ph, th
 
-    def run(self, nsamples, burnin, interval):                   # GIBBS SAMPLER KERNEL
+    def run(self, nsamples, burnin, interval, likelihood_interval = 1):   # GIBBS SAMPLER KERNEL
+        # THE LIKELIHOOD IS PRINTED EVERY likelihood_interval SAMPLES, 0 ONLY FINDS IT AFTER THE LAST SAMPLE
         if nsamples <= burnin:                                      # BURNIN CHECK
             print("ERROR: BURN-IN POINT EXCEEDS THE NUMBER OF SAMPLES")
             sys.exit(0)
@@ -102,43 +86,37 @@ class Sampler(object):
         print("# of TOPICS:", self.TOPICS)
         print("# of VOCABS:", self.VOCABS)
 
-        # MAKE SPACE FOR TOPIC-ASSIGNMENT MATRICES WITH 0s
-        self.topicAssignments = {}                                  # {INDEX OF DOC: [TOPIC ASSIGNMENT]}
-        for doc in self.documents:
-            d = self.doc_to_index[doc]
-            self.topicAssignments[d] = [0 for word in self.documents[doc]]
-        self.cntTW = np.zeros((self.TOPICS, self.VOCABS))           # NUMBER OF TOPICS ASSIGNED TO A WORD
-        self.cntDT = np.zeros((self.DOCS, self.TOPICS))             # NUMBER OF TOPICS ASSIGNED IN A DOCUMENT
-        self.cntT = np.zeros(self.TOPICS)                           # ASSIGNMENT COUNT FOR EACH TOPIC
-        self.lenD = np.zeros(self.DOCS)                             # ASSIGNMENT COUNT FOR EACH DOCUMENT = LENGTH OF DOCUMENT
+        # EXPAND THE RECORDS INTO int32 TOKEN ARRAYS, THE WORDS OF EACH DOCUMENT SHUFFLED
+        tokenDocs = np.repeat(self.recordDocs, self.recordCounts)
+        tokenWords = np.repeat(self.recordWords, self.recordCounts)
+        order = np.lexsort((np.random.random(len(tokenDocs)), tokenDocs))
+        self.tokenDocs = tokenDocs[order]                           # DOCUMENT INDEX OF EACH TOKEN
+        self.tokenWords = tokenWords[order]                         # WORD INDEX OF EACH TOKEN
 
         # RANDOMLY ASSIGN TOPIC TO EACH WORD
-        for doc in self.documents:
-            for i, word in enumerate(self.documents[doc]):
-                d = self.doc_to_index[doc]
-                w = self.word_to_index[word]
-                rt = random.randint(0, self.TOPICS-1)               # RANDOM TOPIC ASSIGNMENT
-                self.topicAssignments[d][i] = rt                    # RANDOMLY ASSIGN TOPIC TO EACH WORD
-                self.cntTW[rt, w] += 1
-                self.cntDT[d, rt] += 1
-                self.cntT[rt] += 1
-                self.lenD[d] += 1
+        self.topicAssignments = np.random.randint(self.TOPICS, size=len(self.tokenWords)).astype(np.int32)
+        self.cntTW = np.zeros((self.TOPICS, self.VOCABS))           # NUMBER OF TOPICS ASSIGNED TO A WORD
+        np.add.at(self.cntTW, (self.topicAssignments, self.tokenWords), 1)
+        self.cntDT = np.zeros((self.DOCS, self.TOPICS))             # NUMBER OF TOPICS ASSIGNED IN A DOCUMENT
+        np.add.at(self.cntDT, (self.tokenDocs, self.topicAssignments), 1)
+        self.cntT = np.bincount(self.topicAssignments, minlength=self.TOPICS).astype(float)  # ASSIGNMENT COUNT FOR EACH TOPIC
+        self.lenD = np.bincount(self.tokenDocs, minlength=self.DOCS).astype(float)           # ASSIGNMENT COUNT FOR EACH DOCUMENT = LENGTH OF DOCUMENT
 
         # COLLAPSED GIBBS SAMPLING
         print("INITIAL STATE")
-        print("\tLikelihood:", self.LogLikelihood())               # FIND (JOINT) LOG-LIKELIHOOD
+        if likelihood_interval:
+            print("\tLikelihood:", self.LogLikelihood())           # FIND (JOINT) LOG-LIKELIHOOD
         print("\tAlpha:", end="")
         for i in range(self.TOPICS):
             print(" %.5f" % self.alpha[i], end="")
         print("\n\tBeta: %.5f" % self.beta)
         SAMPLES = 0
         for s in range(nsamples):
-            for doc in self.documents:
-                for i, word in enumerate(self.documents[doc]):
-                    self.assignTopics(doc, word, i)                 # DRAW TOPIC SAMPLE FROM FULL-CONDITIONAL DISTRIBUTION
-            lik = self.LogLikelihood()
+            for i in range(len(self.tokenWords)):
+                self.assignTopics(i)                                # DRAW TOPIC SAMPLE FROM FULL-CONDITIONAL DISTRIBUTION
             print("SAMPLE #" + str(s))
-            print("\tLikelihood:", lik)
+            if likelihood_interval and s % likelihood_interval == 0:
+                print("\tLikelihood:", self.LogLikelihood())
             print("\tAlpha:", end="")
             for i in range(self.TOPICS):
                 print(" %.5f" % self.alpha[i], end="")
@@ -150,4 +128,5 @@ class Sampler(object):
                 SAMPLES += 1
         self.theta /= SAMPLES                                       # AVERAGING GIBBS SAMPLES OF THETA
         self.phi /= SAMPLES                                         # AVERAGING GIBBS SAMPLES OF PHI
-        return (theta, phi, lik)
+        lik = self.LogLikelihood()
+        return (self.theta, self.phi, lik)
@@ -1,8 +1,14 @@
 #!/usr/bin/python3
 import numpy as np
-from math import lgamma
-
-gammaln = np.vectorize(lgamma)
+from scipy import sparse
+from itertools import repeat
+import sampling
+from sampling import sample_index, sample_rows
+from corpus import Corpus
+from foldin import fold_in
+import kernels
+import shared
+from convergence import log_multi_beta_rows
 
 def word_indices(vec):
     """
@@ -15,12 +21,60 @@ def word_indices(vec):
             yield idx
 
 
-def log_multi_beta(alpha):
+CANDIDATE_AUTHOR = 0
+FICTITIOUS_AUTHOR = 1
+
+def fictitious_author_chains(corpus, theta_r, phi, alpha, n_topics, burn_in, samples, spacing):
     """
-    Logarithm of the multinomial beta function.
+    The chains of at_fa_p2 for a batch of candidates in lockstep, the i-th token is resampled
+    in all chains at once. theta_r holds the rows of the candidates of the batch.
+    Returns the log probability of every test document for every candidate of the batch.
     """
-    return np.sum(gammaln(alpha)) - gammaln(np.sum(alpha))
+    n_candidates = len(theta_r)
+    chains = np.arange(n_candidates)
+    topics = np.random.randint(n_topics, size=(n_candidates, corpus.n_tokens))
+    authors = np.random.randint(2, size=(n_candidates, corpus.n_tokens))
+
+    # as before every token starts in the count of the fictitious author, whatever its author
+    cooccur_fic_author_topic = np.array([np.bincount(chain_topics, minlength=n_topics) for chain_topics in topics], dtype=float)
+
+    theta_fic = 0
+    taken_samples = 0
+
+    it = 0  # iterations
+    while taken_samples < samples:
+        for i, word in enumerate(corpus.words):
+            fictitious = authors[:, i] == FICTITIOUS_AUTHOR
+            cooccur_fic_author_topic[chains[fictitious], topics[fictitious, i]] -= 1
+
+            theta_fake = cooccur_fic_author_topic + alpha
+            theta_fake /= np.sum(theta_fake, axis=1)[:, np.newaxis]
+
+            distribution = np.concatenate((theta_r * phi[:, word], theta_fake * phi[:, word]), axis=1)
+            idx = sample_rows(distribution)
+
+            fictitious = idx >= n_topics
+            topics[:, i] = idx % n_topics
+            authors[:, i] = np.where(fictitious, FICTITIOUS_AUTHOR, CANDIDATE_AUTHOR)
+            cooccur_fic_author_topic[chains[fictitious], topics[fictitious, i]] += 1
 
+        if it >= burn_in:
+            it_after_burn_in = it - burn_in
+            if (it_after_burn_in % spacing) == 0:
+                theta_fic += theta_fake
+                taken_samples += 1
+        it += 1
+
+    # as before the last theta_fake, not the sum of the samples
+    theta_fic = theta_fake / taken_samples
+
+    words, counts = corpus.counts(range(corpus.n_docs))
+    return np.dot(counts, np.log(np.dot(theta_r + theta_fic, phi[:, words])).T)
+
+def fictitious_author_batch(corpus, theta_r, seed, alpha, n_topics, burn_in, samples, spacing, phi_descriptors):
+    sampling.reseed(seed)
+    with shared.attached(phi_descriptors) as arrays:
+        return fictitious_author_chains(corpus, theta_r, arrays["phi"], alpha, n_topics, burn_in, samples, spacing)
 
 class AtSampler(object):
     def __init__(self, n_topics, n_authors, alpha, beta):
@@ -34,8 +88,8 @@ class AtSampler(object):
         self.alpha = alpha
         self.beta = beta
 
-    def _initialize(self, doc_authors, matrix):
-        n_docs, vocab_size = matrix.shape
+    def _initialize(self, doc_authors, corpus):
+        n_docs, vocab_size = corpus.n_docs, corpus.vocab_size
 
         self.doc_authors = doc_authors
         self.cooccur_author_topic = np.zeros((self.n_authors, self.n_topics))
@@ -45,11 +99,15 @@ class AtSampler(object):
         self.num_words_per_author = np.zeros(self.n_authors)
         self.topics = {}
         self.authors = {}
+        # prior mass of the rows of cooccur_author_topic and cooccur_topic_word, the row sums
+        # are num_words_per_author and occurrence_topic, which are kept up to date while sampling
+        self.alpha_sum = np.sum(np.broadcast_to(self.alpha, (self.n_topics,)))
+        self.beta_sum = np.sum(np.broadcast_to(self.beta, (vocab_size,)))
 
         for doc in range(n_docs):
             # i is a number between 0 and doc_length-1
             # w is a number between 0 and vocab_size-1
-            for i, word in enumerate(word_indices(matrix[doc, :])):
+            for i, word in enumerate(corpus.tokens(doc).tolist()):
                 # choose an arbitrary topic as first topic for word i
                 topic = np.random.randint(self.n_topics)
                 author = doc_authors[doc][np.random.randint(len(doc_authors[doc]))]
@@ -63,46 +121,23 @@ class AtSampler(object):
 
     def _conditional_distribution(self, authors, word):
         """
-        Conditional distribution (matrix).
+        Conditional distribution (unnormalised vector of size len(authors) * n_topics).
         """
-        vocab_size = self.cooccur_topic_word.shape[1]
-
-
-        # at_complex = (self.cooccur_author_topic[authors, :] + self.alpha) / (self.num_words_per_author[authors].repeat(self.n_topics).reshape(len(authors),
-        #                                                                     self.n_topics) + self.alpha * self.n_topics)
-        at = (self.cooccur_author_topic[authors, :] + self.alpha)
-        at /= np.sum(at, axis=1)[:, np.newaxis]
-
-        # wt_complex = (self.cooccur_topic_word[:, word] + self.beta) / (self.occurrence_topic + self.beta * vocab_size)
-
-        wt = (self.cooccur_topic_word + self.beta)
-        wt /= np.sum(wt, axis=1)[:, np.newaxis]
-        wt = wt[:, word]
+        beta = self.beta[word] if np.ndim(self.beta) else self.beta
 
+        at = (self.cooccur_author_topic[authors, :] + self.alpha) / (self.num_words_per_author[authors] + self.alpha_sum)[:, np.newaxis]
+        wt = (self.cooccur_topic_word[:, word] + beta) / (self.occurrence_topic + self.beta_sum)
 
         pdf = at * wt
         # reshape into a looong vector
         pdf = pdf.reshape(len(authors) * self.n_topics)
-        # normalize to obtain probabilities
-        pdf /= pdf.sum()
         return pdf
 
     def loglikelihood(self):
         """
         Compute the likelihood that the model generated the data.
         """
-
-        lik = 0
-
-        for topic in range(self.n_topics):
-            lik += log_multi_beta(self.cooccur_topic_word[topic, :] + self.beta)
-            lik -= log_multi_beta(self.beta)
-
-        for author in range(self.n_authors):
-            lik += log_multi_beta(self.cooccur_author_topic[author, :] + self.alpha)
-            lik -= log_multi_beta(self.alpha)
-
-        return lik
+        return log_multi_beta_rows(self.cooccur_topic_word, self.beta) + log_multi_beta_rows(self.cooccur_author_topic, self.alpha)
 
 
     def phi(self):
@@ -117,46 +152,46 @@ class AtSampler(object):
         num /= np.sum(num, axis=1)[:, np.newaxis]
         return num
 
-    def train(self, doc_authors, matrix, burn_in, samples, spacing):
+    def train(self, doc_authors, matrix, burn_in, samples, spacing, convergence=None):
         """
         Run the Gibbs sampler.
+
+        convergence: stopping rule for the burn-in, e.g. convergence.RelativeChange(), which is given
+                     the log-likelihood after every sweep. The burn-in ends when the rule is met,
+                     burn_in is then its maximum length.
         """
-        n_docs, vocab_size = matrix.shape
-        self._initialize(doc_authors, matrix)
+        corpus = Corpus(matrix)
+        vocab_size = corpus.vocab_size
+        self._initialize(doc_authors, corpus)
         theta = 0
         phi = 0
         taken_samples = 0
 
+        # the compiled kernel works on the topics and authors as arrays in the token order of Corpus
+        compiled = kernels.enabled
+        if compiled:
+            token_docs = corpus.token_docs()
+            author_offsets, author_list = kernels.flat_authors(doc_authors)
+            topics = corpus.flat_state(self.topics)
+            authors = corpus.flat_state(self.authors)
+            alpha = np.broadcast_to(np.asarray(self.alpha, dtype=float), (self.n_topics,)).copy()
+            beta = np.broadcast_to(np.asarray(self.beta, dtype=float), (vocab_size,)).copy()
+
         it = 0  # iterations
         while taken_samples < samples:
-            for doc in range(n_docs):  # all documents
-                for i, word in enumerate(word_indices(matrix[doc, :])):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
-
-                    old_topic = self.topics[(doc, i)]
-                    old_author = self.authors[(doc, i)]
-
-                    self.cooccur_topic_word[old_topic, word] -= 1
-                    self.cooccur_author_topic[old_author, old_topic] -= 1
-                    self.occurrence_topic[old_topic] -= 1
-                    self.num_words_per_author[old_author] -= 1
-                    self.number_words_per_doc[doc] -= 1
-
-                    distribution = self._conditional_distribution(self.doc_authors[doc], word)
-                    idx = np.random.multinomial(1, distribution).argmax()
-
-                    new_author = self.doc_authors[doc][int(idx / self.n_topics)]
-                    new_topic = idx % self.n_topics
-
-                    self.cooccur_author_topic[new_author, new_topic] += 1
-                    self.number_words_per_doc[doc] += 1
-                    self.cooccur_topic_word[new_topic, word] += 1
-                    self.occurrence_topic[new_topic] += 1
-                    self.num_words_per_author[new_author] += 1
-                    self.topics[(doc, i)] = new_topic
-                    self.authors[(doc, i)] = new_author
+            if not compiled:
+                self._sweep(corpus)
+            else:
+                kernels.at_sweep(corpus.words, token_docs, author_offsets, author_list, topics, authors,
+                                 self.cooccur_author_topic, self.cooccur_topic_word, self.number_words_per_doc, self.occurrence_topic,
+                                 self.num_words_per_author, alpha, self.alpha_sum, beta, self.beta_sum, np.random.random(corpus.n_tokens))
+            if convergence is not None and it < burn_in and convergence.update(self.loglikelihood()):
+                burn_in = it
             if it >= burn_in:
                 it_after_burn_in = it - burn_in
                 if (it_after_burn_in % spacing) == 0:
+                    if taken_samples == 0:
+                        print("burn-in ended after", it, "sweeps")
                     theta += self.theta()
                     phi += self.phi()
                     taken_samples += 1
@@ -164,183 +199,82 @@ class AtSampler(object):
 
         theta /= taken_samples
         phi /= taken_samples
+        if compiled:
+            self.topics = corpus.dict_state(topics)
+            self.authors = corpus.dict_state(authors)
 
         return (theta, phi)
 
-    def classify(self, matrix, phi, burn_in, samples, spacing):
-        n_docs, vocab_size = matrix.shape
-        thetas = 0
-        n_docs, vocab_size = matrix.shape
-
-        self.cooccur_author_topic = np.zeros((self.n_authors, self.n_topics))
-        self.number_words_per_doc = np.zeros(n_docs)
-        self.occurrence_topic = np.zeros(self.n_topics)
-        self.num_words_per_author = np.zeros(self.n_authors)
-        self.topics = {}
-
-        for doc in range(n_docs):
-            author = doc
-            # i is a number between 0 and doc_length-1
-            # w is a number between 0 and vocab_size-1
-            for i, word in enumerate(word_indices(matrix[doc, :])):
-                # choose an arbitrary topic as first topic for word i
-                topic = np.random.randint(self.n_topics)
-                self.cooccur_author_topic[author, topic] += 1
-                self.number_words_per_doc[doc] += 1
-                self.occurrence_topic[topic] += 1
-                self.num_words_per_author[author] += 1
-                self.topics[(doc, i)] = topic
-        theta = 0
-        taken_samples = 0
-
-        it = 0  # iterations
-        while taken_samples < samples:
-            for doc in range(n_docs):  # all documents
-                author = doc
-                for i, word in enumerate(word_indices(matrix[doc, :])):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
+    def _sweep(self, corpus):
+        for doc in range(corpus.n_docs):  # all documents
+            for i, word in enumerate(corpus.tokens(doc).tolist()):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
 
-                    old_topic = self.topics[(doc, i)]
+                old_topic = self.topics[(doc, i)]
+                old_author = self.authors[(doc, i)]
 
-                    self.cooccur_author_topic[author, old_topic] -= 1
-                    self.occurrence_topic[old_topic] -= 1
-                    self.number_words_per_doc[doc] -= 1
+                self.cooccur_topic_word[old_topic, word] -= 1
+                self.cooccur_author_topic[old_author, old_topic] -= 1
+                self.occurrence_topic[old_topic] -= 1
+                self.num_words_per_author[old_author] -= 1
+                self.number_words_per_doc[doc] -= 1
 
-                    distribution = ((self.cooccur_author_topic[0, :] + self.alpha) / \
-                                    (self.num_words_per_author[0] + self.alpha * self.n_topics) * phi[:, word])
-                    distribution /= np.sum(distribution)
-                    new_topic = np.random.multinomial(1, distribution).argmax()
+                distribution = self._conditional_distribution(self.doc_authors[doc], word)
+                idx = sample_index(distribution)
 
-                    self.cooccur_author_topic[author, new_topic] += 1
-                    self.number_words_per_doc[doc] += 1
-                    self.occurrence_topic[new_topic] += 1
-                    self.topics[(doc, i)] = new_topic
+                new_author = self.doc_authors[doc][int(idx / self.n_topics)]
+                new_topic = idx % self.n_topics
 
-            if it >= burn_in:
-                it_after_burn_in = it - burn_in
-                if (it_after_burn_in % spacing) == 0:
-                    theta += self.theta()
-                    taken_samples += 1
-            it += 1
+                self.cooccur_author_topic[new_author, new_topic] += 1
+                self.number_words_per_doc[doc] += 1
+                self.cooccur_topic_word[new_topic, word] += 1
+                self.occurrence_topic[new_topic] += 1
+                self.num_words_per_author[new_author] += 1
+                self.topics[(doc, i)] = new_topic
+                self.authors[(doc, i)] = new_author
 
-        theta /= taken_samples
+    def classify(self, matrix, phi, burn_in, samples, spacing):
+        """
+        Fold in the test documents with phi fixed, every test document is written by its own
+        author, all documents advance in lockstep (foldin.fold_in).
+        """
+        corpus = Corpus(matrix)
+        theta, self.cooccur_author_topic, topics = fold_in(corpus, phi, self.alpha, burn_in, samples, spacing)
+        self.num_words_per_author = np.sum(self.cooccur_author_topic, axis=1)
+        self.number_words_per_doc = corpus.doc_lengths().astype(float)
+        self.occurrence_topic = np.bincount(topics, minlength=self.n_topics).astype(float)
 
         return (theta)
 
     def at_p(self, phi, theta, matrix):
-        n_docs, vocab_size = matrix.shape
-        candidate_probabilities = np.zeros((n_docs, self.n_authors))
-
-        for doc in range(n_docs):  # all documents
-            for candidate in range(self.n_authors):
-                text_prob = 0
-                for i, word in enumerate(word_indices(matrix[doc, :])):
-                    theta_vector = theta[candidate, :]
-                    phi_vector = phi[:, word]
-                    product =  np.dot(theta_vector, phi_vector)
-                    text_prob += np.log(product)
-
-                candidate_probabilities[doc, candidate] = text_prob
-
-        return candidate_probabilities
-
-    def at_fa_p2(self, phi, theta_r, matrix, samples, burn_in, spacing):
-        n_docs, vocab_size = matrix.shape
-        candidate_probabilities = np.zeros((n_docs, self.n_authors))
-
-        CANDIDATE_AUTHOR = 0
-        FICTITIOUS_AUTHOR = 1
-
-        for candidate in range(self.n_authors):
-            cooccur_fic_author_topic = np.zeros(self.n_topics)
-            number_words_per_doc = np.zeros(n_docs)
-            occurrence_topic = np.zeros(self.n_topics)
-            num_words_of_fic_author = 0
-            topics = {}
-            authors = {}
-
-            for doc in range(n_docs):
-                # i is a number between 0 and doc_length-1
-                # w is a number between 0 and vocab_size-1
-                for i, word in enumerate(word_indices(matrix[doc, :])):
-                    # choose an arbitrary topic as first topic for word i
-                    topic = np.random.randint(self.n_topics)
-                    author = CANDIDATE_AUTHOR if np.random.randint(2) else FICTITIOUS_AUTHOR
-
-                    topics[(doc, i)] = topic
-                    authors[(doc, i)] = author
-
-                    if FICTITIOUS_AUTHOR:
-                        cooccur_fic_author_topic[topic] += 1
-                        occurrence_topic[topic] += 1
-                        number_words_per_doc[doc] += 1
-                        num_words_of_fic_author += 1
-
-            theta_fic = 0
-            taken_samples = 0
-
-            it = 0  # iterations
-            while taken_samples < samples:
-                for doc in range(n_docs):  # all documents
-                    for i, word in enumerate(word_indices(matrix[doc, :])):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
-
-                        old_topic = topics[(doc, i)]
-                        old_author = authors[(doc, i)]
-
-                        if old_author == FICTITIOUS_AUTHOR:
-                            cooccur_fic_author_topic[old_topic] -= 1
-                            occurrence_topic[old_topic] -= 1
-                            number_words_per_doc[doc] -= 1
-                            num_words_of_fic_author -= 1
-
-                        # vocab_size = self.cooccur_topic_word.shape[1]
-
-                        theta_fake = cooccur_fic_author_topic + self.alpha
-                        theta_fake /= theta_fake.sum()
-
-                        distribution_real = np.multiply(theta_r[candidate], phi[:, word])
-                        distribution_fake = np.multiply(theta_fake, phi[:, word])
-
-                        distribution = np.concatenate((distribution_real, distribution_fake))
-                        # normalize to obtain probabilities
-                        distribution /= distribution.sum()
-
-                        idx = np.random.multinomial(1, distribution).argmax()
-
-                        if idx >= self.n_topics:
-                            new_topic = idx - self.n_topics
-                            new_author = FICTITIOUS_AUTHOR
-
-                            cooccur_fic_author_topic[new_topic] += 1
-                            number_words_per_doc[doc] += 1
-                            occurrence_topic[new_topic] += 1
-                            num_words_of_fic_author += 1
-                        else:
-                            new_topic = idx
-                            new_author = CANDIDATE_AUTHOR
-
-                        topics[(doc, i)] = new_topic
-                        authors[(doc, i)] = new_author
-
-                if it >= burn_in:
-                    it_after_burn_in = it - burn_in
-                    if (it_after_burn_in % spacing) == 0:
-                        theta_fic += theta_fake
-                        taken_samples += 1
-                it += 1
-
-            theta_fic = theta_fake / taken_samples
-
-            for doc in range(n_docs):  # all documents
-                text_prob = 0
-                for i, word in enumerate(word_indices(matrix[doc, :])):
-                    theta_vector = theta_r[candidate, :]
-                    phi_vector = phi[:, word]
-                    product_real =  np.dot(theta_vector, phi_vector)
-                    product_fic = np.dot(theta_fic, phi_vector)
-                    sum_prob = product_real + product_fic
-
-                    text_prob += np.log(sum_prob)
+        """
+        Log probability of every test document for every candidate author. log(theta phi) is
+        computed once for the words occurring in the test documents and weighted by their counts.
+        matrix: a numpy array or a scipy sparse matrix
+        """
+        matrix = sparse.csr_matrix(matrix)
+        words = np.unique(matrix.indices[matrix.data != 0])
+        candidate_words = np.log(np.dot(theta[:self.n_authors], phi[:, words]))
+        return np.asarray(matrix[:, words] @ candidate_words.T)
 
-                candidate_probabilities[doc, candidate] = text_prob
+    def at_fa_p2(self, phi, theta_r, matrix, samples, burn_in, spacing, batch_size=64, processes=1):
+        """
+        Probability of every test document for every candidate author, written by the candidate
+        together with a fictitious author. Every candidate has its own Gibbs chain over all test
+        documents, the chains of batch_size candidates run in lockstep (fictitious_author_chains).
 
+        processes: with more than one process the batches run in a process pool with phi in shared memory.
+        """
+        corpus = Corpus(matrix)
+        batches = [range(start, min(start + batch_size, self.n_authors)) for start in range(0, self.n_authors, batch_size)]
+
+        if processes > 1:
+            seeds = np.random.randint(2**31 - 1, size=len(batches))
+            with shared.SharedArrays({"phi": phi}) as phi_shared, shared.pool(processes) as p:
+                results = p.starmap(fictitious_author_batch, zip(repeat(corpus), [theta_r[batch] for batch in batches], seeds, repeat(self.alpha),
+                                                                 repeat(self.n_topics), repeat(burn_in), repeat(samples), repeat(spacing),
+                                                                 repeat(phi_shared.descriptors)))
+        else:
+            results = [fictitious_author_chains(corpus, theta_r[batch], phi, self.alpha, self.n_topics, burn_in, samples, spacing) for batch in batches]
+
+        candidate_probabilities = np.concatenate(results, axis=1)
         return np.exp(candidate_probabilities)
@@ -0,0 +1,456 @@
+#!/usr/bin/python3
+"""
+Benchmarks for the samplers on synthetic corpora.
+
+usage: python3 benchmark.py <name> [<name> ...]
+"""
+import sys, os, time, io, contextlib, tracemalloc, tempfile
+import numpy as np
+from corpus import Corpus
+import dadt
+import at
+import lda
+from math import lgamma
+import sampling
+from foldin import fold_in
+import kernels
+import GibbsLDA
+
+a = "a"
+d = "d"
+
+def synthetic_corpus(n_docs, vocab_size, doc_length, n_authors, seed=0):
+    """
+    Zipf distributed documents, every author writes about the same number of documents.
+    """
+    rng = np.random.RandomState(seed)
+    p = 1 / np.arange(1, vocab_size + 1)
+    p /= p.sum()
+    matrix = np.zeros((n_docs, vocab_size))
+    for doc in range(n_docs):
+        matrix[doc] = rng.multinomial(doc_length, p)
+    doc_authors = [[doc % n_authors] for doc in range(n_docs)]
+    return matrix, doc_authors
+
+def synthetic_authored_corpus(n_docs, vocab_size, doc_length, n_authors, n_dtopics=10, test_fraction=0.2, seed=0):
+    """
+    Documents mixing an author specific word distribution with one of n_dtopics shared ones.
+    Returns (matrix, test_matrix, doc_authors, test_doc_authors).
+    """
+    rng = np.random.RandomState(seed)
+    author_words = rng.dirichlet(np.full(vocab_size, 0.05), n_authors)
+    document_words = rng.dirichlet(np.full(vocab_size, 0.05), n_dtopics)
+    matrix = np.zeros((n_docs, vocab_size))
+    doc_authors = []
+    for doc in range(n_docs):
+        author = doc % n_authors
+        n_author_words = rng.binomial(doc_length, 0.5)
+        matrix[doc] = rng.multinomial(n_author_words, author_words[author]) + \
+                      rng.multinomial(doc_length - n_author_words, document_words[rng.randint(n_dtopics)])
+        doc_authors.append([author])
+    test = np.arange(n_docs) >= n_docs * (1 - test_fraction)
+    return matrix[~test], matrix[test], [doc_authors[doc] for doc in np.flatnonzero(~test)], [doc_authors[doc] for doc in np.flatnonzero(test)]
+
+def dadt_parameters(vocab_size, num_dtopics=50, num_atopics=350):
+    # same as models.DADT_P, without stopwords
+    alpha_a = min(0.1, 5/num_atopics)
+    alpha_d = min(0.1, 5/num_dtopics)
+    alpha = {a: alpha_a, d: alpha_d}
+    beta = {a: np.full(vocab_size, 0.01), d: np.full(vocab_size, 0.01)}
+    delta = {a: alpha_a, d: alpha_d}
+    num_topics = {a: num_atopics, d: num_dtopics}
+    return num_topics, alpha, beta, delta
+
+def timed(function, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+    return elapsed, result
+
+def bench_corpus_state():
+    """
+    Memory of the per-token assignment state and time of one dadt.train sweep.
+    """
+    n_docs, vocab_size, doc_length, n_authors = 200, 2000, 500, 20
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    corpus = Corpus(matrix)
+
+    tracemalloc.start()
+    document_word_topic = {}
+    authors = {}
+    for doc in range(n_docs):
+        for i, word in enumerate(corpus.tokens(doc)):
+            document_word_topic[(doc, i)] = (1, np.random.randint(350))
+            authors[(doc, i)] = doc_authors[doc][0]
+    dict_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del document_word_topic, authors
+
+    tracemalloc.start()
+    is_atopic, topic, author = dadt.initialize(corpus, doc_authors, {a: 350, d: 50}, {a: 0.1, d: 0.1})
+    array_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print("tokens", corpus.n_tokens)
+    print("dict state   %10d bytes %6.1f bytes/token" % (dict_bytes, dict_bytes / corpus.n_tokens))
+    print("array state  %10d bytes %6.1f bytes/token" % (array_bytes, array_bytes / corpus.n_tokens))
+
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 5, 15)
+    elapsed, _ = timed(dadt.train, corpus, None, doc_authors, num_topics, n_authors, alpha, beta, delta, 1, 0, 2, 1)
+    print("train, 2 sweeps + init %.2fs" % elapsed)
+
+def random_state(n_docs, vocab_size, doc_length, n_authors, num_dtopics=50, num_atopics=350):
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    corpus = Corpus(matrix)
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, num_dtopics, num_atopics)
+    is_atopic, topic, author = dadt.initialize(corpus, doc_authors, num_topics, delta)
+    counts = dadt.count(corpus, is_atopic, topic, author, num_topics, n_authors)
+    cooccurrence_topic_word = dadt.count_topic_word(corpus, is_atopic, topic, num_topics)
+    return corpus, doc_authors, num_topics, alpha, beta, delta, counts, cooccurrence_topic_word
+
+def bench_topic_word_normalizer(n_tokens=200):
+    """
+    Per-token cost of the atopic word term of sample_topic, full row normalisation
+    of cooccurrence_topic_word against the incrementally maintained totals.
+    """
+    vocab_size = 30000
+    corpus, doc_authors, num_topics, alpha, beta, delta, counts, cooccurrence_topic_word = random_state(200, vocab_size, 500, 20)
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    beta_sum = dadt.beta_mass(beta)
+    words = corpus.words[np.random.randint(corpus.n_tokens, size=n_tokens)]
+
+    start = time.perf_counter()
+    dense = [dadt.topic_phi(a, cooccurrence_topic_word, beta)[:, word].copy() for word in words]
+    dense_time = (time.perf_counter() - start) / n_tokens
+
+    start = time.perf_counter()
+    column = [(cooccurrence_topic_word[a][:, word] + beta[a][word]) / (occurrence_topic[a] + beta_sum[a]) for word in words]
+    column_time = (time.perf_counter() - start) / n_tokens
+
+    print("vocab", vocab_size, "atopics", num_topics[a])
+    print("full normalisation   %10.1f us/token" % (dense_time * 1e6))
+    print("maintained totals    %10.1f us/token" % (column_time * 1e6))
+    print("max abs difference   %10.3g" % max(np.max(np.abs(x - y)) for x, y in zip(dense, column)))
+
+    start = time.perf_counter()
+    for doc, word in zip(corpus.token_docs()[:n_tokens], corpus.words[:n_tokens]):
+        dadt.sample_topic(doc, word, num_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic, occurrence_author, n_words_per_doc, alpha, beta, beta_sum, delta)
+    print("sample_topic         %10.1f us/token" % ((time.perf_counter() - start) / n_tokens * 1e6))
+
+def bench_sparse_sampler():
+    """
+    Time of train sweeps with every sampler, at the topic numbers of models.DADT_P and with more atopics.
+    """
+    n_docs, vocab_size, doc_length, n_authors = 100, 5000, 300, 10
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    corpus = Corpus(matrix)
+    print("tokens", corpus.n_tokens)
+    for num_atopics in (350, 2000):
+        num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 50, num_atopics)
+        for sampler in dadt.samplers:
+            for sweeps in (1, 3):
+                elapsed, _ = timed(dadt.train, corpus, None, doc_authors, num_topics, n_authors, alpha, beta, delta, 1, 0, sweeps, 1, sampler=sampler)
+                print("%4d atopics %-8s %d sweeps %8.2fs" % (num_atopics, sampler, sweeps, elapsed))
+
+def bench_alias_sampler():
+    """
+    Tokens per second of train and attribution accuracy of the whole DADT_P
+    pipeline for every sampler on an authored synthetic corpus.
+    """
+    vocab_size, n_authors = 1000, 10
+    matrix, test_matrix, doc_authors, test_doc_authors = synthetic_authored_corpus(250, vocab_size, 100, n_authors)
+    corpus, test_corpus = Corpus(matrix), Corpus(test_matrix)
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 10, 20)
+    burn_in, samples, spacing = 30, 4, 5
+    sweeps = burn_in + (samples - 1) * spacing + 1
+    print("tokens", corpus.n_tokens, "test docs", test_corpus.n_docs, "sweeps", sweeps)
+    for sampler in dadt.samplers:
+        np.random.seed(0)
+        sampling.uniforms.reset()
+        elapsed, (theta, phi, pi_sampled, chi_sampled) = timed(dadt.train, corpus, None, doc_authors, num_topics, n_authors, alpha, beta, delta, 1, burn_in, samples, spacing, sampler=sampler)
+        _, (theta_test, pi_test) = timed(dadt.classify, test_corpus, 10, 10, 1, num_topics, alpha, beta, delta, 1, phi)
+        _, probabilities = timed(dadt.dadt_p, test_corpus, n_authors, theta, phi, pi_test, chi_sampled)
+        accuracy = np.mean(np.argmax(probabilities, axis=1) == np.array(test_doc_authors)[:, 0])
+        print("%-8s %8.0f tokens/s  accuracy %.2f" % (sampler, corpus.n_tokens * sweeps / elapsed, accuracy))
+
+def bench_categorical_draw(n_draws=20000):
+    """
+    Per-draw cost of a categorical draw from unnormalised weights.
+    """
+    for n_topics in (50, 400):
+        weights = np.random.random(n_topics)
+
+        start = time.perf_counter()
+        for _ in range(n_draws):
+            p = weights / np.sum(weights)
+            np.random.multinomial(1, p).argmax()
+        multinomial_time = (time.perf_counter() - start) / n_draws
+
+        start = time.perf_counter()
+        for _ in range(n_draws):
+            p = weights / np.sum(weights)
+            while True:  # the former dadt.normalise followed by the draw
+                try:
+                    np.random.multinomial(1, p).argmax()
+                    break
+                except ValueError:
+                    p = p * 0.999999999999999
+            np.random.multinomial(1, p).argmax()
+        normalise_time = (time.perf_counter() - start) / n_draws
+
+        start = time.perf_counter()
+        for _ in range(n_draws):
+            sampling.sample_index(weights)
+        sample_index_time = (time.perf_counter() - start) / n_draws
+
+        counts = np.bincount([sampling.sample_index(weights) for _ in range(n_draws)], minlength=n_topics)
+        print("K %3d multinomial %5.1f us  normalise + multinomial %5.1f us  sample_index %5.1f us  TV %.3f" % (
+              n_topics, multinomial_time * 1e6, normalise_time * 1e6, sample_index_time * 1e6,
+              0.5 * np.sum(np.abs(counts / n_draws - weights / np.sum(weights)))))
+
+def bench_parallel_train():
+    """
+    Tokens per second and attribution accuracy of train with shards sampled in a process pool.
+    """
+    vocab_size, n_authors = 1000, 10
+    matrix, test_matrix, doc_authors, test_doc_authors = synthetic_authored_corpus(250, vocab_size, 100, n_authors)
+    corpus, test_corpus = Corpus(matrix), Corpus(test_matrix)
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 10, 20)
+    burn_in, samples, spacing = 30, 4, 5
+    sweeps = burn_in + (samples - 1) * spacing + 1
+    print("tokens", corpus.n_tokens, "test docs", test_corpus.n_docs, "sweeps", sweeps)
+    for processes, sync_interval in ((1, 1), (2, 1), (4, 1), (4, 5)):
+        np.random.seed(0)
+        sampling.uniforms.reset()
+        elapsed, (theta, phi, pi_sampled, chi_sampled) = timed(dadt.train, corpus, None, doc_authors, num_topics, n_authors, alpha, beta, delta, 1, burn_in, samples, spacing,
+                                                                processes=processes, sync_interval=sync_interval)
+        _, (theta_test, pi_test) = timed(dadt.classify, test_corpus, 10, 10, 1, num_topics, alpha, beta, delta, 1, phi)
+        _, probabilities = timed(dadt.dadt_p, test_corpus, n_authors, theta, phi, pi_test, chi_sampled)
+        accuracy = np.mean(np.argmax(probabilities, axis=1) == np.array(test_doc_authors)[:, 0])
+        print("%d processes sync every %d %8.0f tokens/s  accuracy %.2f" % (processes, sync_interval, corpus.n_tokens * sweeps / elapsed, accuracy))
+
+def bench_at_conditional(n_tokens=50):
+    """
+    Per-token cost of AtSampler._conditional_distribution against the former full row
+    normalisation, at the topic number of models.AT_P and a PAN11 sized vocabulary.
+    """
+    n_docs, vocab_size, doc_length, n_authors, n_topics = 300, 30000, 300, 72, 400
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    sampler = at.AtSampler(n_topics, n_authors, 0.1, 0.1)
+    corpus = Corpus(matrix)
+    sampler._initialize(doc_authors, corpus)
+    tokens = np.random.randint(corpus.n_tokens, size=n_tokens)
+    docs, words = corpus.token_docs()[tokens], corpus.words[tokens]
+
+    start = time.perf_counter()
+    former = []
+    for doc, word in zip(docs, words):
+        authors = doc_authors[doc]
+        author_topics = sampler.cooccur_author_topic[authors, :] + sampler.alpha
+        author_topics /= np.sum(author_topics, axis=1)[:, np.newaxis]
+        topic_words = sampler.cooccur_topic_word + sampler.beta
+        topic_words /= np.sum(topic_words, axis=1)[:, np.newaxis]
+        former.append((author_topics * topic_words[:, word]).reshape(-1))
+    former_time = (time.perf_counter() - start) / n_tokens
+
+    start = time.perf_counter()
+    current = [sampler._conditional_distribution(doc_authors[doc], word) for doc, word in zip(docs, words)]
+    current_time = (time.perf_counter() - start) / n_tokens
+
+    print("tokens", corpus.n_tokens, "vocab", vocab_size, "topics", n_topics)
+    print("full normalisation   %10.1f us/token" % (former_time * 1e6))
+    print("maintained totals    %10.1f us/token" % (current_time * 1e6))
+    print("max relative difference %.3g" % max(np.max(np.abs(x - y) / x) for x, y in zip(former, current)))
+
+def bench_at_p():
+    """
+    Time of AtSampler.at_p against the former loop over documents, candidates and tokens.
+    """
+    n_docs, vocab_size, doc_length, n_authors, n_topics = 20, 30000, 300, 72, 400
+    test_matrix, _ = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    theta = np.random.dirichlet(np.full(n_topics, 0.1), n_authors)
+    phi = np.random.dirichlet(np.full(vocab_size, 0.1), n_topics)
+    sampler = at.AtSampler(n_topics, n_authors, 0.1, 0.1)
+
+    start = time.perf_counter()
+    former = np.zeros((n_docs, n_authors))
+    for doc in range(n_docs):
+        for candidate in range(n_authors):
+            for word in at.word_indices(test_matrix[doc, :]):
+                former[doc, candidate] += np.log(np.dot(theta[candidate, :], phi[:, word]))
+    former_time = time.perf_counter() - start
+
+    elapsed, current = timed(sampler.at_p, phi, theta, test_matrix)
+
+    print("docs", n_docs, "candidates", n_authors, "vocab", vocab_size, "topics", n_topics)
+    print("loops       %8.3fs" % former_time)
+    print("vectorised  %8.3fs" % elapsed)
+    print("max relative difference %.3g" % np.max(np.abs(former - current) / np.abs(former)))
+
+def bench_at_fa_p2():
+    """
+    Time of AtSampler.at_fa_p2 for a thousand candidates with a batch size of 1,
+    one chain at a time as before, and with the chains of a batch in lockstep.
+    """
+    n_docs, vocab_size, doc_length, n_authors, n_topics = 5, 5000, 40, 1000, 50
+    burn_in, samples, spacing = 2, 2, 1
+    test_matrix, _ = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    theta = np.random.dirichlet(np.full(n_topics, 0.1), n_authors)
+    phi = np.random.dirichlet(np.full(vocab_size, 0.1), n_topics)
+    sampler = at.AtSampler(n_topics, n_authors, 0.1, 0.1)
+    print("tokens", n_docs * doc_length, "candidates", n_authors, "topics", n_topics, "sweeps", burn_in + samples)
+    for batch_size in (1, 64, 256):
+        elapsed, _ = timed(sampler.at_fa_p2, phi, theta, test_matrix, samples, burn_in, spacing, batch_size=batch_size)
+        print("batch size %4d %8.2fs" % (batch_size, elapsed))
+
+def bench_loglikelihood():
+    """
+    Time of one AtSampler.loglikelihood and LDA.loglikelihood at the topic number of models.AT_P
+    and a PAN11 sized vocabulary, against the former row loop with np.vectorize(lgamma).
+    """
+    n_docs, vocab_size, doc_length, n_authors, n_topics = 300, 30000, 300, 72, 400
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    at_sampler = at.AtSampler(n_topics, n_authors, 0.1, 0.1)
+    at_sampler._initialize(doc_authors, Corpus(matrix))
+    lda_sampler = lda.LDA(n_topics, 0.1, 0.1)
+    lda_sampler._initialize(Corpus(matrix))
+
+    vectorized_gammaln = np.vectorize(lgamma)
+    def log_multi_beta(alpha):
+        return np.sum(vectorized_gammaln(alpha)) - vectorized_gammaln(np.sum(alpha))
+
+    beta = np.full(vocab_size, 0.1)
+    alpha = np.full(n_topics, 0.1)
+    for name, sampler, rows in (("at", at_sampler, at_sampler.cooccur_author_topic), ("lda", lda_sampler, lda_sampler.cooccur_doc_topic)):
+        start = time.perf_counter()
+        former = 0
+        for topic in range(n_topics):
+            former += log_multi_beta(sampler.cooccur_topic_word[topic, :] + beta) - log_multi_beta(beta)
+        for row in rows:
+            former += log_multi_beta(row + alpha) - log_multi_beta(alpha)
+        former_time = time.perf_counter() - start
+
+        elapsed, current = timed(sampler.loglikelihood)
+        print("%-4s row loop %8.3fs  array gammaln %8.4fs  relative difference %.3g" % (name, former_time, elapsed, abs(former - current) / abs(former)))
+
+def bench_fold_in():
+    """
+    Tokens per second of the test document fold-in of AtSampler.classify and LDA.classify,
+    one token at a time as before and all documents in lockstep, for growing numbers of documents.
+    """
+    vocab_size, doc_length, n_topics, alpha = 30000, 200, 400, 0.1
+    phi = np.random.dirichlet(np.full(vocab_size, 0.1), n_topics)
+    for n_docs in (10, 100, 500):
+        matrix, _ = synthetic_corpus(n_docs, vocab_size, doc_length, 1)
+        corpus = Corpus(matrix)
+
+        start = time.perf_counter()
+        topics = np.random.randint(n_topics, size=corpus.n_tokens)
+        cooccur_doc_topic = np.zeros((n_docs, n_topics))
+        np.add.at(cooccur_doc_topic, (corpus.token_docs(), topics), 1)
+        for doc in range(n_docs):
+            for i in range(corpus.doc_offsets[doc], corpus.doc_offsets[doc + 1]):
+                cooccur_doc_topic[doc, topics[i]] -= 1
+                topics[i] = sampling.sample_index((cooccur_doc_topic[doc, :] + alpha) * phi[:, corpus.words[i]])
+                cooccur_doc_topic[doc, topics[i]] += 1
+        sequential_time = time.perf_counter() - start
+
+        lockstep_time, _ = timed(fold_in, corpus, phi, alpha, 0, 1, 1)
+        print("docs %4d  sequential %8.0f tokens/s  lockstep %8.0f tokens/s" % (n_docs, corpus.n_tokens / sequential_time, corpus.n_tokens / lockstep_time))
+
+def bench_kernels():
+    """
+    The compiled kernels against the numpy samplers: one sweep of each with the same uniform
+    random numbers must give the same assignments, the counts must match a recount of the
+    assignments, and the time per sweep. test_kernels.py asserts the same on a small corpus.
+    """
+    if not kernels.available:
+        print("numba is not installed")
+        return
+    n_docs, vocab_size, doc_length, n_authors = 40, 2000, 100, 8
+    matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+    doc_authors = [authors + [(authors[0] + 1) % n_authors] if doc % 3 == 0 else authors for doc, authors in enumerate(doc_authors)]
+    corpus = Corpus(matrix)
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 10, 30)
+    beta_sum = dadt.beta_mass(beta)
+    print("tokens", corpus.n_tokens)
+
+    def dadt_sweep(enabled, seed):
+        np.random.seed(0)
+        is_atopic, topic, author = dadt.initialize(corpus, doc_authors, num_topics, delta)
+        counts = dadt.count(corpus, is_atopic, topic, author, num_topics, n_authors)
+        cooccurrence_topic_word = dadt.count_topic_word(corpus, is_atopic, topic, num_topics)
+        np.random.seed(seed)
+        sampling.uniforms.block = np.random.random(corpus.n_tokens).tolist()
+        sampling.uniforms.position = 0
+        np.random.seed(seed)
+        kernels.enabled = enabled
+        elapsed, _ = timed(dadt.sweep, 0, corpus, doc_authors, num_topics, alpha, beta, beta_sum, delta, is_atopic, topic, author, counts, cooccurrence_topic_word, None)
+        recounted = dadt.count(corpus, is_atopic, topic, author, num_topics, n_authors)
+        consistent = all(np.array_equal(x[a_d], y[a_d]) for x, y in zip((counts[0], counts[2], counts[3]), (recounted[0], recounted[2], recounted[3])) for a_d in (a, d)) and \
+                     np.array_equal(counts[1], recounted[1]) and \
+                     all(np.array_equal(cooccurrence_topic_word[a_d], dadt.count_topic_word(corpus, is_atopic, topic, num_topics)[a_d]) for a_d in (a, d))
+        return elapsed, np.stack((is_atopic, topic, author)), consistent
+
+    def sampler_sweep(enabled, seed, make, train):
+        sampler = make()
+        np.random.seed(seed)
+        sampling.uniforms.reset()
+        kernels.enabled = enabled
+        elapsed, _ = timed(train, sampler)
+        state = [corpus.flat_state(sampler.topics)] + ([corpus.flat_state(sampler.authors)] if hasattr(sampler, "authors") else [])
+        topics = state[0]
+        consistent = np.array_equal(sampler.cooccur_topic_word, np.histogram2d(topics, corpus.words, bins=(sampler.n_topics, vocab_size), range=((0, sampler.n_topics), (0, vocab_size)))[0]) and \
+                     np.array_equal(sampler.occurrence_topic, np.bincount(topics, minlength=sampler.n_topics))
+        return elapsed, np.stack(state), consistent
+
+    models = [("dadt", dadt_sweep),
+              ("at", lambda enabled, seed: sampler_sweep(enabled, seed, lambda: at.AtSampler(30, n_authors, 0.1, 0.01), lambda sampler: sampler.train(doc_authors, matrix, 0, 1, 1))),
+              ("lda", lambda enabled, seed: sampler_sweep(enabled, seed, lambda: lda.LDA(30, 0.1, 0.01), lambda sampler: sampler.train(matrix, 0, 1, 1)))]
+    for name, sweep in models:
+        sweep(True, 0)  # compile
+        numpy_time, numpy_state, numpy_consistent = sweep(False, 1)
+        kernel_time, kernel_state, kernel_consistent = sweep(True, 1)
+        print("%-4s numpy %7.3fs  kernel %7.3fs  same assignments %.4f  counts consistent %s %s" % (
+              name, numpy_time, kernel_time, np.mean(np.all(numpy_state == kernel_state, axis=0)), numpy_consistent, kernel_consistent))
+    kernels.enabled = kernels.available
+
+def bench_triples_loader(n_docs=2000, words_per_doc=100, vocab_size=5000):
+    """
+    Time and peak Python memory of GibbsLDA.LoadData on a synthetic DocID\tWordID\tFREQUENCY file.
+    """
+    rng = np.random.RandomState(0)
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        for doc in range(n_docs):
+            for word in rng.choice(vocab_size, words_per_doc, replace=False):
+                f.write("d%d\tw%d\t%d\n" % (doc, word, rng.randint(1, 30)))
+    try:
+        tracemalloc.start()
+        elapsed, (docs, words, counts, doc_to_index, word_to_index) = timed(GibbsLDA.LoadData, f.name)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        os.remove(f.name)
+    print("records %d  tokens %d  load %.2fs  peak %.1f MB" % (len(docs), np.sum(counts), elapsed, peak / 1e6))
+
+benchmarks = {
+    "corpus_state": bench_corpus_state,
+    "topic_word_normalizer": bench_topic_word_normalizer,
+    "sparse_sampler": bench_sparse_sampler,
+    "alias_sampler": bench_alias_sampler,
+    "categorical_draw": bench_categorical_draw,
+    "parallel_train": bench_parallel_train,
+    "at_conditional": bench_at_conditional,
+    "at_p": bench_at_p,
+    "at_fa_p2": bench_at_fa_p2,
+    "loglikelihood": bench_loglikelihood,
+    "fold_in": bench_fold_in,
+    "kernels": bench_kernels,
+    "triples_loader": bench_triples_loader,
+}
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or benchmarks:
+        print("==", name)
+        benchmarks[name]()
@@ -0,0 +1,118 @@
+import threading
+import numpy as np
+from scipy.special import gammaln
+
+def log_multi_beta_rows(counts, prior):
+    """
+    Sum over the rows of counts of log B(row + prior) - log B(prior), B the multinomial beta function.
+    The terms of zero counts cancel, so only the non-zero counts are evaluated.
+    prior: a scalar or a vector with an entry per column
+    """
+    prior = np.broadcast_to(np.asarray(prior, dtype=float), counts.shape[1:])
+    rows, columns = np.nonzero(counts)
+    lik = np.sum(gammaln(counts[rows, columns] + prior[columns]) - gammaln(prior[columns]))
+    prior_sum = np.sum(prior)
+    lik -= np.sum(gammaln(np.sum(counts, axis=1) + prior_sum)) - counts.shape[0] * gammaln(prior_sum)
+    return lik
+
+def r_hat(traces):
+    """
+    Gelman-Rubin potential scale reduction factor of traces, a n_chains x n_sweeps array.
+    """
+    n = traces.shape[1]
+    within = np.mean(np.var(traces, axis=1, ddof=1))
+    between = np.var(np.mean(traces, axis=1), ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else np.inf
+    return np.sqrt(((n - 1) / n * within + between) / within)
+
+class RelativeChange(object):
+    def __init__(self, window=10, tolerance=1e-4):
+        """
+        Stopping rule for the burn-in of a single chain, which ends once the mean log-likelihood
+        of the last window sweeps differs from the mean of the window before by less than
+        tolerance relative to it.
+        """
+        self.window = window
+        self.tolerance = tolerance
+        self.trace = []
+
+    def update(self, loglikelihood):
+        """
+        Add the log-likelihood after a sweep, returns True when the burn-in is over.
+        """
+        self.trace.append(loglikelihood)
+        if len(self.trace) < 2 * self.window:
+            return False
+        last = np.mean(self.trace[-self.window:])
+        previous = np.mean(self.trace[-2 * self.window:-self.window])
+        return abs(last - previous) <= self.tolerance * abs(previous)
+
+class RHat(object):
+    def __init__(self, n_chains, threshold=1.1, min_sweeps=20, manager=None):
+        """
+        Stopping rule for n_chains chains running at the same time, e.g. the chains of
+        main.run_chains. The burn-in ends once R-hat of the log-likelihood over the second half of
+        the sweeps all chains have made is below threshold. A chain that is ahead keeps sweeping
+        until the others catch up.
+
+        Every train call takes a monitor from monitor(name). The first n_chains monitors of a
+        name are compared with each other, the next n_chains with each other and so on.
+
+        manager: a started multiprocessing Manager when the chains run in different processes,
+                 the traces are then kept by the manager. Create the rule before the processes
+                 are forked.
+        """
+        self.n_chains = n_chains
+        self.threshold = threshold
+        self.min_sweeps = min_sweeps
+        self.manager = manager
+        if manager is None:
+            self.groups = {}
+            self.lock = threading.Lock()
+        else:
+            self.groups = manager.dict()
+            self.lock = manager.Lock()
+
+    def new_list(self):
+        return [] if self.manager is None else self.manager.list()
+
+    def monitor(self, name):
+        with self.lock:
+            if name not in self.groups:
+                self.groups[name] = self.new_list()
+            groups = self.groups[name]
+            if not len(groups) or len(groups[-1]) == self.n_chains:
+                groups.append(self.new_list())
+            traces = groups[-1]
+            chain = ChainMonitor(self, traces, self.new_list())
+            traces.append(chain.trace)
+        return chain
+
+    def converged(self, traces):
+        with self.lock:
+            if len(traces) < self.n_chains:
+                return False
+            n = min(len(trace) for trace in traces)
+            if n < self.min_sweeps:
+                return False
+            second_half = np.array([trace[n - n // 2:n] for trace in traces])
+        return r_hat(second_half) < self.threshold
+
+class ChainMonitor(object):
+    def __init__(self, rule, traces, trace):
+        """
+        The view of one chain on a RHat rule, traces are the traces of the chains it is compared with
+        and trace the one of this chain.
+        """
+        self.rule = rule
+        self.traces = traces
+        self.trace = trace
+
+    def update(self, loglikelihood):
+        """
+        Add the log-likelihood after a sweep, returns True when the burn-in is over.
+        """
+        with self.rule.lock:
+            self.trace.append(loglikelihood)
+        return self.rule.converged(self.traces)
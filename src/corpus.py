@@ -0,0 +1,100 @@
+import numpy as np
+from scipy import sparse
+
+
+class Corpus(object):
+    def __init__(self, matrix):
+        """
+        Flat token representation of a document-term matrix, a numpy array or a scipy sparse matrix.
+
+        words: int32 array with the word index of every token
+        doc_offsets: int32 array of length n_docs + 1, the tokens of
+                     document doc are words[doc_offsets[doc]:doc_offsets[doc + 1]]
+
+        Tokens appear in the same order as word_indices yields them,
+        if word 5 appears 3 times in a document it is stored as 5 5 5.
+        """
+        self.n_docs, self.vocab_size = matrix.shape
+
+        if sparse.issparse(matrix):
+            matrix = sparse.csr_matrix(matrix)
+            if not matrix.has_sorted_indices:
+                matrix = matrix.sorted_indices()
+            counts = matrix.data.astype(np.int64)
+            self.words = np.repeat(matrix.indices, counts).astype(np.int32)
+            # tokens before the first stored entry of every row
+            token_offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+            np.cumsum(counts, out=token_offsets[1:])
+            self.doc_offsets = token_offsets[matrix.indptr].astype(np.int32)
+        else:
+            counts = matrix.astype(np.int64)
+            docs, words = counts.nonzero()  # row major, so sorted by doc then word
+            self.words = np.repeat(words, counts[docs, words]).astype(np.int32)
+
+            self.doc_offsets = np.zeros(self.n_docs + 1, dtype=np.int32)
+            np.cumsum(counts.sum(axis=1), out=self.doc_offsets[1:])
+
+    @classmethod
+    def from_arrays(cls, words, doc_offsets, vocab_size):
+        corpus = cls.__new__(cls)
+        corpus.words = words
+        corpus.doc_offsets = doc_offsets
+        corpus.n_docs = len(doc_offsets) - 1
+        corpus.vocab_size = vocab_size
+        return corpus
+
+    def documents(self, start, end):
+        """
+        Corpus of the documents start to end - 1, its words are a view of this corpus.
+        """
+        doc_offsets = self.doc_offsets[start:end + 1]
+        return Corpus.from_arrays(self.words[doc_offsets[0]:doc_offsets[-1]], doc_offsets - doc_offsets[0], self.vocab_size)
+
+    def shards(self, n_shards):
+        """
+        Boundaries of n_shards contiguous document ranges with about the same number of tokens,
+        as a list of (start, end).
+        """
+        bounds = np.searchsorted(self.doc_offsets, np.linspace(0, self.n_tokens, n_shards + 1)[1:-1])
+        bounds = np.unique(np.concatenate(([0], bounds, [self.n_docs])))
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+    @property
+    def n_tokens(self):
+        return len(self.words)
+
+    def doc_lengths(self):
+        return np.diff(self.doc_offsets)
+
+    def token_docs(self):
+        """
+        int32 array with the document index of every token.
+        """
+        return np.repeat(np.arange(self.n_docs, dtype=np.int32), self.doc_lengths())
+
+    def tokens(self, doc):
+        return self.words[self.doc_offsets[doc]:self.doc_offsets[doc + 1]]
+
+    def flat_state(self, state):
+        """
+        A per-token state dict keyed by (doc, i), i the position in word_indices order, as an array.
+        """
+        return np.array([state[(doc, i)] for doc in range(self.n_docs) for i in range(self.doc_offsets[doc + 1] - self.doc_offsets[doc])])
+
+    def dict_state(self, array):
+        """
+        Inverse of flat_state.
+        """
+        return {(doc, i): value for doc in range(self.n_docs) for i, value in enumerate(array[self.doc_offsets[doc]:self.doc_offsets[doc + 1]].tolist())}
+
+    def counts(self, docs):
+        """
+        Word counts of the documents docs, restricted to the words occurring in them.
+        Returns (words, counts), counts is a len(docs) x len(words) matrix.
+        """
+        tokens = [self.tokens(doc) for doc in docs]
+        rows = np.repeat(np.arange(len(docs)), [len(doc_tokens) for doc_tokens in tokens])
+        words, columns = np.unique(np.concatenate(tokens), return_inverse=True)
+        counts = np.zeros((len(docs), len(words)))
+        np.add.at(counts, (rows, columns), 1)
+        return (words, counts)
@@ -1,19 +1,15 @@
 #!/usr/bin/python3
+import os
 import numpy as np
+from itertools import repeat
+import sampling
+import shared
+import kernels
+from convergence import log_multi_beta_rows
 
 a = "a"
 d = "d"
 
-def word_indices(vec):
-    """
-    Turn a document vector of size vocab_size to a sequence
-    of word indices. The word indices are between 0 and
-    vocab_size-1. The sequence length is equal to the document length.
-    """
-    for index in vec.nonzero()[0]:  # if word 5 appears 3 times, returns 5 5 5
-        for i in range(int(vec[index])):
-            yield index
-
 def topic_phi(a_d, cooccurrence_topic_word, beta):
     phi = (cooccurrence_topic_word[a_d] + beta[a_d])
     phi /= np.sum(phi, axis=1)[:, np.newaxis]
@@ -39,19 +35,16 @@ def chi(eta, doc_authors,n_authors):
     return chi
 
 def normalise(distribution):
+    return distribution / np.sum(distribution)
 
-    distribution /= np.sum(distribution)
-
-    while True:
-        try:
-            _ = np.random.multinomial(1, distribution).argmax()
-            break
-        except ValueError:
-            distribution = distribution * 0.999999999999999  # dirty hack because of floating point errors
-
-    return distribution
+def beta_mass(beta):
+    """
+    Prior mass of every topic-word row, sum over the vocabulary of beta.
+    Together with occurrence_topic it gives the row sums of cooccurrence_topic_word + beta.
+    """
+    return {a: np.sum(beta[a]), d: np.sum(beta[d])}
 
-def sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic, occurrence_author, n_words_per_doc, alpha, beta, delta):
+def sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic, occurrence_author, n_words_per_doc, alpha, beta, beta_sum, delta):
 
     authors = doc_authors[doc]
 
@@ -67,14 +60,11 @@ def sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occu
 
     ###############################################################################################################################
 
-    vocab_size_a = cooccurrence_topic_word[a].shape[1]
-
     author_atopics = cooccurrence_authordoc_topic[a][authors, :] + alpha[a]
     author_atopics /= np.sum(author_atopics, axis=1)[:, np.newaxis]
 
-    word_atopics = (cooccurrence_topic_word[a] + beta[a])
-    word_atopics /= np.sum(word_atopics, axis=1)[:, np.newaxis]
-    word_atopics = word_atopics[:, word]
+    # occurrence_topic is kept up to date with the counts, so only the column of word is needed
+    word_atopics = (cooccurrence_topic_word[a][:, word] + beta[a][word]) / (occurrence_topic[a] + beta_sum[a])
 
     distribution_a = (delta[a] + n_words_per_doc[a][doc]) * author_atopics * word_atopics
     distribution_a = distribution_a.reshape(len(authors) * n_topics[a])
@@ -82,9 +72,7 @@ def sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occu
 
     #########################################################################################################################
 
-    distribution = np.concatenate((distribution_d, distribution_a))
-    distribution /= np.sum(distribution)
-    index = np.random.multinomial(1, distribution).argmax()
+    index = sampling.sample_index(np.concatenate((distribution_d, distribution_a)))
 
     is_dtopic = index < n_topics[d]
 
@@ -96,103 +84,709 @@ def sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occu
         new_atopic = index % n_topics[a]
         return (not is_dtopic, new_author, new_atopic)
 
-def train(matrix, vocab, doc_authors, n_topics, n_authors, alpha, beta, delta, eta, burn_in, samples, spacing):
-    n_docs, n_words = matrix.shape
-    chi_sampled = chi(eta, doc_authors,n_authors)
-    # Initialize matricies
-
-    n_words_per_doc = {a : np.zeros((n_docs)), d : np.zeros((n_docs))}
-    occurrence_author = np.zeros((n_authors))
-    occurrence_topic = {a : np.zeros((n_topics[a])), d : np.zeros((n_topics[d]))}
-    cooccurrence_authordoc_topic = {a: np.zeros((n_authors, n_topics[a])), d: np.zeros((n_docs, n_topics[d]))}
-    document_atopic_dtopic_ratio = np.zeros((n_docs))
-    document_word_topic = {}  # index : (doc, word-index) value: (1 for atopic 0 for dtopic, topic)
-
-    cooccurrence_topic_word = {a : np.zeros((n_topics[a], n_words)), d : np.zeros((n_topics[d], n_words))}
-    prior_author = np.zeros((n_authors))  # only used in classifier
-    authors = {}
-
-    for doc in range(n_docs):
-        document_atopic_dtopic_ratio[doc] = np.random.beta(delta[a], delta[d])
-        # i is a number between 0 and doc_length-1
-        # w is a number between 0 and vocab_size-1
-        for i, word in enumerate(word_indices(matrix[doc, :])):
-            # choose an arbitrary topic as first topic for word i
-            is_atopic = np.random.binomial(1, document_atopic_dtopic_ratio[doc])
-            if (is_atopic):
-                atopic = np.random.randint(n_topics[a])
-                author = doc_authors[doc][np.random.randint(len(doc_authors[doc]))]
-                occurrence_topic[a][atopic] += 1
-                occurrence_author[author] += 1
-                document_word_topic[(doc, i)] = (is_atopic, atopic)
-                cooccurrence_topic_word[a][atopic, word] += 1
-                cooccurrence_authordoc_topic[a][(author, atopic)] += 1
-                authors[(doc, i)] = author
+class SparseBuckets(object):
+    def __init__(self, corpus, doc_authors, n_topics, alpha, beta, counts, cooccurrence_topic_word):
+        """
+        SparseLDA style sampler (Yao, Mimno and McCallum 2009) for the conditional of sample_topic.
+
+        Both halves of the conditional are split into a smoothing bucket (alpha * beta), a
+        document/author bucket over the topics with a non-zero count in the document or author
+        and a topic-word bucket over the topics with a non-zero count for the word. The smoothing
+        masses and the document/author masses of the current document are cached and updated with
+        every count change, so a token costs time in the number of non-zero topics instead of K.
+
+        counts: (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic)
+                as returned by count, updated in place
+        """
+        (self.n_words_per_doc, self.occurrence_author, self.occurrence_topic, self.cooccurrence_authordoc_topic) = counts
+        self.cooccurrence_topic_word = cooccurrence_topic_word
+        self.corpus = corpus
+        self.doc_authors = doc_authors
+        self.n_topics = n_topics
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_sum = beta_mass(beta)
+
+        # the dtopic word term is normalised with beta[d][word] * vocab_size, keep one smoothing
+        # mass per distinct value of beta[d] (there are only a few, stopwords and the rest)
+        self.dbeta_values, self.dbeta_class = np.unique(beta[d], return_inverse=True)
+        self.dbeta_mass = self.dbeta_values * corpus.vocab_size
+
+        # topics with a non-zero count per author/document and per word
+        self.topics = {a: [set(np.flatnonzero(row).tolist()) for row in self.cooccurrence_authordoc_topic[a]],
+                       d: [set(np.flatnonzero(row).tolist()) for row in self.cooccurrence_authordoc_topic[d]]}
+        self.word_topics = {a: [set() for word in range(corpus.vocab_size)],
+                            d: [set() for word in range(corpus.vocab_size)]}
+        for a_d in (a, d):
+            for topic, word in zip(*cooccurrence_topic_word[a_d].nonzero()):
+                self.word_topics[a_d][word].add(int(topic))
+
+    def begin_document(self, doc):
+        """
+        Recompute the cached masses from the counts for doc, this also
+        removes the rounding errors of the incremental updates.
+        """
+        self.doc = doc
+        self.authors = self.doc_authors[doc]
+
+        self.smoothing = {a: np.sum(1 / (self.occurrence_topic[a] + self.beta_sum[a])),
+                          d: np.sum(1 / (self.occurrence_topic[d][:, np.newaxis] + self.dbeta_mass), axis=0)}
+
+        self.document = np.zeros(len(self.dbeta_values))
+        for topic in self.topics[d][doc]:
+            self.document += self.cooccurrence_authordoc_topic[d][doc, topic] / (self.occurrence_topic[d][topic] + self.dbeta_mass)
+
+        self.author = {}
+        for author in self.authors:
+            topics = list(self.topics[a][author])
+            self.author[author] = np.sum(self.cooccurrence_authordoc_topic[a][author, topics] / (self.occurrence_topic[a][topics] + self.beta_sum[a]))
+
+    def _masses(self, is_atopic, topic, sign):
+        # add (sign 1) or remove (sign -1) the terms of topic from the cached masses
+        if is_atopic:
+            denominator = self.occurrence_topic[a][topic] + self.beta_sum[a]
+            self.smoothing[a] += sign / denominator
+            for author in self.authors:
+                self.author[author] += sign * self.cooccurrence_authordoc_topic[a][author, topic] / denominator
+        else:
+            denominator = self.occurrence_topic[d][topic] + self.dbeta_mass
+            self.smoothing[d] += sign / denominator
+            self.document += sign * self.cooccurrence_authordoc_topic[d][self.doc, topic] / denominator
+
+    def update(self, word, is_atopic, author, topic, change):
+        """
+        Add change (1 or -1) to the counts of a token of the current document.
+        """
+        doc = self.doc
+        topic = int(topic)
+        self._masses(is_atopic, topic, -1)
+
+        if (is_atopic):
+            self.cooccurrence_topic_word[a][topic, word] += change
+            self.cooccurrence_authordoc_topic[a][author, topic] += change
+            self.occurrence_topic[a][topic] += change
+            self.occurrence_author[author] += change
+            self.n_words_per_doc[a][doc] += change
+            author_topics, word_topics = self.topics[a][author], self.word_topics[a][word]
+            author_count, word_count = self.cooccurrence_authordoc_topic[a][author, topic], self.cooccurrence_topic_word[a][topic, word]
+        else:
+            self.cooccurrence_topic_word[d][topic, word] += change
+            self.cooccurrence_authordoc_topic[d][doc, topic] += change
+            self.occurrence_topic[d][topic] += change
+            self.n_words_per_doc[d][doc] += change
+            author_topics, word_topics = self.topics[d][doc], self.word_topics[d][word]
+            author_count, word_count = self.cooccurrence_authordoc_topic[d][doc, topic], self.cooccurrence_topic_word[d][topic, word]
+
+        if author_count > 0:
+            author_topics.add(topic)
+        else:
+            author_topics.discard(topic)
+        if word_count > 0:
+            word_topics.add(topic)
+        else:
+            word_topics.discard(topic)
+
+        self._masses(is_atopic, topic, 1)
+
+    def _dtopic_buckets(self, word):
+        doc = self.doc
+        beta_word = self.beta[d][word]
+        beta_class = self.dbeta_class[word]
+        beta_mass = self.dbeta_mass[beta_class]
+
+        smoothing = beta_word * self.alpha[d] * self.smoothing[d][beta_class]
+        document = beta_word * self.document[beta_class]
+
+        word_topics = list(self.word_topics[d][word])
+        topic_word = (self.cooccurrence_authordoc_topic[d][doc, word_topics] + self.alpha[d]) * \
+                     self.cooccurrence_topic_word[d][word_topics, word] / (self.occurrence_topic[d][word_topics] + beta_mass)
+        return (smoothing, document, word_topics, topic_word)
+
+    def _sample_dtopic(self, word):
+        doc = self.doc
+        beta_word = self.beta[d][word]
+        beta_mass = self.dbeta_mass[self.dbeta_class[word]]
+        smoothing, document, word_topics, topic_word = self._dtopic_buckets(word)
+
+        u = sampling.random() * (smoothing + document + topic_word.sum())
+        if u < smoothing:
+            return sampling.draw(1 / (self.occurrence_topic[d] + beta_mass), u / (beta_word * self.alpha[d]))
+        u -= smoothing
+        if u < document:
+            topics = list(self.topics[d][doc])
+            weights = self.cooccurrence_authordoc_topic[d][doc, topics] / (self.occurrence_topic[d][topics] + beta_mass)
+            return topics[sampling.draw(weights, u / beta_word)]
+        u -= document
+        return word_topics[sampling.draw(topic_word, u)]
+
+    def _atopic_buckets(self, word):
+        authors = self.authors
+        beta_word = self.beta[a][word]
+        author_mass = np.array([self.occurrence_author[author] + self.alpha[a] * self.n_topics[a] for author in authors])
+
+        smoothing = beta_word * self.alpha[a] * self.smoothing[a] / author_mass
+        author_topic = beta_word * np.array([self.author[author] for author in authors]) / author_mass
+
+        word_topics = list(self.word_topics[a][word])
+        topic_word = (self.cooccurrence_authordoc_topic[a][np.ix_(authors, np.array(word_topics, dtype=int))] + self.alpha[a]) / author_mass[:, np.newaxis] * \
+                     (self.cooccurrence_topic_word[a][word_topics, word] / (self.occurrence_topic[a][word_topics] + self.beta_sum[a]))
+        return (author_mass, smoothing, author_topic, word_topics, topic_word)
+
+    def half_masses(self, word):
+        """
+        The sums of the bucket weights of the dtopic and the atopic half for a token of word in
+        the current document, the normalisers of the halves of the sample_topic conditional.
+        """
+        doc = self.doc
+        beta_class = self.dbeta_class[word]
+        word_topics = list(self.word_topics[d][word])
+        dtopic_mass = self.beta[d][word] * (self.alpha[d] * self.smoothing[d][beta_class] + self.document[beta_class]) + \
+                      np.dot(self.cooccurrence_authordoc_topic[d][doc, word_topics] + self.alpha[d],
+                             self.cooccurrence_topic_word[d][word_topics, word] / (self.occurrence_topic[d][word_topics] + self.dbeta_mass[beta_class]))
+
+        word_topics = list(self.word_topics[a][word])
+        word_terms = self.cooccurrence_topic_word[a][word_topics, word] / (self.occurrence_topic[a][word_topics] + self.beta_sum[a])
+        smoothing = self.beta[a][word] * self.alpha[a] * self.smoothing[a]
+        atopic_mass = 0
+        for author in self.authors:
+            atopic_mass += (smoothing + self.beta[a][word] * self.author[author] + np.dot(self.cooccurrence_authordoc_topic[a][author, word_topics] + self.alpha[a], word_terms)) / \
+                           (self.occurrence_author[author] + self.alpha[a] * self.n_topics[a])
+        return {d: dtopic_mass, a: atopic_mass}
+
+    def _sample_atopic(self, word):
+        authors = self.authors
+        beta_word = self.beta[a][word]
+        author_mass, smoothing, author_topic, word_topics, topic_word = self._atopic_buckets(word)
+
+        smoothing_sum = smoothing.sum()
+        author_topic_sum = author_topic.sum()
+
+        u = sampling.random() * (smoothing_sum + author_topic_sum + topic_word.sum())
+        if u < smoothing_sum:
+            index = sampling.draw(smoothing, u)
+            u = (u - smoothing[:index].sum()) / smoothing[index] * self.smoothing[a]
+            return (authors[index], sampling.draw(1 / (self.occurrence_topic[a] + self.beta_sum[a]), u))
+        u -= smoothing_sum
+        if u < author_topic_sum:
+            index = sampling.draw(author_topic, u)
+            u = (u - author_topic[:index].sum()) / beta_word * author_mass[index]
+            topics = list(self.topics[a][authors[index]])
+            weights = self.cooccurrence_authordoc_topic[a][authors[index], topics] / (self.occurrence_topic[a][topics] + self.beta_sum[a])
+            return (authors[index], topics[sampling.draw(weights, u)])
+        u -= author_topic_sum
+        index = sampling.draw(topic_word.reshape(-1), u)
+        return (authors[index // len(word_topics)], word_topics[index % len(word_topics)])
+
+    def sample(self, word):
+        """
+        Draw (is_atopic, author, topic) for a token of the current document from the same
+        conditional as sample_topic. sample_topic normalises both halves separately, so
+        each half has probability 1/2.
+        """
+        if sampling.random() < 0.5:
+            return (0, 0, self._sample_dtopic(word))
+        else:
+            author, atopic = self._sample_atopic(word)
+            return (1, author, atopic)
+
+    def resample_document(self, doc, is_atopic, topic, author):
+        self.begin_document(doc)
+        words = self.corpus.words
+        for i in range(self.corpus.doc_offsets[doc], self.corpus.doc_offsets[doc + 1]):
+            word = words[i]
+            self.update(word, is_atopic[i], author[i], topic[i], -1)
+            is_atopic[i], author[i], topic[i] = self.sample(word)
+            self.update(word, is_atopic[i], author[i], topic[i], 1)
+
+def alias_table(weights):
+    """
+    Walker's alias table (Vose's construction) for sampling from weights
+    in O(1), weights do not have to be normalised.
+    Returns (probability, alias) as lists.
+    """
+    n = len(weights)
+    scaled = (weights * n / np.sum(weights)).tolist()
+    probability = [1.0] * n
+    alias = list(range(n))
+    small = [i for i in range(n) if scaled[i] < 1]
+    large = [i for i in range(n) if scaled[i] >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probability[less] = scaled[less]
+        alias[less] = more
+        scaled[more] += scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    return (probability, alias)
+
+def alias_draw(table):
+    probability, alias = table
+    index = int(sampling.random() * len(probability))
+    if sampling.random() < probability[index]:
+        return index
+    return alias[index]
+
+class AliasSampler(object):
+    def __init__(self, corpus, doc_authors, n_topics, alpha, beta, delta, counts, cooccurrence_topic_word, mh_steps=2):
+        """
+        Metropolis-Hastings sampler with alias table proposals (Yuan et al. 2015, LightLDA).
+
+        A token state is (is_atopic, author, topic), the target is the conditional of
+        sample_topic: both halves normalised separately, so each has probability 1/2. The two
+        normalisers are the bucket sums of a SparseBuckets on the same counts, which keeps
+        its masses up to date, so they cost time in the number of non-zero topics of the
+        word and the document instead of K, and the other terms O(1) per proposal.
+
+        Proposals alternate between
+        word proposals: the word terms of both halves (author uniform among the
+                        document authors), from a per-word alias table that is rebuilt
+                        lazily once it has been used as often as it has entries
+        doc proposals:  the document terms of the dtopic half and the author terms of
+                        the atopic half, each with mass 1/2, from an alias table built
+                        when a document starts
+        so a proposal costs O(1) amortized, and mh_steps proposals are made per token.
+
+        counts: (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic)
+                as returned by count, updated in place
+        """
+        (self.n_words_per_doc, self.occurrence_author, self.occurrence_topic, self.cooccurrence_authordoc_topic) = counts
+        self.cooccurrence_topic_word = cooccurrence_topic_word
+        self.corpus = corpus
+        self.doc_authors = doc_authors
+        self.n_topics = n_topics
+        self.alpha = alpha
+        self.beta = beta
+        self.delta = delta
+        self.beta_sum = beta_mass(beta)
+        self.mh_steps = mh_steps
+
+        # word: (weights, alias table, draws left before rebuild)
+        self.word_tables = {}
+        # the masses of the halves, updated with the counts
+        self.buckets = SparseBuckets(corpus, doc_authors, n_topics, alpha, beta, counts, cooccurrence_topic_word)
+
+    def _word_weights(self, word):
+        vocab_size = self.corpus.vocab_size
+        word_dtopics = (self.cooccurrence_topic_word[d][:, word] + self.beta[d][word]) / (self.occurrence_topic[d] + self.beta[d][word] * vocab_size)
+        word_atopics = (self.cooccurrence_topic_word[a][:, word] + self.beta[a][word]) / (self.occurrence_topic[a] + self.beta_sum[a])
+        return np.concatenate((word_dtopics, word_atopics))
+
+    def begin_document(self, doc):
+        self.doc = doc
+        self.authors = self.doc_authors[doc]
+        self.buckets.begin_document(doc)
+
+        document_dtopics = self.cooccurrence_authordoc_topic[d][doc, :] + self.alpha[d]
+        author_atopics = (self.cooccurrence_authordoc_topic[a][self.authors, :] + self.alpha[a]) / \
+                         (self.occurrence_author[self.authors] + self.alpha[a] * self.n_topics[a])[:, np.newaxis]
+
+        weights = np.concatenate((normalise(document_dtopics), normalise(author_atopics.reshape(-1))))
+        self.doc_weights = (weights / np.sum(weights)).tolist()
+        self.doc_table = alias_table(weights)
+
+    def _word_table(self, word):
+        if word not in self.word_tables or self.word_tables[word][2] <= 0:
+            weights = self._word_weights(word)
+            self.word_tables[word] = [(weights / np.sum(weights)).tolist(), alias_table(weights), len(weights)]
+        self.word_tables[word][2] -= 1
+        return self.word_tables[word]
+
+    def _target(self, word, is_atopic, author, topic):
+        # the weight of a state within its half, the terms of SparseBuckets.half_masses
+        doc = self.doc
+        if is_atopic:
+            return (self.cooccurrence_authordoc_topic[a][author, topic] + self.alpha[a]) / (self.occurrence_author[author] + self.alpha[a] * self.n_topics[a]) * \
+                   (self.cooccurrence_topic_word[a][topic, word] + self.beta[a][word]) / (self.occurrence_topic[a][topic] + self.beta_sum[a])
+        else:
+            return (self.cooccurrence_authordoc_topic[d][doc, topic] + self.alpha[d]) * \
+                   (self.cooccurrence_topic_word[d][topic, word] + self.beta[d][word]) / (self.occurrence_topic[d][topic] + self.beta[d][word] * self.corpus.vocab_size)
+
+    def _word_proposal(self, table, state):
+        # proposal probability of state and a new proposal
+        weights = table[0]
+        is_atopic, author, topic = state
+        n_dtopics = self.n_topics[d]
+        if is_atopic:
+            probability = weights[n_dtopics + topic] / len(self.authors)
+        else:
+            probability = weights[topic]
+        index = alias_draw(table[1])
+        if index < n_dtopics:
+            return probability, (0, 0, index), weights[index]
+        author = self.authors[int(sampling.random() * len(self.authors))]
+        return probability, (1, author, index - n_dtopics), weights[index] / len(self.authors)
+
+    def _doc_proposal(self, state):
+        weights = self.doc_weights
+        is_atopic, author, topic = state
+        n_dtopics, n_atopics = self.n_topics[d], self.n_topics[a]
+        if is_atopic:
+            probability = weights[n_dtopics + self.authors.index(author) * n_atopics + topic]
+        else:
+            probability = weights[topic]
+        index = alias_draw(self.doc_table)
+        if index < n_dtopics:
+            return probability, (0, 0, index), weights[index]
+        new_author = self.authors[(index - n_dtopics) // n_atopics]
+        return probability, (1, new_author, (index - n_dtopics) % n_atopics), weights[index]
+
+    def sample(self, word, state):
+        """
+        mh_steps Metropolis-Hastings steps for a token of the current document,
+        starting at its current state (is_atopic, author, topic).
+        """
+        target = self._target(word, *state)
+        table = self._word_table(word)
+        masses = None
+        for step in range(self.mh_steps):
+            if step % 2 == 0:
+                probability, proposal, proposal_probability = self._word_proposal(table, state)
+            else:
+                probability, proposal, proposal_probability = self._doc_proposal(state)
+            proposal_target = self._target(word, *proposal)
+            # both halves have probability 1/2, the ratio of the probabilities of states in
+            # different halves needs their masses, which are only computed then
+            ratio = 1
+            if proposal[0] != state[0]:
+                if masses is None:
+                    masses = self.buckets.half_masses(word)
+                ratio = masses[a if state[0] else d] / masses[a if proposal[0] else d]
+            if sampling.random() * target * proposal_probability < proposal_target * ratio * probability:
+                state = proposal
+                target = proposal_target
+        return state
+
+    def update(self, word, is_atopic, author, topic, change):
+        self.buckets.update(word, is_atopic, author, topic, change)
+
+    def resample_document(self, doc, is_atopic, topic, author):
+        self.begin_document(doc)
+        words = self.corpus.words
+        for i in range(self.corpus.doc_offsets[doc], self.corpus.doc_offsets[doc + 1]):
+            word = words[i]
+            state = (int(is_atopic[i]), int(author[i]), int(topic[i]))
+            self.update(word, *state, -1)
+            is_atopic[i], author[i], topic[i] = self.sample(word, state)
+            self.update(word, is_atopic[i], author[i], topic[i], 1)
+
+def initialize(corpus, doc_authors, n_topics, delta):
+    """
+    Choose an arbitrary topic (and author) as first assignment of every token.
+    Returns the int32 arrays (is_atopic, topic, author) indexed like corpus.words,
+    author is 0 for tokens with a dtopic.
+    """
+    n_tokens = corpus.n_tokens
+    token_docs = corpus.token_docs()
+
+    document_atopic_dtopic_ratio = np.random.beta(delta[a], delta[d], corpus.n_docs)
+    is_atopic = np.random.binomial(1, document_atopic_dtopic_ratio[token_docs]).astype(np.int32)
+
+    atopics = np.random.randint(n_topics[a], size=n_tokens)
+    dtopics = np.random.randint(n_topics[d], size=n_tokens)
+    topic = np.where(is_atopic, atopics, dtopics).astype(np.int32)
+
+    n_doc_authors = np.array([len(authors) for authors in doc_authors])
+    first_doc_author = np.cumsum(n_doc_authors) - n_doc_authors
+    choice = first_doc_author[token_docs] + (np.random.random(n_tokens) * n_doc_authors[token_docs]).astype(np.int64)
+    author = np.where(is_atopic, np.concatenate(doc_authors)[choice], 0).astype(np.int32)
+
+    return (is_atopic, topic, author)
+
+def cooccurrence(rows, columns, n_rows, n_columns):
+    flat = rows.astype(np.int64) * n_columns + columns
+    return np.bincount(flat, minlength=n_rows * n_columns).reshape(n_rows, n_columns).astype(float)
+
+def count(corpus, is_atopic, topic, author, n_topics, n_authors):
+    """
+    Count matrices of the author and document side for the assignments.
+    """
+    token_docs = corpus.token_docs()
+    atopic = is_atopic == 1
+    dtopic = ~atopic
+
+    n_words_per_doc = {a : np.bincount(token_docs[atopic], minlength=corpus.n_docs).astype(float),
+                       d : np.bincount(token_docs[dtopic], minlength=corpus.n_docs).astype(float)}
+    occurrence_author = np.bincount(author[atopic], minlength=n_authors).astype(float)
+    occurrence_topic = {a : np.bincount(topic[atopic], minlength=n_topics[a]).astype(float),
+                        d : np.bincount(topic[dtopic], minlength=n_topics[d]).astype(float)}
+    cooccurrence_authordoc_topic = {a: cooccurrence(author[atopic], topic[atopic], n_authors, n_topics[a]),
+                                    d: cooccurrence(token_docs[dtopic], topic[dtopic], corpus.n_docs, n_topics[d])}
+
+    return (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic)
+
+def count_topic_word(corpus, is_atopic, topic, n_topics):
+    atopic = is_atopic == 1
+    dtopic = ~atopic
+    return {a : cooccurrence(topic[atopic], corpus.words[atopic], n_topics[a], corpus.vocab_size),
+            d : cooccurrence(topic[dtopic], corpus.words[dtopic], n_topics[d], corpus.vocab_size)}
+
+samplers = ["gibbs", "sparse", "alias"]
+
+def loglikelihood(doc_authors, alpha, beta, delta, counts, cooccurrence_topic_word):
+    """
+    Joint log-likelihood of the words and the assignments with the topic-word,
+    document/author-topic and dtopic/atopic terms.
+    """
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    lik = 0
+    for a_d in (a, d):
+        lik += log_multi_beta_rows(cooccurrence_topic_word[a_d], beta[a_d])
+        lik += log_multi_beta_rows(cooccurrence_authordoc_topic[a_d], alpha[a_d])
+    lik += log_multi_beta_rows(np.column_stack((n_words_per_doc[a], n_words_per_doc[d])), [delta[a], delta[d]])
+    # the author of an atopic token is uniform among the document authors
+    lik -= np.sum(n_words_per_doc[a] * np.log([len(authors) for authors in doc_authors]))
+    return lik
+
+def sampler_buckets(sampler, corpus, doc_authors, n_topics, alpha, beta, delta, counts, cooccurrence_topic_word):
+    if sampler == "sparse":
+        return SparseBuckets(corpus, doc_authors, n_topics, alpha, beta, counts, cooccurrence_topic_word)
+    elif sampler == "alias":
+        return AliasSampler(corpus, doc_authors, n_topics, alpha, beta, delta, counts, cooccurrence_topic_word)
+    return None
+
+def sweep(it, corpus, doc_authors, n_topics, alpha, beta, beta_sum, delta, is_atopic, topic, author, counts, cooccurrence_topic_word, buckets):
+    """
+    Resample every token of corpus once, buckets is None for the dense sampler,
+    which runs as a compiled kernel if kernels.enabled.
+    """
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    if buckets is None and kernels.enabled:
+        print("train it", it)
+        author_offsets, author_list = kernels.flat_authors(doc_authors)
+        kernels.dadt_sweep(corpus.words, corpus.doc_offsets, author_offsets, author_list, is_atopic, topic, author,
+                           n_words_per_doc[a], n_words_per_doc[d], occurrence_author, occurrence_topic[a], occurrence_topic[d],
+                           cooccurrence_authordoc_topic[a], cooccurrence_authordoc_topic[d], cooccurrence_topic_word[a], cooccurrence_topic_word[d],
+                           alpha[a], alpha[d], beta[a], beta[d], beta_sum[a], delta[a], delta[d], np.random.random(corpus.n_tokens))
+        return
+    n_docs = corpus.n_docs
+    words = corpus.words
+    doc_offsets = corpus.doc_offsets
+
+    for doc in range(n_docs):  # all documents
+        print("train it", it, "doc", doc, "/", n_docs)
+        if buckets is not None:
+            buckets.resample_document(doc, is_atopic, topic, author)
+            continue
+        for i in range(doc_offsets[doc], doc_offsets[doc + 1]):
+            word = words[i]
+            old_topic = topic[i]
+
+            if (is_atopic[i]):
+                old_author = author[i]
+                cooccurrence_topic_word[a][old_topic, word] -= 1
+                cooccurrence_authordoc_topic[a][old_author, old_topic] -= 1
+                occurrence_topic[a][old_topic] -= 1
+                occurrence_author[old_author] -= 1
+                n_words_per_doc[a][doc] -= 1
+            else:
+                cooccurrence_topic_word[d][old_topic, word] -= 1
+                cooccurrence_authordoc_topic[d][doc, old_topic] -= 1
+                occurrence_topic[d][old_topic] -= 1
+                n_words_per_doc[d][doc] -= 1
+
+            new_is_atopic, new_author, new_topic = sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic, occurrence_author, n_words_per_doc, alpha, beta, beta_sum, delta)
+
+            is_atopic[i] = new_is_atopic
+            topic[i] = new_topic
+            author[i] = new_author
+
+            if (new_is_atopic):
+                cooccurrence_topic_word[a][new_topic, word] += 1
+                cooccurrence_authordoc_topic[a][new_author, new_topic] += 1
+                occurrence_topic[a][new_topic] += 1
+                occurrence_author[new_author] += 1
                 n_words_per_doc[a][doc] += 1
             else:
-                dtopic = np.random.randint(n_topics[d])
-                cooccurrence_topic_word[d][(dtopic, word)] += 1
-                cooccurrence_authordoc_topic[d][(doc, dtopic)] += 1
-                occurrence_topic[d][dtopic] += 1
+                cooccurrence_topic_word[d][new_topic, word] += 1
+                cooccurrence_authordoc_topic[d][doc, new_topic] += 1
+                occurrence_topic[d][new_topic] += 1
                 n_words_per_doc[d][doc] += 1
-                document_word_topic[(doc, i)] = (is_atopic, dtopic)
 
-    taken_samples = 0
+def train_shard(it, sweeps, seed, corpus, doc_authors, is_atopic, topic, author, n_topics, n_authors, alpha, beta, delta, sampler, global_descriptors):
+    """
+    sweeps sweeps over a shard of the training documents against a local
+    copy of the global counts, returns the new assignments of the shard.
+    """
+    sampling.reseed(seed)
+
+    # the document side counts of the shard are complete, the rest is replaced by the global counts
+    (n_words_per_doc, _, _, cooccurrence_authordoc_topic) = count(corpus, is_atopic, topic, author, n_topics, n_authors)
+    with shared.attached(global_descriptors) as global_counts:
+        occurrence_author = global_counts["occurrence_author"].copy()
+        occurrence_topic = {a: global_counts["occurrence_atopic"].copy(), d: global_counts["occurrence_dtopic"].copy()}
+        cooccurrence_authordoc_topic[a] = global_counts["cooccurrence_author_atopic"].copy()
+        cooccurrence_topic_word = {a: global_counts["cooccurrence_atopic_word"].copy(), d: global_counts["cooccurrence_dtopic_word"].copy()}
+
+    counts = (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic)
+    buckets = sampler_buckets(sampler, corpus, doc_authors, n_topics, alpha, beta, delta, counts, cooccurrence_topic_word)
+    for s in range(sweeps):
+        sweep(it + s, corpus, doc_authors, n_topics, alpha, beta, beta_mass(beta), delta, is_atopic, topic, author, counts, cooccurrence_topic_word, buckets)
+
+    return (is_atopic, topic, author)
+
+def save_checkpoint(path, it, burn_in, trace, taken_samples, is_atopic, topic, author, theta_sampled, phi_sampled, pi_sampled):
+    """
+    Write the state of train after iteration it - 1 to path. The counts are not written, they
+    follow from the assignments. The file is written next to path and then renamed, so a crash
+    while writing leaves the previous checkpoint intact.
+    burn_in: the burn-in, which a stopping rule may have ended early
+    trace: the log-likelihood trace of the stopping rule, or None
+    """
+    rng_name, rng_keys, rng_position, has_gauss, cached_gaussian = np.random.get_state()
+    sampled = {}
+    if trace is not None:
+        sampled["trace"] = np.array(trace[:])
+    if taken_samples > 0:
+        sampled.update(theta_a=theta_sampled[a], theta_d=theta_sampled[d], phi_a=phi_sampled[a], phi_d=phi_sampled[d])
+
+    with open(path + ".tmp", "wb") as f:
+        np.savez_compressed(f, it=it, burn_in=burn_in, taken_samples=taken_samples, is_atopic=is_atopic, topic=topic, author=author, pi=pi_sampled,
+                            rng_keys=rng_keys, rng_position=rng_position, has_gauss=has_gauss, cached_gaussian=cached_gaussian,
+                            uniforms=np.array(sampling.uniforms.block[sampling.uniforms.position:]), **sampled)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+def load_checkpoint(path, corpus):
+    """
+    Read a checkpoint written by save_checkpoint and restore the random state.
+    Returns (it, burn_in, trace, taken_samples, is_atopic, topic, author, theta_sampled, phi_sampled, pi_sampled),
+    trace is None if the checkpoint has none.
+    """
+    with np.load(path) as checkpoint:
+        if len(checkpoint["topic"]) != corpus.n_tokens:
+            raise ValueError("checkpoint " + path + " does not match the corpus")
+        np.random.set_state(("MT19937", checkpoint["rng_keys"], int(checkpoint["rng_position"]), int(checkpoint["has_gauss"]), float(checkpoint["cached_gaussian"])))
+        sampling.uniforms.block = checkpoint["uniforms"].tolist()
+        sampling.uniforms.position = 0
+
+        taken_samples = int(checkpoint["taken_samples"])
+        theta_sampled = {a: 0, d: 0}
+        phi_sampled = {a: 0, d: 0}
+        if taken_samples > 0:
+            theta_sampled = {a: checkpoint["theta_a"], d: checkpoint["theta_d"]}
+            phi_sampled = {a: checkpoint["phi_a"], d: checkpoint["phi_d"]}
+        trace = checkpoint["trace"].tolist() if "trace" in checkpoint else None
+        return (int(checkpoint["it"]), int(checkpoint["burn_in"]), trace, taken_samples, checkpoint["is_atopic"], checkpoint["topic"], checkpoint["author"],
+                theta_sampled, phi_sampled, checkpoint["pi"])
+
+def train(corpus, vocab, doc_authors, n_topics, n_authors, alpha, beta, delta, eta, burn_in, samples, spacing, sampler="gibbs", processes=1, sync_interval=1,
+          checkpoint=None, checkpoint_interval=10, convergence=None):
+    """
+    sampler: "gibbs" draws every token from the dense conditional of sample_topic,
+             "sparse" draws from the same conditional with SparseBuckets,
+             "alias" makes Metropolis-Hastings steps with AliasSampler.
+    processes: with more than one process the documents are split into shards that are
+               sampled in a process pool (approximate distributed LDA, Newman et al. 2009).
+               Every shard samples against its own copy of the global counts, which are merged
+               every sync_interval sweeps and at every sweep a sample is taken. While convergence
+               decides the burn-in they are merged after every sweep, so that the rule is given
+               the log-likelihood of every sweep as with one process.
+    checkpoint: path of a file the sampler state is saved to every checkpoint_interval sweeps.
+                If the file exists, training resumes from it, with the same results as an
+                uninterrupted run with the same settings. The "sparse" and "alias" samplers are
+                rebuilt at every checkpoint, so their results differ from a run without checkpoint.
+                Every chain needs a file of its own, see models.checkpoint_path.
+    convergence: stopping rule for the burn-in, e.g. convergence.RelativeChange(), which is given the
+                 log-likelihood after every sweep. The burn-in ends when the rule is met, burn_in
+                 is then its maximum length.
+    """
+    if sampler not in samplers:
+        raise ValueError("unknown sampler " + str(sampler))
+
+    n_docs = corpus.n_docs
+    chi_sampled = chi(eta, doc_authors,n_authors)
 
     it = 0  # iterations
+    taken_samples = 0
     theta_sampled = {a: 0, d: 0}
     phi_sampled = {a: 0, d: 0}
     pi_sampled = np.zeros((n_docs))
 
-    while taken_samples < samples:
-        print("train", it)
-        for doc in range(n_docs):  # all documents
-            print("train it", it, "doc", doc, "/", n_docs)
-            for i, word in enumerate(word_indices(matrix[doc, :])):
-                old_is_atopic, old_topic = document_word_topic[(doc, i)]
-
-                if (old_is_atopic):
-                    old_author = authors[(doc, i)]
-                    cooccurrence_topic_word[a][old_topic, word] -= 1
-                    cooccurrence_authordoc_topic[a][(old_author, old_topic)] -= 1
-                    occurrence_topic[a][old_topic] -= 1
-                    occurrence_author[old_author] -= 1
-                    n_words_per_doc[a][doc] -= 1
-                else:
-                    cooccurrence_topic_word[d][old_topic, word] -= 1
-                    cooccurrence_authordoc_topic[d][(doc, old_topic)] -= 1
-                    occurrence_topic[d][old_topic] -= 1
-                    n_words_per_doc[d][doc] -= 1
-
-                is_atopic, new_author, new_topic = sample_topic(doc, word, n_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic, occurrence_author, n_words_per_doc, alpha, beta, delta)
-
-                if (is_atopic):
-                    authors[(doc, i)] = new_author
-                    cooccurrence_topic_word[a][new_topic, word] += 1
-                    cooccurrence_authordoc_topic[a][(new_author, new_topic)] += 1
-                    occurrence_topic[a][new_topic] += 1
-                    occurrence_author[new_author] += 1
-                    n_words_per_doc[a][doc] += 1
-                    document_word_topic[(doc, i)] = (is_atopic, new_topic)
-                else:
-                    cooccurrence_topic_word[d][new_topic, word] += 1
-                    cooccurrence_authordoc_topic[d][(doc, new_topic)] += 1
-                    occurrence_topic[d][new_topic] += 1
-                    n_words_per_doc[d][doc] += 1
-                    document_word_topic[(doc, i)] = (is_atopic, new_topic)
-
-        if it >= burn_in:
-            it_after_burn_in = it - burn_in
-            if (it_after_burn_in % spacing) == 0:
-                phi_sampled[a] += topic_phi(a, cooccurrence_topic_word, beta)
-                phi_sampled[d] += topic_phi(d, cooccurrence_topic_word, beta)
-                theta_sampled[a] += topic_theta(a, cooccurrence_authordoc_topic, alpha)
-                theta_sampled[d] += topic_theta(d, cooccurrence_authordoc_topic, alpha)
-                pi_sampled += pi(delta, n_words_per_doc)
-                taken_samples += 1
-
-        it += 1
-
+    if checkpoint is not None and os.path.exists(checkpoint):
+        (it, burn_in, trace, taken_samples, is_atopic, topic, author, theta_sampled, phi_sampled, pi_sampled) = load_checkpoint(checkpoint, corpus)
+        if convergence is not None and trace is not None:
+            convergence.trace[:] = trace
+        print("train resumed from", checkpoint, "at", it)
+    else:
+        is_atopic, topic, author = initialize(corpus, doc_authors, n_topics, delta)
+    next_checkpoint = it + checkpoint_interval
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = count(corpus, is_atopic, topic, author, n_topics, n_authors)
+    cooccurrence_topic_word = count_topic_word(corpus, is_atopic, topic, n_topics)
+    beta_sum = beta_mass(beta)
+
+    if processes > 1:
+        pool = shared.pool(processes)
+        shards = corpus.shards(processes)
+    else:
+        buckets = sampler_buckets(sampler, corpus, doc_authors, n_topics, alpha, beta, delta, (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic), cooccurrence_topic_word)
+
+    try:
+        while taken_samples < samples:
+            print("train", it)
+            if processes > 1:
+                # merge before every sweep at which a sample is taken, and after every sweep of
+                # the burn-in while the convergence rule needs its log-likelihood
+                next_sample = burn_in if it < burn_in else it + (burn_in - it) % spacing
+                sweeps = 1 if convergence is not None and it < burn_in else min(sync_interval, next_sample - it + 1)
+                global_counts = {"occurrence_author": occurrence_author,
+                                 "occurrence_atopic": occurrence_topic[a], "occurrence_dtopic": occurrence_topic[d],
+                                 "cooccurrence_author_atopic": cooccurrence_authordoc_topic[a],
+                                 "cooccurrence_atopic_word": cooccurrence_topic_word[a], "cooccurrence_dtopic_word": cooccurrence_topic_word[d]}
+                seeds = np.random.randint(2**31 - 1, size=len(shards))
+                with shared.SharedArrays(global_counts) as global_shared:
+                    results = pool.starmap(train_shard, [(it, sweeps, seed, corpus.documents(start, end), doc_authors[start:end],
+                                                          is_atopic[corpus.doc_offsets[start]:corpus.doc_offsets[end]],
+                                                          topic[corpus.doc_offsets[start]:corpus.doc_offsets[end]],
+                                                          author[corpus.doc_offsets[start]:corpus.doc_offsets[end]],
+                                                          n_topics, n_authors, alpha, beta, delta, sampler, global_shared.descriptors)
+                                                         for seed, (start, end) in zip(seeds, shards)])
+                is_atopic = np.concatenate([result[0] for result in results])
+                topic = np.concatenate([result[1] for result in results])
+                author = np.concatenate([result[2] for result in results])
+
+                # the global counts plus the deltas of all shards are the counts of the merged assignments
+                (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = count(corpus, is_atopic, topic, author, n_topics, n_authors)
+                cooccurrence_topic_word = count_topic_word(corpus, is_atopic, topic, n_topics)
+                it += sweeps - 1
+            else:
+                sweep(it, corpus, doc_authors, n_topics, alpha, beta, beta_sum, delta, is_atopic, topic, author, (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic), cooccurrence_topic_word, buckets)
+
+            if convergence is not None and it < burn_in:
+                lik = loglikelihood(doc_authors, alpha, beta, delta, (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic), cooccurrence_topic_word)
+                print("train it", it, "likelihood", lik)
+                if convergence.update(lik):
+                    burn_in = it
+
+            if it >= burn_in:
+                it_after_burn_in = it - burn_in
+                if (it_after_burn_in % spacing) == 0:
+                    if taken_samples == 0:
+                        print("train burn-in ended after", it, "sweeps")
+                    phi_sampled[a] += topic_phi(a, cooccurrence_topic_word, beta)
+                    phi_sampled[d] += topic_phi(d, cooccurrence_topic_word, beta)
+                    theta_sampled[a] += topic_theta(a, cooccurrence_authordoc_topic, alpha)
+                    theta_sampled[d] += topic_theta(d, cooccurrence_authordoc_topic, alpha)
+                    pi_sampled += pi(delta, n_words_per_doc)
+                    taken_samples += 1
+
+            it += 1
+
+            if checkpoint is not None and it >= next_checkpoint and taken_samples < samples:
+                save_checkpoint(checkpoint, it, burn_in, None if convergence is None else convergence.trace, taken_samples, is_atopic, topic, author, theta_sampled, phi_sampled, pi_sampled)
+                next_checkpoint = it + checkpoint_interval
+                if processes == 1:
+                    # the sparse and alias samplers keep state that is not in the checkpoint
+                    # (set order, stale alias tables), start them afresh as a resumed run does
+                    buckets = sampler_buckets(sampler, corpus, doc_authors, n_topics, alpha, beta, delta, (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic), cooccurrence_topic_word)
+    finally:
+        # also when a sweep raises, so no workers are left behind
+        if processes > 1:
+            pool.terminate()
+            pool.join()
 
     theta_sampled[a] /= taken_samples
     theta_sampled[d] /= taken_samples
@@ -203,97 +797,113 @@ def train(matrix, vocab, doc_authors, n_topics, n_authors, alpha, beta, delta, e
     return(theta_sampled, phi_sampled, pi_sampled, chi_sampled)
 
 
-def classify(test_matrix, test_burn_in, test_samples, test_spacing, n_topics, alpha, beta, delta, eta, phi_sampled):
-    n_docs, n_words = test_matrix.shape
+def classify_shard(test_corpus, seed, test_burn_in, test_samples, test_spacing, n_topics, alpha, beta, delta, eta, phi_descriptors):
+    sampling.reseed(seed)
+    with shared.attached(phi_descriptors) as phi_sampled:
+        return classify(test_corpus, test_burn_in, test_samples, test_spacing, n_topics, alpha, beta, delta, eta, phi_sampled)
 
-    n_words_per_doc = {a : np.zeros((n_docs)), d : np.zeros((n_docs))}
-    occurrence_author = np.zeros((n_docs))
-    occurrence_topic = {a : np.zeros((n_topics[a])), d : np.zeros((n_topics[d]))}
-    cooccurrence_authordoc_topic = {a: np.zeros((n_docs, n_topics[a])), d: np.zeros((n_docs, n_topics[d]))}
-    document_atopic_dtopic_ratio = np.zeros((n_docs))
-    document_word_topic = {}  # index : (doc, word-index) value: (1 for atopic 0 for dtopic, topic)
-
-    for doc in range(n_docs):
+def classify_sweep(it, test_corpus, n_topics, alpha, delta, phi_sampled, is_atopic, topic, counts):
+    """
+    Resample every token of the test documents once with phi fixed, the fictitious author of
+    document doc is doc. Runs as a compiled kernel if kernels.enabled.
+    """
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    if kernels.enabled:
+        kernels.dadt_classify_sweep(test_corpus.words, test_corpus.doc_offsets, is_atopic, topic, n_words_per_doc[a], n_words_per_doc[d], occurrence_author,
+                                    occurrence_topic[a], occurrence_topic[d], cooccurrence_authordoc_topic[a], cooccurrence_authordoc_topic[d],
+                                    phi_sampled[a], phi_sampled[d], alpha[a], alpha[d], delta[a], delta[d], np.random.random(test_corpus.n_tokens))
+        return
+    n_docs = test_corpus.n_docs
+    words = test_corpus.words
+    doc_offsets = test_corpus.doc_offsets
+
+    for doc in range(n_docs):  # all documents
+        print("classify it", it, "doc", doc, "/", n_docs)
         fic_author = doc
-        document_atopic_dtopic_ratio[doc] = np.random.beta(delta[a], delta[d])
-        # i is a number between 0 and doc_length-1
-        # w is a number between 0 and vocab_size-1
-        for i, word in enumerate(word_indices(test_matrix[doc, :])):
-            # choose an arbitrary topic as first topic for word i
-            is_atopic = np.random.binomial(1, document_atopic_dtopic_ratio[doc])
-            if (is_atopic):
-                atopic = np.random.randint(n_topics[a])
-                occurrence_topic[a][atopic] += 1
-                occurrence_author[fic_author] += 1
-                document_word_topic[(doc, i)] = (is_atopic, atopic)
-                cooccurrence_authordoc_topic[a][(fic_author, atopic)] += 1
-                n_words_per_doc[a][doc] += 1
+        for i in range(doc_offsets[doc], doc_offsets[doc + 1]):
+            word = words[i]
+            old_topic = topic[i]
+
+            if (is_atopic[i]):
+                cooccurrence_authordoc_topic[a][fic_author, old_topic] -= 1
+                occurrence_topic[a][old_topic] -= 1
+                n_words_per_doc[a][doc] -= 1
             else:
-                dtopic = np.random.randint(n_topics[d])
-                cooccurrence_authordoc_topic[d][(doc, dtopic)] += 1
-                occurrence_topic[d][dtopic] += 1
-                n_words_per_doc[d][doc] += 1
-                document_word_topic[(doc, i)] = (is_atopic, dtopic)
+                cooccurrence_authordoc_topic[d][doc, old_topic] -= 1
+                occurrence_topic[d][old_topic] -= 1
+                n_words_per_doc[d][doc] -= 1
 
-    taken_samples = 0
-
-    it = 0  # iterations
-    theta_sampled = {a: 0, d: 0}
-    pi_sampled = np.zeros((n_docs))
+            document_dtopics = (cooccurrence_authordoc_topic[d][doc, :] + alpha[d]) / \
+                              (n_words_per_doc[d][doc] + alpha[d] * n_topics[d])
 
-    while taken_samples < test_samples:
-        print("classify", it)
-        for doc in range(n_docs):  # all documents
-            print("classify it", it, "doc", doc, "/", n_docs)
-            fic_author = doc
-            for i, word in enumerate(word_indices(test_matrix[doc, :])):
-                old_is_atopic, old_topic = document_word_topic[(doc, i)]
+            distribution_d = (delta[d] + n_words_per_doc[d][doc]) * document_dtopics * phi_sampled[d][:, word]
 
-                if (old_is_atopic):
-                    cooccurrence_authordoc_topic[a][(fic_author, old_topic)] -= 1
-                    occurrence_topic[a][old_topic] -= 1
-                    n_words_per_doc[a][doc] -= 1
-                else:
-                    cooccurrence_authordoc_topic[d][(doc, old_topic)] -= 1
-                    occurrence_topic[d][old_topic] -= 1
-                    n_words_per_doc[d][doc] -= 1
+            # normalize to obtain probabilities
+            distribution_d = normalise(distribution_d)
 
-                document_dtopics = (cooccurrence_authordoc_topic[d][doc, :] + alpha[d]) / \
-                                  (n_words_per_doc[d][doc] + alpha[d] * n_topics[d])
+            author_atopics = (cooccurrence_authordoc_topic[a][fic_author, :] + alpha[a]) / \
+                            (occurrence_author[fic_author] + alpha[a] * n_topics[a])
 
-                distribution_d = (delta[d] + n_words_per_doc[d][doc]) * document_dtopics * phi_sampled[d][:, word]
+            distribution_a = (delta[a] + n_words_per_doc[a][doc]) * author_atopics * phi_sampled[a][:, word]
 
-                # normalize to obtain probabilities
-                distribution_d = normalise(distribution_d)
+            # normalize to obtain probabilities
+            distribution_a = normalise(distribution_a)
 
-                author_atopics = (cooccurrence_authordoc_topic[a][fic_author, :] + alpha[a]) / \
-                                (occurrence_author[fic_author] + alpha[a] * n_topics[a])
+            index = sampling.sample_index(np.concatenate((distribution_d, distribution_a)))
 
-                distribution_a = (delta[a] + n_words_per_doc[a][doc]) * author_atopics * phi_sampled[a][:, word]
+            is_dtopic = index < n_topics[d]
 
-                # normalize to obtain probabilities
-                distribution_a = normalise(distribution_a)
+            if is_dtopic:
+                new_dtopic = index
+                cooccurrence_authordoc_topic[d][doc, new_dtopic] += 1
+                occurrence_topic[d][new_dtopic] += 1
+                n_words_per_doc[d][doc] += 1
+                is_atopic[i] = 0
+                topic[i] = new_dtopic
+            else:
+                new_atopic = index - n_topics[d]
+                cooccurrence_authordoc_topic[a][fic_author, new_atopic] += 1
+                occurrence_topic[a][new_atopic] += 1
+                n_words_per_doc[a][doc] += 1
+                is_atopic[i] = 1
+                topic[i] = new_atopic
 
-                distribution = np.concatenate((distribution_d, distribution_a))
+def classify(test_corpus, test_burn_in, test_samples, test_spacing, n_topics, alpha, beta, delta, eta, phi_sampled, processes=1):
+    """
+    Fold in the test documents with phi fixed, every test document has its own fictitious author.
 
-                distribution = normalise(distribution)
+    processes: with more than one process the test documents are split into shards of about
+               the same number of tokens, one chain per shard runs in a process pool with
+               phi in shared memory, and theta and pi are merged back in document order.
+    """
+    if processes > 1:
+        shards = test_corpus.shards(processes)
+        seeds = np.random.randint(2**31 - 1, size=len(shards))
+        with shared.SharedArrays(phi_sampled) as phi_shared, shared.pool(processes) as p:
+            results = p.starmap(classify_shard, zip([test_corpus.documents(start, end) for start, end in shards], seeds,
+                                                     repeat(test_burn_in), repeat(test_samples), repeat(test_spacing), repeat(n_topics),
+                                                     repeat(alpha), repeat(beta), repeat(delta), repeat(eta), repeat(phi_shared.descriptors)))
+        theta_sampled = {a: np.concatenate([theta[a] for theta, _ in results]),
+                         d: np.concatenate([theta[d] for theta, _ in results])}
+        pi_sampled = np.concatenate([pi_shard for _, pi_shard in results])
+        return(theta_sampled, pi_sampled)
+
+    n_docs = test_corpus.n_docs
+
+    # every test document is written by its own fictitious author
+    fic_doc_authors = [[doc] for doc in range(n_docs)]
+    is_atopic, topic, author = initialize(test_corpus, fic_doc_authors, n_topics, delta)
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = count(test_corpus, is_atopic, topic, author, n_topics, n_docs)
 
-                index = np.random.multinomial(1, distribution).argmax()
+    taken_samples = 0
 
-                is_dtopic = index < n_topics[d]
+    it = 0  # iterations
+    theta_sampled = {a: 0, d: 0}
+    pi_sampled = np.zeros((n_docs))
 
-                if is_dtopic:
-                    new_dtopic = index
-                    cooccurrence_authordoc_topic[d][(doc, new_dtopic)] += 1
-                    occurrence_topic[d][new_dtopic] += 1
-                    n_words_per_doc[d][doc] += 1
-                    document_word_topic[(doc, i)] = (0, new_dtopic)
-                else:
-                    new_atopic = index - n_topics[d]
-                    cooccurrence_authordoc_topic[a][(fic_author, new_atopic)] += 1
-                    occurrence_topic[a][new_atopic] += 1
-                    n_words_per_doc[a][doc] += 1
-                    document_word_topic[(doc, i)] = (1, new_atopic)
+    while taken_samples < test_samples:
+        print("classify", it)
+        classify_sweep(it, test_corpus, n_topics, alpha, delta, phi_sampled, is_atopic, topic, (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic))
 
         if it >= test_burn_in:
             it_after_burn_in = it - test_burn_in
@@ -312,27 +922,38 @@ def classify(test_matrix, test_burn_in, test_samples, test_spacing, n_topics, al
 
     return(theta_sampled, pi_sampled)
 
-def dadt_p(matrix, n_authors, theta, phi, pi_test, chi):
-    n_docs, vocab_size = matrix.shape
-    candidate_probabilities = np.zeros((n_docs, n_authors))
-    for doc in range(n_docs):
-        print("deciding doc", doc, "/", n_docs)
-        for candidate in range(n_authors):
-            text_prob = 0
-            for i, word in enumerate(word_indices(matrix[doc, :])):
-                theta_vector = {}
-                phi_vector = {}
-
-                theta_vector[a] = theta[a][candidate, :]
-                phi_vector[a] = phi[a][:, word]
-                author_product =  np.dot(theta_vector[a], phi_vector[a])
-
-                theta_vector[d] = theta[d][doc, :]
-                phi_vector[d] = phi[d][:, word]
-                document_product =  np.dot(theta_vector[d], phi_vector[d])
-
-                text_prob += np.log(pi_test[doc] * author_product + (1-pi_test[doc])*document_product)
+def dadt_p(corpus, n_authors, theta, phi, pi_test, chi, max_elements=2**22):
+    """
+    Log probability of every test document for every candidate author.
 
-            candidate_probabilities[doc, candidate] = np.log(chi[candidate]) + text_prob
+    The author-word mixture theta[a] phi[a] is computed once for the words of the test documents,
+    the document-word mixture per batch of documents for the words in the batch, and every
+    distinct word of a document is weighted by its count. A batch takes documents while its
+    docs x candidates x words mixture has at most max_elements entries (at least one document).
+    """
+    n_docs = corpus.n_docs
+    candidate_probabilities = np.zeros((n_docs, n_authors))
+    test_words = np.unique(corpus.words)
+    author_words = np.dot(theta[a][:n_authors], phi[a][:, test_words])
+    doc_lengths = np.diff(corpus.doc_offsets)
+    start = 0
+    while start < n_docs:
+        # the tokens of the batch bound its number of distinct words
+        end = start + 1
+        while end < n_docs and (end + 1 - start) * n_authors * np.sum(doc_lengths[start:end + 1]) <= max_elements:
+            end += 1
+        print("deciding doc", start, "/", n_docs)
+        docs = np.arange(start, end)
+        words, counts = corpus.counts(docs)
+
+        document_words = np.dot(theta[d][docs], phi[d][:, words])
+        pi_docs = pi_test[docs][:, np.newaxis, np.newaxis]
+        # docs x candidates x words
+        mixture = pi_docs * author_words[np.newaxis, :, np.searchsorted(test_words, words)]
+        mixture += (1 - pi_docs) * document_words[:, np.newaxis, :]
+        text_prob = np.einsum('dcw,dw->dc', np.log(mixture, out=mixture), counts)
+
+        candidate_probabilities[docs] = np.log(chi[:n_authors]) + text_prob
+        start = end
 
     return candidate_probabilities
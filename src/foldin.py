@@ -0,0 +1,58 @@
+import numpy as np
+from sampling import sample_rows
+
+def fold_in(corpus, phi, alpha, burn_in, samples, spacing):
+    """
+    Gibbs sampler for the topics of the documents of corpus with phi fixed, every document
+    has its own topic distribution with prior alpha.
+
+    The documents are independent, so they advance in lockstep: step i resamples the i-th
+    token of every document that has one at once, with array operations over the
+    docs x topics count matrix. The documents are sorted by length, so the documents
+    at step i are a prefix of that order.
+
+    Returns (theta, cooccur_doc_topic, topics), theta averaged over the samples, the counts
+    and the topic of every token after the last sweep.
+    """
+    n_docs = corpus.n_docs
+    n_topics = phi.shape[0]
+    doc_lengths = corpus.doc_lengths()
+
+    topics = np.random.randint(n_topics, size=corpus.n_tokens)
+    cooccur_doc_topic = np.zeros((n_docs, n_topics))
+    np.add.at(cooccur_doc_topic, (corpus.token_docs(), topics), 1)
+
+    order = np.argsort(-doc_lengths, kind='stable')
+    # number of documents with more than i tokens
+    n_active = np.searchsorted(-doc_lengths[order], -np.arange(np.max(doc_lengths, initial=0)), side='left')
+    offsets = corpus.doc_offsets[order]
+    # a row per word occurring in corpus, so a step reads contiguous rows
+    vocab, local_words = np.unique(corpus.words, return_inverse=True)
+    word_topics = np.ascontiguousarray(phi[:, vocab].T)
+
+    theta = 0
+    taken_samples = 0
+
+    it = 0  # iterations
+    while taken_samples < samples:
+        for i, n in enumerate(n_active):
+            docs = order[:n]
+            tokens = offsets[:n] + i
+            words = local_words[tokens]
+
+            cooccur_doc_topic[docs, topics[tokens]] -= 1
+            new_topics = sample_rows((cooccur_doc_topic[docs] + alpha) * word_topics[words])
+            cooccur_doc_topic[docs, new_topics] += 1
+            topics[tokens] = new_topics
+
+        if it >= burn_in:
+            it_after_burn_in = it - burn_in
+            if (it_after_burn_in % spacing) == 0:
+                num = cooccur_doc_topic + alpha
+                theta += num / np.sum(num, axis=1)[:, np.newaxis]
+                taken_samples += 1
+        it += 1
+
+    theta /= taken_samples
+
+    return (theta, cooccur_doc_topic, topics)
@@ -0,0 +1,244 @@
+"""
+Compiled sweeps of the Gibbs samplers over flat token arrays, used by dadt, at and lda
+when numba is installed. Every sweep takes one uniform random number per token, drawn
+with np.random by the caller, so runs are reproducible with np.random.seed.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+    available = True
+except ImportError:
+    available = False
+
+# the samplers use the kernels if enabled, set to False to run the numpy code instead
+enabled = available
+
+def jit(function):
+    if available:
+        return njit(cache=True, nogil=True)(function)
+    return function
+
+def flat_authors(doc_authors):
+    """
+    doc_authors as (offsets, authors), the authors of document doc are authors[offsets[doc]:offsets[doc + 1]].
+    """
+    offsets = np.zeros(len(doc_authors) + 1, dtype=np.int64)
+    np.cumsum([len(authors) for authors in doc_authors], out=offsets[1:])
+    authors = np.array([author for authors in doc_authors for author in authors], dtype=np.int64)
+    return offsets, authors
+
+@jit
+def draw(weights, n, u):
+    """
+    Index below n with probability proportional to weights[:n], u uniform in [0, 1).
+    """
+    total = 0.0
+    for k in range(n):
+        total += weights[k]
+    target = u * total
+    cumulative = 0.0
+    for k in range(n):
+        cumulative += weights[k]
+        if target < cumulative:
+            return k
+    return n - 1
+
+@jit
+def dadt_sweep(words, doc_offsets, author_offsets, author_list, is_atopic, topic, author,
+               n_words_per_doc_a, n_words_per_doc_d, occurrence_author, occurrence_topic_a, occurrence_topic_d,
+               cooccurrence_author_topic, cooccurrence_doc_topic, cooccurrence_atopic_word, cooccurrence_dtopic_word,
+               alpha_a, alpha_d, beta_a, beta_d, beta_sum_a, delta_a, delta_d, uniforms):
+    """
+    dadt.sweep with the conditional of dadt.sample_topic.
+    """
+    n_atopics = cooccurrence_atopic_word.shape[0]
+    n_dtopics = cooccurrence_dtopic_word.shape[0]
+    vocab_size = cooccurrence_dtopic_word.shape[1]
+    max_authors = np.max(author_offsets[1:] - author_offsets[:-1])
+    weights = np.empty(n_dtopics + max_authors * n_atopics)
+
+    for doc in range(len(doc_offsets) - 1):
+        authors = author_list[author_offsets[doc]:author_offsets[doc + 1]]
+        n_weights = n_dtopics + len(authors) * n_atopics
+        for i in range(doc_offsets[doc], doc_offsets[doc + 1]):
+            word = words[i]
+            old_topic = topic[i]
+            if is_atopic[i]:
+                old_author = author[i]
+                cooccurrence_atopic_word[old_topic, word] -= 1
+                cooccurrence_author_topic[old_author, old_topic] -= 1
+                occurrence_topic_a[old_topic] -= 1
+                occurrence_author[old_author] -= 1
+                n_words_per_doc_a[doc] -= 1
+            else:
+                cooccurrence_dtopic_word[old_topic, word] -= 1
+                cooccurrence_doc_topic[doc, old_topic] -= 1
+                occurrence_topic_d[old_topic] -= 1
+                n_words_per_doc_d[doc] -= 1
+
+            # both halves are normalised separately, as in sample_topic
+            total = 0.0
+            for k in range(n_dtopics):
+                weights[k] = (delta_d + n_words_per_doc_d[doc]) * \
+                             (cooccurrence_doc_topic[doc, k] + alpha_d) / (n_words_per_doc_d[doc] + alpha_d * n_dtopics) * \
+                             (cooccurrence_dtopic_word[k, word] + beta_d[word]) / (occurrence_topic_d[k] + beta_d[word] * vocab_size)
+                total += weights[k]
+            for k in range(n_dtopics):
+                weights[k] /= total
+
+            total = 0.0
+            for j in range(len(authors)):
+                for k in range(n_atopics):
+                    weight = (delta_a + n_words_per_doc_a[doc]) * \
+                             (cooccurrence_author_topic[authors[j], k] + alpha_a) / (occurrence_author[authors[j]] + alpha_a * n_atopics) * \
+                             (cooccurrence_atopic_word[k, word] + beta_a[word]) / (occurrence_topic_a[k] + beta_sum_a)
+                    weights[n_dtopics + j * n_atopics + k] = weight
+                    total += weight
+            for k in range(n_dtopics, n_weights):
+                weights[k] /= total
+
+            index = draw(weights, n_weights, uniforms[i])
+            if index < n_dtopics:
+                is_atopic[i] = 0
+                topic[i] = index
+                author[i] = 0
+                cooccurrence_dtopic_word[index, word] += 1
+                cooccurrence_doc_topic[doc, index] += 1
+                occurrence_topic_d[index] += 1
+                n_words_per_doc_d[doc] += 1
+            else:
+                index -= n_dtopics
+                new_author = authors[index // n_atopics]
+                new_topic = index % n_atopics
+                is_atopic[i] = 1
+                topic[i] = new_topic
+                author[i] = new_author
+                cooccurrence_atopic_word[new_topic, word] += 1
+                cooccurrence_author_topic[new_author, new_topic] += 1
+                occurrence_topic_a[new_topic] += 1
+                occurrence_author[new_author] += 1
+                n_words_per_doc_a[doc] += 1
+
+@jit
+def dadt_classify_sweep(words, doc_offsets, is_atopic, topic, n_words_per_doc_a, n_words_per_doc_d, occurrence_author,
+                        occurrence_topic_a, occurrence_topic_d, cooccurrence_author_topic, cooccurrence_doc_topic,
+                        phi_a, phi_d, alpha_a, alpha_d, delta_a, delta_d, uniforms):
+    """
+    A sweep of dadt.classify, phi is fixed and the fictitious author of document doc is doc.
+    """
+    n_atopics = phi_a.shape[0]
+    n_dtopics = phi_d.shape[0]
+    weights = np.empty(n_dtopics + n_atopics)
+
+    for doc in range(len(doc_offsets) - 1):
+        for i in range(doc_offsets[doc], doc_offsets[doc + 1]):
+            word = words[i]
+            old_topic = topic[i]
+            if is_atopic[i]:
+                cooccurrence_author_topic[doc, old_topic] -= 1
+                occurrence_topic_a[old_topic] -= 1
+                n_words_per_doc_a[doc] -= 1
+            else:
+                cooccurrence_doc_topic[doc, old_topic] -= 1
+                occurrence_topic_d[old_topic] -= 1
+                n_words_per_doc_d[doc] -= 1
+
+            total = 0.0
+            for k in range(n_dtopics):
+                weights[k] = (delta_d + n_words_per_doc_d[doc]) * \
+                             (cooccurrence_doc_topic[doc, k] + alpha_d) / (n_words_per_doc_d[doc] + alpha_d * n_dtopics) * phi_d[k, word]
+                total += weights[k]
+            for k in range(n_dtopics):
+                weights[k] /= total
+
+            total = 0.0
+            for k in range(n_atopics):
+                weights[n_dtopics + k] = (delta_a + n_words_per_doc_a[doc]) * \
+                                         (cooccurrence_author_topic[doc, k] + alpha_a) / (occurrence_author[doc] + alpha_a * n_atopics) * phi_a[k, word]
+                total += weights[n_dtopics + k]
+            for k in range(n_dtopics, n_dtopics + n_atopics):
+                weights[k] /= total
+
+            index = draw(weights, n_dtopics + n_atopics, uniforms[i])
+            if index < n_dtopics:
+                is_atopic[i] = 0
+                topic[i] = index
+                cooccurrence_doc_topic[doc, index] += 1
+                occurrence_topic_d[index] += 1
+                n_words_per_doc_d[doc] += 1
+            else:
+                index -= n_dtopics
+                is_atopic[i] = 1
+                topic[i] = index
+                cooccurrence_author_topic[doc, index] += 1
+                occurrence_topic_a[index] += 1
+                n_words_per_doc_a[doc] += 1
+
+@jit
+def at_sweep(words, token_docs, author_offsets, author_list, topics, authors,
+             cooccur_author_topic, cooccur_topic_word, number_words_per_doc, occurrence_topic, num_words_per_author,
+             alpha, alpha_sum, beta, beta_sum, uniforms):
+    """
+    A sweep of AtSampler.train, alpha has an entry per topic and beta one per word.
+    """
+    n_topics = cooccur_topic_word.shape[0]
+    max_authors = np.max(author_offsets[1:] - author_offsets[:-1])
+    weights = np.empty(max_authors * n_topics)
+
+    for i in range(len(words)):
+        word = words[i]
+        doc = token_docs[i]
+        old_topic = topics[i]
+        old_author = authors[i]
+        cooccur_topic_word[old_topic, word] -= 1
+        cooccur_author_topic[old_author, old_topic] -= 1
+        occurrence_topic[old_topic] -= 1
+        num_words_per_author[old_author] -= 1
+        number_words_per_doc[doc] -= 1
+
+        doc_authors = author_list[author_offsets[doc]:author_offsets[doc + 1]]
+        for j in range(len(doc_authors)):
+            for k in range(n_topics):
+                weights[j * n_topics + k] = (cooccur_author_topic[doc_authors[j], k] + alpha[k]) / (num_words_per_author[doc_authors[j]] + alpha_sum) * \
+                                            (cooccur_topic_word[k, word] + beta[word]) / (occurrence_topic[k] + beta_sum)
+
+        index = draw(weights, len(doc_authors) * n_topics, uniforms[i])
+        new_author = doc_authors[index // n_topics]
+        new_topic = index % n_topics
+        cooccur_author_topic[new_author, new_topic] += 1
+        number_words_per_doc[doc] += 1
+        cooccur_topic_word[new_topic, word] += 1
+        occurrence_topic[new_topic] += 1
+        num_words_per_author[new_author] += 1
+        topics[i] = new_topic
+        authors[i] = new_author
+
+@jit
+def lda_sweep(words, token_docs, topics, cooccur_doc_topic, cooccur_topic_word, number_words_per_doc, occurrence_topic,
+              alpha, alpha_sum, beta, beta_sum, uniforms):
+    """
+    A sweep of LDA.train, alpha has an entry per topic and beta one per word.
+    """
+    n_topics = cooccur_topic_word.shape[0]
+    weights = np.empty(n_topics)
+
+    for i in range(len(words)):
+        word = words[i]
+        doc = token_docs[i]
+        old_topic = topics[i]
+        cooccur_doc_topic[doc, old_topic] -= 1
+        number_words_per_doc[doc] -= 1
+        cooccur_topic_word[old_topic, word] -= 1
+        occurrence_topic[old_topic] -= 1
+
+        for k in range(n_topics):
+            weights[k] = (cooccur_topic_word[k, word] + beta[word]) / (occurrence_topic[k] + beta_sum) * \
+                         (cooccur_doc_topic[doc, k] + alpha[k]) / (number_words_per_doc[doc] + alpha_sum)
+
+        new_topic = draw(weights, n_topics, uniforms[i])
+        cooccur_doc_topic[doc, new_topic] += 1
+        number_words_per_doc[doc] += 1
+        cooccur_topic_word[new_topic, word] += 1
+        occurrence_topic[new_topic] += 1
+        topics[i] = new_topic
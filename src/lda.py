@@ -1,14 +1,9 @@
 import numpy as np
-from math import lgamma
-
-gammaln = np.vectorize(lgamma)
-
-def sample_index(p):
-    """
-    Sample from the Multinomial distribution and return the sample index.
-    """
-    return np.random.multinomial(1, p).argmax()
-
+from sampling import sample_index
+from convergence import log_multi_beta_rows
+from corpus import Corpus
+from foldin import fold_in
+import kernels
 
 def word_indices(vec):
     """
@@ -21,13 +16,6 @@ def word_indices(vec):
             yield idx
 
 
-def log_multi_beta(alpha):
-    """
-    Logarithm of the multinomial beta function.
-    """
-    return np.sum(gammaln(alpha)) - gammaln(np.sum(alpha))
-
-
 class LDA(object):
     def __init__(self, n_topics, alpha, beta):
         """
@@ -39,8 +27,8 @@ class LDA(object):
         self.alpha = alpha
         self.beta = beta
 
-    def _initialize(self, matrix):
-        n_docs, vocab_size = matrix.shape
+    def _initialize(self, corpus):
+        n_docs, vocab_size = corpus.n_docs, corpus.vocab_size
 
         self.cooccur_doc_topic = np.zeros((n_docs, self.n_topics))
         self.cooccur_topic_word = np.zeros((self.n_topics, vocab_size))
@@ -51,7 +39,7 @@ class LDA(object):
         for doc in range(n_docs):
             # i is a number between 0 and doc_length-1
             # w is a number between 0 and vocab_size-1
-            for i, word in enumerate(word_indices(matrix[doc, :])):
+            for i, word in enumerate(corpus.tokens(doc).tolist()):
                 # choose an arbitrary topic as first topic for word i
                 topic = np.random.randint(self.n_topics)
                 self.cooccur_doc_topic[doc, topic] += 1
@@ -62,7 +50,7 @@ class LDA(object):
 
     def _conditional_distribution(self, doc, word):
         """
-        Conditional distribution (vector of size n_topics).
+        Conditional distribution (unnormalised vector of size n_topics).
         """
         vocab_size = self.cooccur_topic_word.shape[1]
 
@@ -73,27 +61,13 @@ class LDA(object):
                 (self.number_words_per_doc[doc] + self.alpha * self.n_topics)
 
         p_z = left * right
-        # normalize to obtain probabilities
-        p_z /= np.sum(p_z)
         return p_z
 
     def loglikelihood(self):
         """
         Compute the likelihood that the model generated the data.
         """
-        vocab_size = self.cooccur_topic_word.shape[1]
-        n_docs = self.cooccur_doc_topic.shape[0]
-        lik = 0
-
-        for topic in range(self.n_topics):
-            lik += log_multi_beta(self.cooccur_topic_word[topic, :] + self.beta)
-            lik -= log_multi_beta(self.beta)
-
-        for doc in range(n_docs):
-            lik += log_multi_beta(self.cooccur_doc_topic[doc, :] + self.alpha)
-            lik -= log_multi_beta(self.alpha)
-
-        return lik
+        return log_multi_beta_rows(self.cooccur_topic_word, self.beta) + log_multi_beta_rows(self.cooccur_doc_topic, self.alpha)
 
     def phi(self):
         # word topic distribution
@@ -107,38 +81,44 @@ class LDA(object):
         num /= np.sum(num, axis=1)[:, np.newaxis]
         return num
 
-    def train(self, matrix, burn_in, samples, spacing):
+    def train(self, matrix, burn_in, samples, spacing, convergence=None):
         """
         Run the Gibbs sampler.
+
+        convergence: stopping rule for the burn-in, e.g. convergence.RelativeChange(), which is given
+                     the log-likelihood after every sweep. The burn-in ends when the rule is met,
+                     burn_in is then its maximum length.
         """
-        n_docs, vocab_size = matrix.shape
+        corpus = Corpus(matrix)
+        vocab_size = corpus.vocab_size
 
-        self._initialize(matrix)
+        self._initialize(corpus)
         theta = 0
         phi = 0
         taken_samples = 0
 
+        # the compiled kernel works on the topics as an array in the token order of Corpus
+        compiled = kernels.enabled
+        if compiled:
+            token_docs = corpus.token_docs()
+            topics = corpus.flat_state(self.topics)
+            alpha = np.broadcast_to(np.asarray(self.alpha, dtype=float), (self.n_topics,)).copy()
+            beta = np.broadcast_to(np.asarray(self.beta, dtype=float), (vocab_size,)).copy()
+
         it = 0  # iterations
         while taken_samples < samples:
-            for doc in range(n_docs):  # all documents
-                for i, word in enumerate(word_indices(matrix[doc, :])):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
-                    old_topic = self.topics[(doc, i)]
-                    self.cooccur_doc_topic[doc, old_topic] -= 1
-                    self.number_words_per_doc[doc] -= 1
-                    self.cooccur_topic_word[old_topic, word] -= 1
-                    self.occurrence_topic[old_topic] -= 1
-
-                    p_z = self._conditional_distribution(doc, word)
-                    new_topic = sample_index(p_z)
-
-                    self.cooccur_doc_topic[doc, new_topic] += 1
-                    self.number_words_per_doc[doc] += 1
-                    self.cooccur_topic_word[new_topic, word] += 1
-                    self.occurrence_topic[new_topic] += 1
-                    self.topics[(doc, i)] = new_topic
+            if not compiled:
+                self._sweep(corpus)
+            else:
+                kernels.lda_sweep(corpus.words, token_docs, topics, self.cooccur_doc_topic, self.cooccur_topic_word, self.number_words_per_doc,
+                                  self.occurrence_topic, alpha, np.sum(alpha), beta, np.sum(beta), np.random.random(corpus.n_tokens))
+            if convergence is not None and it < burn_in and convergence.update(self.loglikelihood()):
+                burn_in = it
             if it >= burn_in:
                 it_after_burn_in = it - burn_in
                 if (it_after_burn_in % spacing) == 0:
+                    if taken_samples == 0:
+                        print("burn-in ended after", it, "sweeps")
                     theta += self.theta()
                     phi += self.phi()
                     taken_samples += 1
@@ -146,42 +126,38 @@ class LDA(object):
 
         theta /= taken_samples
         phi /= taken_samples
+        if compiled:
+            self.topics = corpus.dict_state(topics)
 
         return (theta, phi, self.loglikelihood())
 
-    def classify(self, matrix, phi, burn_in, samples, spacing):
-        n_docs, vocab_size = matrix.shape
+    def _sweep(self, corpus):
+        for doc in range(corpus.n_docs):  # all documents
+            for i, word in enumerate(corpus.tokens(doc).tolist()):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
+                old_topic = self.topics[(doc, i)]
+                self.cooccur_doc_topic[doc, old_topic] -= 1
+                self.number_words_per_doc[doc] -= 1
+                self.cooccur_topic_word[old_topic, word] -= 1
+                self.occurrence_topic[old_topic] -= 1
 
-        self._initialize(matrix)
-        theta = 0
-        taken_samples = 0
+                p_z = self._conditional_distribution(doc, word)
+                new_topic = sample_index(p_z)
 
-        it = 0  # iterations
-        while taken_samples < samples:
-            for doc in range(n_docs):  # all documents
-                for i, word in enumerate(word_indices(matrix[doc, :])):  # 1 3, 2 3, 3 3, 4 3, 5 4, 6 4, ...
-                    old_topic = self.topics[(doc, i)]
-                    self.cooccur_doc_topic[doc, old_topic] -= 1
-                    self.number_words_per_doc[doc] -= 1
-                    self.occurrence_topic[old_topic] -= 1
-
-                    distribution = ((self.cooccur_doc_topic[doc, :] + self.alpha) / \
-                                    (self.number_words_per_doc[doc] + self.alpha * self.n_topics) * phi[:, word])
-                    distribution /= np.sum(distribution)
-                    new_topic = sample_index(distribution)
-
-                    self.cooccur_doc_topic[doc, new_topic] += 1
-                    self.number_words_per_doc[doc] += 1
-                    self.occurrence_topic[new_topic] += 1
-                    self.topics[(doc, i)] = new_topic
-            if it >= burn_in:
-                it_after_burn_in = it - burn_in
-                if (it_after_burn_in % spacing) == 0:
-                    theta += self.theta()
-                    phi += self.phi()
-                    taken_samples += 1
-            it += 1
+                self.cooccur_doc_topic[doc, new_topic] += 1
+                self.number_words_per_doc[doc] += 1
+                self.cooccur_topic_word[new_topic, word] += 1
+                self.occurrence_topic[new_topic] += 1
+                self.topics[(doc, i)] = new_topic
 
-        theta /= taken_samples
+    def classify(self, matrix, phi, burn_in, samples, spacing):
+        """
+        Fold in the test documents with phi fixed, all documents advance in lockstep (foldin.fold_in).
+        """
+        corpus = Corpus(matrix)
+        theta, self.cooccur_doc_topic, topics = fold_in(corpus, phi, self.alpha, burn_in, samples, spacing)
+        self.number_words_per_doc = corpus.doc_lengths().astype(float)
+        self.cooccur_topic_word = np.zeros((self.n_topics, corpus.vocab_size))
+        np.add.at(self.cooccur_topic_word, (topics, corpus.words), 1)
+        self.occurrence_topic = np.sum(self.cooccur_topic_word, axis=1)
 
         return (theta, self.loglikelihood())
@@ -1,10 +1,14 @@
 #!/usr/bin/python3
-import sys, os, re
+import sys, os, re, random, hashlib, shutil, json
+from array import array
 import numpy as np
+from scipy import sparse
 from models import *
 import math
-from multiprocessing.pool import ThreadPool
+import multiprocessing
 from itertools import repeat
+import shared
+from scheduler import Scheduler
 # import yappi
 
 # DIRECTORY = '../data/nichtschiller/'
@@ -13,7 +17,12 @@ from itertools import repeat
 # DIRECTORY = '../data/c10processed/'
 DIRECTORY = '../data/pan11processed/'
 # DIRECTORY = '../data/pan12processed-tiny/'
+# tokens of the files read by read_files, reused while the files are unchanged
+TOKEN_CACHE = '../data/tokencache/'
 cores = 32
+# every chain, fold and model is a task of one scheduler with cores workers, tasks are admitted
+# while their cores are free and their memory estimates fit into 80% of the available memory
+scheduler = Scheduler(cores)
 
 stopwords = []
 stopfile = open("../data/stopwords.txt")
@@ -22,19 +31,98 @@ for line in stopfile:
     stopwords.append(line)
 stopfile.close()
 
+# characters removed from the words of a document, whitespace separates the words
+token_pattern = re.compile(r'[^\w\s]|_')
+
+def tokenize_file(path):
+    with open(path) as f:
+        return token_pattern.sub('', f.read().lower()).split()
+
+def write_token_cache(cache, paths):
+    """
+    Tokenize the files of paths in a process pool and save the tokens to the directory cache,
+    as the words in vocab.txt, one per line, the int32 word of every token in tokens.npy and
+    the int64 start of every document in offsets.npy.
+    """
+    lookup = {}
+    tokens = array('i')
+    offsets = [0]
+    with shared.pool(cores) as p:
+        for content in p.imap(tokenize_file, paths, chunksize=max(1, len(paths) // (4 * cores))):
+            tokens.extend([lookup.setdefault(word, len(lookup)) for word in content])
+            offsets.append(len(tokens))
+
+    # written next to cache and renamed, so an interrupted run leaves no partial cache
+    temporary = cache + '.tmp' + str(os.getpid())
+    os.makedirs(temporary)
+    with open(os.path.join(temporary, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(lookup))
+    np.save(os.path.join(temporary, 'tokens.npy'), np.frombuffer(tokens, dtype=np.int32))
+    np.save(os.path.join(temporary, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+    try:
+        os.replace(temporary, cache)
+    except OSError:  # written by another run in the meantime
+        shutil.rmtree(temporary)
+
+def prune_token_caches(folder, cache):
+    """
+    Record cache as the token cache of folder in TOKEN_CACHE/caches.json and remove the cache the
+    folder had before, so the caches of earlier versions of a folder do not pile up.
+    """
+    path = os.path.join(TOKEN_CACHE, 'caches.json')
+    caches = {}
+    if os.path.isfile(path):
+        with open(path) as f:
+            caches = json.load(f)
+    folder = os.path.abspath(folder)
+    previous = caches.get(folder)
+    if previous == os.path.basename(cache):
+        return
+    if previous is not None:
+        print('removing the token cache of an earlier version of', folder)
+        shutil.rmtree(os.path.join(TOKEN_CACHE, previous), ignore_errors=True)
+    caches[folder] = os.path.basename(cache)
+    temporary = path + '.tmp' + str(os.getpid())
+    with open(temporary, 'w') as f:
+        json.dump(caches, f)
+    os.replace(temporary, path)
+
 def read_files(folder, author_ids):
-    pattern = re.compile(r'[\W_]+')
+    """
+    Tokens and author of every file author-number.txt in folder, in file name order.
+    The files are tokenized in parallel and cached in TOKEN_CACHE under a key of the file names,
+    sizes and mtimes, later runs on the unchanged folder memory-map the cache instead.
+    The cache of an earlier version of the folder is removed (prune_token_caches).
+    The tokens are returned as they are cached, docs is (tokens, offsets, vocab): the word
+    tokens[i] of the documents is vocab[tokens[i]], vocab a list of str, and the tokens of
+    document doc are tokens[offsets[doc]:offsets[doc + 1]].
+    """
     author_pattern = re.compile(r'(\w+)-\d+\.txt')
-    files = os.listdir(folder)
-    docs_content = []
-    doc_authors = []
-    for filename in files:
-        match = author_pattern.match(filename)
-        if not match:
+    files = []
+    for filename in sorted(os.listdir(folder)):
+        if not author_pattern.match(filename):
             print('No match in', filename)
             continue
+        files.append(filename)
+
+    stats = [os.stat(folder + filename) for filename in files]
+    key = repr((os.path.abspath(folder), token_pattern.pattern, [(filename, stat.st_size, stat.st_mtime_ns) for filename, stat in zip(files, stats)]))
+    cache = os.path.join(TOKEN_CACHE, hashlib.sha1(key.encode()).hexdigest())
+    if not os.path.isdir(cache):
+        print('TOKENIZE', folder)
+        os.makedirs(TOKEN_CACHE, exist_ok=True)
+        write_token_cache(cache, [folder + filename for filename in files])
+    prune_token_caches(folder, cache)
+
+    # a list, a str array would be as wide as the longest word, e.g. a URL without its punctuation
+    with open(os.path.join(cache, 'vocab.txt')) as f:
+        vocab = f.read().split('\n')
+    tokens = np.load(os.path.join(cache, 'tokens.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(cache, 'offsets.npy'), mmap_mode='r')
 
-        author = match.group(1)
+    doc_authors = []
+    for filename in files:
+        author = author_pattern.match(filename).group(1)
 
         if author not in author_ids:
             author_id = len(author_ids)
@@ -42,153 +130,105 @@ def read_files(folder, author_ids):
         else:
             author_id = author_ids[author]
 
-        with open(folder + filename) as f:
-            content = []
-            for line in f:
-                words = [pattern.sub('', w.lower()) for w in line.split()]
-                content.extend(words)
-            docs_content.append(content)
-            doc_authors.append([author_id])
+        doc_authors.append([author_id])
 
-    return docs_content, doc_authors, author_ids
+    return (tokens, offsets, vocab), doc_authors, author_ids
 
-def cross_validation(n, models, docs_content, doc_authors, _):
-    print("CROSS VALIDATION", n)
-    author_docs = [set([doc for doc, author in enumerate(doc_authors) if author == a]) for a in sorted(set(doc_authors))]
+def fold_splits(n, doc_authors, n_authors):
+    """
+    The test documents of each of n folds, the documents of every author are spread evenly over the folds.
+    """
     author_splits = {}
 
-    for author in range(len(author_ids)):
-        sample_size =  len(author_docs[author])//n
-        rest = len(author_docs[author]) % n
-        for i in range(n):
-            if i == 0:
-                author_splits[author] = []
-            actual_size = sample_size
-            if i < rest:
-                actual_size += 1
-            sample = set(random.sample(author_docs[author], actual_size))
-            author_docs[author] -= sample
-            author_splits[author].append(sample)
-
-    numbers = list(range(n))
-    with ThreadPool(cores) as p:
-        real_author_list = p.starmap(fold_map_function, zip(numbers, repeat(models), repeat(author_ids), repeat(author_splits), repeat(docs_content), repeat(doc_authors)))
-
-    test_authors = {}
-
-    for folddict in real_author_list:
-        for model, modeldict in folddict.items():
-            if not model in test_authors:
-                test_authors[model] = {}
-            test_authors[model].update(modeldict)
-
-    print("END CROSS VALIDATION")
-
-    return test_authors, STAT_OBJS
-
-def fold_map_function(i, models, author_ids, author_splits, docs_content, doc_authors):
-
-    print("FOLD", i)
-    train_docs_content = {}
-    test_docs_content = {}
-    train_doc_authors = []
-    real_ids = {}
-    train_docs_num = 0
-    test_docs_num = 0
-
-    for author in range(len(author_ids)):
-        for sample_number, sample in enumerate(author_splits[author]):
-            for doc_id in sample:
-                if(sample_number == i):
-                    test_docs_content[test_docs_num] = docs_content[doc_id]
-                    real_ids[test_docs_num] = doc_id
-                    test_docs_num += 1
-                else:
-                    train_docs_content[train_docs_num] = docs_content[doc_id]
-                    train_doc_authors.append(doc_authors[doc_id])
-                    train_docs_num += 1
-
-    (matrix, test_matrix, n_authors, vocab) = build_data(train_docs_content, test_docs_content, author_ids)
-
-    author_probs_dict = model_map(models, matrix, test_matrix, n_authors, train_doc_authors, vocab, stopwords)
-
-    real_authors = {}
-    for model in models:
-        real_authors[model.__name__] = {}
-        for doc, authors in enumerate(author_probs_dict[model.__name__]):
-            real_doc_id = real_ids[doc]
-            real_authors[model.__name__][real_doc_id] = authors
-
-    print("END FOLD", i)
-    return real_authors
-
-def model_map(models, matrix, test_matrix, n_authors, train_doc_authors, vocab, stopwords, _):
-    with ThreadPool(cores) as p:
-        author_probs_list = p.starmap(model_help_function, zip(models, repeat(matrix), repeat(test_matrix), repeat(n_authors), repeat(train_doc_authors), repeat(vocab), repeat(stopwords)))
-    author_probs_dict = {models[i].__name__: content for i, content in enumerate(author_probs_list)}
-    return author_probs_dict
-
-def model_help_function(model, matrix, test_matrix, n_authors, train_doc_authors, vocab, stopwords):
-    result = model(matrix, test_matrix, n_authors, train_doc_authors, vocab, stopwords)
-
-    return result
-
-def build_data(train_docs_content, test_docs_content, author_ids):
-
+    for author in range(n_authors):
+        author_docs = [doc for doc, authors in enumerate(doc_authors) if authors[0] == author]
+        random.shuffle(author_docs)
+        author_splits[author] = [author_docs[i::n] for i in range(n)]
+
+    return [np.sort(np.array([doc for splits in author_splits.values() for doc in splits[i]], dtype=np.int64)) for i in range(n)]
+
+def task_memory(model, n_docs, n_tokens, vocab_size):
+    """
+    Rough estimate of the bytes a model task holds, for the admission of the scheduler: a few float64
+    topics x vocab_size count and sample matrices, one more for every further process of the model,
+    the topics x docs counts and some arrays per token.
+    """
+    topics = model_topics(model)
+    return 8 * ((3 + model_cores(model)) * topics * vocab_size + 2 * topics * n_docs + 16 * n_tokens)
+
+def run_model(model, descriptors, train_docs, test_docs, n_authors, train_doc_authors, vocab, scope, chain):
+    """
+    A task of the scheduler, model on the shared matrices: the rows train_docs and test_docs of
+    "matrix" for a fold, "matrix" and "test_matrix" if train_docs is None.
+    scope: the fold, the chains of a convergence.RHat are compared within it
+    chain: the number of the chain within the scope
+    """
+    set_task(scope, chain)
+    with shared.attached(descriptors) as arrays:
+        if train_docs is None:
+            matrix, test_matrix = arrays["matrix"], arrays["test_matrix"]
+        else:
+            matrix, test_matrix = arrays["matrix"][train_docs], arrays["matrix"][test_docs]
+        return np.asarray(model(matrix, test_matrix, n_authors, train_doc_authors, vocab, stopwords))
+
+def count_matrix(tokens, offsets, word_ids, vocab_size):
+    """
+    Sparse CSR document-term matrix with int32 word counts of the documents of read_files,
+    word_ids maps their word ids to the columns, -1 leaves a word out.
+    """
+    columns = word_ids[tokens]
+    rows = np.repeat(np.arange(len(offsets) - 1, dtype=np.int32), np.diff(offsets))
+    kept = columns >= 0
+    matrix = sparse.csr_matrix((np.ones(np.count_nonzero(kept), dtype=np.int32), (rows[kept], columns[kept])), shape=(len(offsets) - 1, vocab_size))
+    matrix.sum_duplicates()
+    return matrix
+
+def build_index(parts):
+    """
+    The vocabulary in sorted order and the CSR count matrix of all documents of a corpus,
+    built once, train/test splits and folds are row selections of the matrix.
+    parts: docs of read_files, their rows follow each other in the matrix.
+    Words of one character are left out. The word ids of the caches are mapped to the columns
+    through the vocabularies of the caches, the tokens are never turned into strings.
+    """
     print("PREPROCESS")
 
-    vocab = set()
-    for doc, content in enumerate(train_docs_content):
-        for word in content:
-            if len(word) > 1:
-                vocab.add(word)
-
-    for doc, content in enumerate(test_docs_content):
-        for word in content:
-            if len(word) > 1:
-                vocab.add(word)
+    vocab = sorted(set(word for _, _, words in parts for word in words if len(word) > 1))
+    columns = {word: column for column, word in enumerate(vocab)}
 
-    vocab = list(vocab)
-    lookupvocab = dict([(word, index) for (index, word) in enumerate(vocab)])
+    matrices = []
+    for tokens, offsets, words in parts:
+        word_ids = np.array([columns.get(word, -1) for word in words], dtype=np.int32)
+        matrices.append(count_matrix(tokens, offsets, word_ids, len(vocab)))
+    matrix = sparse.vstack(matrices, format="csr", dtype=np.int32)
 
-    matrix = np.zeros((len(train_docs_content), len(vocab)))
-
-    test_matrix = np.zeros((len(test_docs_content), len(vocab)))
+    print("END PREPROCESS")
 
-    for doc, content in enumerate(train_docs_content):
-        for word in content:
-            if len(word) > 1:
-                matrix[doc, lookupvocab[word]] += 1
+    return (matrix, vocab)
 
-    for doc, content in enumerate(test_docs_content):
-        for word in content:
-            if len(word) > 1:
-                test_matrix[doc, lookupvocab[word]] += 1
+def build_data(train_docs, test_docs, author_ids):
+    (matrix, vocab) = build_index([train_docs, test_docs])
+    n_train = len(train_docs[1]) - 1
 
     n_authors = len(author_ids)
 
-    print("END PREPROCESS")
-
-    return(matrix, test_matrix, n_authors, vocab)
-
-def run_chains(function, arguments, test_doc_authors):
+    return (matrix[:n_train], matrix[n_train:], n_authors, vocab)
 
+def run_chains(tasks, n_authors, test_doc_authors):
+    """
+    Runs tasks, a list of (model name, test_docs, function, arguments, cores, memory) for every chain,
+    fold and model, on the scheduler. function(*arguments) returns the docs x authors probabilities
+    of the documents test_docs, they are summed over the chains as the tasks complete.
+    """
     print('run chains')
-    doc_probabilities = 0
-
-    with ThreadPool(cores) as p:
-        test_authors_list = p.starmap(function, arguments)
-
-    for test_authors in test_authors_list:
-        for model, rest in test_authors.items():
-            num_docs = len(test_doc_authors)
-            num_authors = len(rest[0])
-            if np.all(doc_probabilities == 0):
-                doc_probabilities = {}
-            for doc_id, probs in enumerate(rest):
-                if model not in doc_probabilities:
-                    doc_probabilities[model] = np.zeros((num_docs, num_authors))
-                doc_probabilities[model][doc_id] += probs
+    doc_probabilities = {}
+
+    for i, author_probs in scheduler.run([task[2:] for task in tasks]):
+        model, test_docs = tasks[i][:2]
+        print("done", model, "task", i)
+        if model not in doc_probabilities:
+            doc_probabilities[model] = np.zeros((len(test_doc_authors), n_authors))
+        doc_probabilities[model][test_docs] += author_probs
 
     guessed_authors = {}
     for model, rest in doc_probabilities.items():
@@ -202,24 +242,50 @@ def run_chains(function, arguments, test_doc_authors):
 
 def cross_main(chains, n_fold, models):
     author_ids = {}
-    docs_content, doc_authors, author_ids = read_files(DIRECTORY, author_ids)
-    accuracies = run_chains(cross_validation, zip(repeat(models), repeat(docs_content), repeat(doc_authors), range(chains)), doc_authors)
+    docs, doc_authors, author_ids = read_files(DIRECTORY, author_ids)
+    (matrix, vocab) = build_index([docs])
+    n_authors = len(author_ids)
+    doc_lengths = np.asarray(matrix.sum(axis=1)).ravel()
+
+    # the chains share the folds, the chains of a fold and model are next to each other
+    tasks = []
+    all_docs = np.arange(len(doc_authors))
+    # every fold of every chain selects its rows from this one matrix in shared memory
+    with shared.SharedArrays({"matrix": matrix}) as arrays:
+        for fold, test_docs in enumerate(fold_splits(n_fold, doc_authors, n_authors)):
+            train_docs = np.setdiff1d(all_docs, test_docs)
+            train_doc_authors = [doc_authors[doc] for doc in train_docs]
+            n_tokens = np.sum(doc_lengths[train_docs])
+            for model in models:
+                memory = task_memory(model, len(doc_authors), n_tokens, len(vocab))
+                for chain in range(chains):
+                    tasks.append((model.__name__, test_docs, run_model,
+                                  (model, arrays.descriptors, train_docs, test_docs, n_authors, train_doc_authors, vocab, fold, chain), model_cores(model), memory))
+        accuracies = run_chains(tasks, n_authors, doc_authors)
     return(accuracies)
 
 def train_main(chains, n_fold, models):
     print("train main")
     author_ids = {} # schiller -> 1
 
-    train_docs_content, train_doc_authors, author_ids = read_files(DIRECTORY + 'train/', author_ids)
-    test_docs_content, test_doc_authors, author_ids = read_files(DIRECTORY + 'test/', author_ids)
+    train_docs, train_doc_authors, author_ids = read_files(DIRECTORY + 'train/', author_ids)
+    test_docs, test_doc_authors, author_ids = read_files(DIRECTORY + 'test/', author_ids)
 
-    (matrix, test_matrix, n_authors, vocab) = build_data(train_docs_content, test_docs_content, author_ids)
-    accuracies = run_chains(model_map, zip(repeat(models), repeat(matrix), repeat(test_matrix), repeat(n_authors), repeat(train_doc_authors), repeat(vocab), repeat(stopwords), range(chains)), test_doc_authors)
+    (matrix, test_matrix, n_authors, vocab) = build_data(train_docs, test_docs, author_ids)
+    # the chains read the matrices from shared memory instead of each getting a pickled copy
+    with shared.SharedArrays({"matrix": matrix, "test_matrix": test_matrix}) as arrays:
+        tasks = [(model.__name__, slice(None), run_model, (model, arrays.descriptors, None, None, n_authors, train_doc_authors, vocab, None, chain),
+                  model_cores(model), task_memory(model, matrix.shape[0] + test_matrix.shape[0], matrix.sum(), len(vocab)))
+                 for model in models for chain in range(chains)]
+        accuracies = run_chains(tasks, n_authors, test_doc_authors)
 
     return(accuracies)
 
 chains = 4
 n_fold = 10
+# end the burn-in of every model once its chains agree, instead of after the fixed burn_in
+# import convergence
+# set_convergence_rule(convergence.RHat(chains, manager=multiprocessing.Manager()).monitor)
 models = [DADT_P]
 # models = [TOKEN_SVM, LDA_SVM, AT_SVM, AT_P, AT_FA_SVM, AT_FA_P1, AT_FA_P2, DADT_SVM, DADT_P]
 
@@ -1,10 +1,13 @@
 #!/usr/bin/python3
 import numpy as np
+from scipy import sparse
 import random
 import lda
 import at
 import dadt
+from corpus import Corpus
 import copy
+import hashlib
 import sys, os
 sys.path.append(os.path.abspath("liblinear/python"))
 import liblinearutil as ll
@@ -12,10 +15,58 @@ import liblinearutil as ll
 a = "a"
 d = "d"
 
-def concatenate_fic_authors(doc_authors, num_topics):
+# stopping rule for the burn-in of the samplers, None runs the fixed burn_in of every model.
+# Otherwise a function of the model name returning the rule of one train call, e.g.
+# lambda name: convergence.RelativeChange() or the monitor method of a convergence.RHat
+# shared by the chains of main.run_chains, burn_in is then the maximum burn-in.
+convergence_rule = None
+
+def set_convergence_rule(rule):
+    global convergence_rule
+    convergence_rule = rule
+
+# the fold a model runs on, chains are compared by the convergence rule within a scope,
+# and the chain of the model in main.run_chains
+convergence_scope = None
+task_chain = 0
+
+def set_task(scope, chain):
+    global convergence_scope, task_chain
+    convergence_scope = scope
+    task_chain = chain
+
+def checkpoint_path(checkpoint, corpus, doc_authors):
+    """
+    The checkpoint file of this chain on the training data: checkpoint followed by a digest of the
+    tokens and authors and the chain, so the chains and folds running at the same time do not
+    resume from each other's state, and a rerun on the same data resumes its own chains.
+    """
+    digest = hashlib.sha1(corpus.words.tobytes() + corpus.doc_offsets.tobytes() + repr(doc_authors).encode()).hexdigest()[:16]
+    return checkpoint + "-" + digest + "-" + str(task_chain)
+
+def burn_in_rule(name):
+    if convergence_rule is None:
+        return None
+    return convergence_rule(name if convergence_scope is None else (convergence_scope, name))
+
+# Every model function has the attribute topics, the number of topics of its topic-word
+# matrices (a dict for the atopics and dtopics of DADT), and may have processes and
+# test_processes, the sizes of the process pools it runs. main.py sizes its tasks with them.
+
+def model_topics(model):
+    topics = getattr(model, "topics", 0)
+    return sum(topics.values()) if isinstance(topics, dict) else topics
+
+def model_cores(model):
+    """
+    The most processes model runs at once.
+    """
+    return max(getattr(model, "processes", 1), getattr(model, "test_processes", 1))
+
+def concatenate_fic_authors(theta, doc_authors, num_topics):
     num_training_docs = len(doc_authors)
     training_matrix = np.zeros((num_training_docs, num_topics * 2))
-    for doc, doc_author_two in doc_authors.items():
+    for doc, doc_author_two in enumerate(doc_authors):
         vector = np.concatenate(theta[doc_author_two])
         training_matrix[doc] = vector
 
@@ -33,14 +84,25 @@ def add_fic_authors(doc_authors, n_authors):
 
     return(doc_authors_new, next_fa)
 
+def svm_rows(matrix):
+    """
+    Rows of a sparse matrix as liblinear feature dicts, column j is feature j + 1 as in a list row.
+    """
+    matrix = sparse.csr_matrix(matrix)
+    return [dict(zip((matrix.indices[start:end] + 1).tolist(), matrix.data[start:end].tolist())) for start, end in zip(matrix.indptr[:-1], matrix.indptr[1:])]
+
+def normalize_rows(matrix):
+    matrix = sparse.csr_matrix(matrix, dtype=float)
+    return sparse.csr_matrix(sparse.diags(1 / np.asarray(matrix.sum(axis=1)).ravel()) @ matrix)
+
 def TOKEN_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     n_docs = matrix.shape[0]
     n_test_docs = test_matrix.shape[0]
-    matrix = matrix / np.sum(matrix, 1)[:,None]
-    test_matrix = test_matrix / np.sum(test_matrix, 1)[:,None]
+    matrix = normalize_rows(matrix)
+    test_matrix = normalize_rows(test_matrix)
 
-    svm_model = ll.train(sum(doc_authors, []), matrix.tolist(), '-c 4')
-    p_label, p_acc, p_val = ll.predict(np.random.rand(n_test_docs), test_matrix.tolist(), svm_model)
+    svm_model = ll.train(sum(doc_authors, []), svm_rows(matrix), '-c 4')
+    p_label, p_acc, p_val = ll.predict(np.random.rand(n_test_docs), svm_rows(test_matrix), svm_model)
 
     author_probs = np.zeros((n_test_docs, n_authors))
     for doc, author in enumerate(p_label):
@@ -48,9 +110,11 @@ def TOKEN_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
 
     return author_probs
 
+TOKEN_SVM.topics = 0
+
 def LDA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 20
+    num_topics = LDA_SVM.topics
     burn_in = 1000  # 0
     alpha = 0.1
     beta = 0.1
@@ -62,7 +126,7 @@ def LDA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     sampler = lda.LDA(num_topics, alpha, beta)
 
     print('Starting!')
-    theta, phi, likelihood = sampler.train(matrix, burn_in, samples, spacing)
+    theta, phi, likelihood = sampler.train(matrix, burn_in, samples, spacing, convergence=burn_in_rule("LDA_SVM"))
     print('likelihood: ', likelihood)
 
     theta_test, likelihood = sampler.classify(test_matrix, phi, burn_in, samples, spacing)
@@ -74,16 +138,18 @@ def LDA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
 
     svm_model = ll.train(sum(doc_authors, []), theta.tolist(), '-c 4')
     p_label, p_acc, p_val = ll.predict(np.random.rand(num_test_docs), theta_test.tolist(), svm_model)
-    author_probs = np.zeros((n_test_docs, n_authors))
+    author_probs = np.zeros((num_test_docs, n_authors))
     for doc, author in enumerate(p_label):
         author_probs[doc,int(author)] = 1
 
     return author_probs
 
+LDA_SVM.topics = 20
+
 
 def AT_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 4
+    num_topics = AT_SVM.topics
     burn_in = 1000  # 0
     alpha = 0.1
     beta = 0.1
@@ -95,31 +161,31 @@ def AT_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     sampler = at.AtSampler(num_topics, n_authors, alpha, beta)
 
     print('Starting!')
-    theta, phi, likelihood = sampler.train(doc_authors, matrix, burn_in, samples, spacing)
+    theta, phi = sampler.train(doc_authors, matrix, burn_in, samples, spacing, convergence=burn_in_rule("AT_SVM"))
     print('theta: ', theta.shape)
     print('phi: ', phi.shape)
-    print('likelihood: ', likelihood)
 
     sampler.n_authors = num_test_docs
 
     theta_test = sampler.classify(test_matrix, phi, burn_in, samples, spacing)
     print('theta test: ', theta_test.shape)
-    print('likelihood: ', likelihood)
 
     theta = theta / np.sum(theta, 1)[:,None]
     theta_test = theta_test / np.sum(theta_test, 1)[:,None]
 
-    svm_model = ll.train([0,1], theta.tolist(), '-c 4')
+    svm_model = ll.train(list(range(n_authors)), theta.tolist(), '-c 4')
     p_label, p_acc, p_val = ll.predict(np.random.rand(num_test_docs), theta_test.tolist(), svm_model)
-    author_probs = np.zeros((n_test_docs, n_authors))
+    author_probs = np.zeros((num_test_docs, n_authors))
     for doc, author in enumerate(p_label):
         author_probs[doc,int(author)] = 1
 
     return author_probs
 
+AT_SVM.topics = 4
+
 def AT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 400
+    num_topics = AT_P.topics
     burn_in = 1000
     alpha = 0.1
     beta = 0.1
@@ -129,7 +195,7 @@ def AT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     sampler = at.AtSampler(num_topics, n_authors, alpha, beta)
 
     print('Starting!')
-    theta, phi = sampler.train(doc_authors, matrix, burn_in, samples, spacing)
+    theta, phi = sampler.train(doc_authors, matrix, burn_in, samples, spacing, convergence=burn_in_rule("AT_P"))
     print('theta: ', theta.shape)
     print('phi: ', phi.shape)
 
@@ -137,9 +203,11 @@ def AT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
 
     return author_probs
 
+AT_P.topics = 400
+
 def AT_FA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 4
+    num_topics = AT_FA_SVM.topics
     burn_in = 1000  # 0
     alpha = 0.1
     beta = 0.1
@@ -153,17 +221,16 @@ def AT_FA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     sampler = at.AtSampler(num_topics, n_authors_new, alpha, beta)
 
     print('Starting!')
-    theta, phi, likelihood = sampler.train(doc_authors_new, matrix, burn_in, samples, spacing)
+    theta, phi = sampler.train(doc_authors_new, matrix, burn_in, samples, spacing, convergence=burn_in_rule("AT_FA_SVM"))
     print('theta:', theta.shape)
     print('phi:', phi.shape)
-    print('likelihood:', likelihood)
 
     sampler.n_authors = num_test_docs
 
     theta_test = sampler.classify(test_matrix, phi, burn_in, samples, spacing)
     print('theta test:', theta_test.shape)
 
-    training_matrix = concatenate_fic_authors(doc_authors, num_topics)
+    training_matrix = concatenate_fic_authors(theta, doc_authors_new, num_topics)
 
     num_test_docs = test_matrix.shape[0]
     test_matrix = np.concatenate((theta_test, theta_test), axis=1)
@@ -174,15 +241,17 @@ def AT_FA_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     svm_model = ll.train(sum(doc_authors, []), training_matrix.tolist(), '-c 4')
     p_label, p_acc, p_val = ll.predict(np.random.rand(num_test_docs), test_matrix.tolist(), svm_model)
 
-    author_probs = np.zeros((n_test_docs, n_authors))
+    author_probs = np.zeros((num_test_docs, n_authors))
     for doc, author in enumerate(p_label):
         author_probs[doc,int(author)] = 1
 
     return author_probs
 
+AT_FA_SVM.topics = 4
+
 def AT_FA_P1(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 4
+    num_topics = AT_FA_P1.topics
     burn_in = 1000 # 0
     alpha = 0.1
     beta = 0.1
@@ -194,7 +263,7 @@ def AT_FA_P1(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     sampler = at.AtSampler(num_topics, n_authors_new, alpha, beta)
 
     print('Starting!')
-    theta, phi= sampler.train(doc_authors_new, matrix, burn_in, samples, spacing)
+    theta, phi= sampler.train(doc_authors_new, matrix, burn_in, samples, spacing, convergence=burn_in_rule("AT_FA_P1"))
     print('theta: ', theta)
     print('phi: ', phi)
 
@@ -204,35 +273,40 @@ def AT_FA_P1(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
 
     return(author_probs)
 
+AT_FA_P1.topics = 4
+
 def AT_FA_P2(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_topics = 4
+    num_topics = AT_FA_P2.topics
     burn_in = 1000  # 0
     alpha = 0.1
     beta = 0.1
     samples = 8
     spacing = 100
+    processes = AT_FA_P2.processes  # candidate batches
 
     doc_authors_new, n_authors_new = add_fic_authors(doc_authors, n_authors)
 
     sampler = at.AtSampler(num_topics, n_authors_new, alpha, beta)
 
     print('Starting!')
-    theta, phi, likelihood = sampler.train(doc_authors_new, matrix, burn_in, samples, spacing)
+    theta, phi = sampler.train(doc_authors_new, matrix, burn_in, samples, spacing, convergence=burn_in_rule("AT_FA_P2"))
     print('theta: ', theta)
     print('phi: ', phi)
-    print('likelihood: ', likelihood)
 
     sampler.n_authors = n_authors
 
-    authors = sampler.at_fa_p2(phi, theta, test_matrix, samples, burn_in, spacing)
+    author_probs = sampler.at_fa_p2(phi, theta, test_matrix, samples, burn_in, spacing, processes=processes)
 
     return(author_probs)
 
+AT_FA_P2.topics = 4
+AT_FA_P2.processes = 1
+
 def DADT_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_atopics = 15
-    num_dtopics = 5
+    num_atopics = DADT_SVM.topics[a]
+    num_dtopics = DADT_SVM.topics[d]
     burn_in = 1000  # 1000
     alpha_a = min(0.1, 5/num_atopics)
     alpha_d = min(0.1, 5/num_dtopics)
@@ -275,17 +349,19 @@ def DADT_SVM(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     svm_model = ll.train(sum(doc_authors, []), training_matrix.tolist(), '-c 4')
     p_label, p_acc, p_val = ll.predict(np.random.rand(num_test_docs), svm_test_matrix.tolist(), svm_model)
 
-    author_probs = np.zeros((n_test_docs, n_authors))
+    author_probs = np.zeros((num_test_docs, n_authors))
     for doc, author in enumerate(p_label):
         author_probs[doc,int(author)] = 1
 
     return author_probs
 
+DADT_SVM.topics = {a: 15, d: 5}
+
 
 def DADT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     # set parameters
-    num_dtopics = 50
-    num_atopics = 350
+    num_dtopics = DADT_P.topics[d]
+    num_atopics = DADT_P.topics[a]
     burn_in = 1000
     alpha_a = min(0.1, 5/num_atopics)
     alpha_d = min(0.1, 5/num_dtopics)
@@ -298,6 +374,14 @@ def DADT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     test_samples = 10
     test_burn_in = 10
     test_spacing = 1
+    sampler = "gibbs"  # one of dadt.samplers
+    processes = DADT_P.processes
+    sync_interval = 1
+    # file name prefix the training state is saved to and resumed from, every chain and fold has its own
+    # file (checkpoint_path). The "sparse" and "alias" samplers give other results with a checkpoint than without.
+    checkpoint = None
+    checkpoint_interval = 10
+    test_processes = DADT_P.test_processes
 
     beta_a = np.array([0.01 + epsilon if word in stopwords else 0.01 for word in vocab])
     beta_d = np.array([0.01 - epsilon if word in stopwords else 0.01 for word in vocab])
@@ -307,15 +391,26 @@ def DADT_P(matrix, test_matrix, n_authors, doc_authors, vocab, stopwords):
     delta = {a: alpha_a, d: alpha_d}
     num_topics = {a: num_atopics, d: num_dtopics}
 
+    corpus = Corpus(matrix)
+    test_corpus = Corpus(test_matrix)
+
+    if checkpoint is not None:
+        checkpoint = checkpoint_path(checkpoint, corpus, doc_authors)
+
     print('Starting!')
-    (theta_sampled, phi_sampled, pi_sampled, chi_sampled) = dadt.train(matrix, vocab, doc_authors, num_topics, n_authors, alpha, beta, delta, eta, burn_in, samples, spacing)
+    (theta_sampled, phi_sampled, pi_sampled, chi_sampled) = dadt.train(corpus, vocab, doc_authors, num_topics, n_authors, alpha, beta, delta, eta, burn_in, samples, spacing, sampler=sampler, processes=processes, sync_interval=sync_interval,
+                                                                     checkpoint=checkpoint, checkpoint_interval=checkpoint_interval, convergence=burn_in_rule("DADT_P"))
 
     print("Classifying")
 
-    (theta_test, pi_test) = dadt.classify(test_matrix, test_burn_in, test_samples, test_spacing, num_topics, alpha, beta, delta, eta, phi_sampled)
+    (theta_test, pi_test) = dadt.classify(test_corpus, test_burn_in, test_samples, test_spacing, num_topics, alpha, beta, delta, eta, phi_sampled, processes=test_processes)
 
     print("Deciding")
 
-    author_probs = dadt.dadt_p(test_matrix, n_authors, theta_sampled, phi_sampled, pi_test, chi_sampled)
+    author_probs = dadt.dadt_p(test_corpus, n_authors, theta_sampled, phi_sampled, pi_test, chi_sampled)
 
     return(author_probs)
+
+DADT_P.topics = {a: 350, d: 50}
+DADT_P.processes = 1  # training shards, merged every sync_interval sweeps
+DADT_P.test_processes = 1
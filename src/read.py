@@ -5,10 +5,20 @@ from unidecode import unidecode
 import optparse
 import os.path
 import subprocess
+import threading
 from multiprocessing import Pool
 import json
+import hashlib
 from itertools import repeat
 
+OPENNLP_DIR = "../opennlp-tools-1.4.3"
+SENTENCE_MODEL = "../opennlp-models/EnglishSD.bin.gz"
+TOKEN_MODEL = "../opennlp-models/EnglishTok.bin.gz"
+
+# paragraph sent after every text, the tools pass it through unchanged and the output of the text ends with it.
+# The sentence detector holds back a paragraph until the empty line after it, so the marker is followed by one.
+END_OF_TEXT = "xxendoftextxx"
+
 class OpenNLP():
     def __init__(self, tool, opennlp_dir, path_model):
         jars = subprocess.check_output(['bash', '-c' , 'echo ' + opennlp_dir + '/lib/*.jar ' + opennlp_dir + "/output/*.jar | tr ' ' ':'"]).decode(encoding="utf-8").strip()
@@ -16,23 +26,79 @@ class OpenNLP():
         java = subprocess.check_output(['bash', '-c', 'echo $JAVA_HOME']).decode(encoding="utf-8").strip() + "/bin/java"
 
         self.command = [java,"-Xmx1000m","-classpath",cp,"-Dopennlp.dir=" + opennlp_dir, tool, path_model]
+        self.available = os.access(java, os.X_OK) and os.path.isdir(opennlp_dir) and os.path.isfile(path_model)
 
-
-
-        # spawn the process
+        # the process is spawned by the first parse and kept for the following ones
+        self.process = None
 
     def parse(self, text):
-        self.process = subprocess.Popen(self.command, stdout = subprocess.PIPE, stdin = subprocess.PIPE, stderr = subprocess.PIPE)
-        response = self.process.communicate(input=((text).encode()))
-        self.process.wait()
-        # print(response)
-        sentences = response[0].decode().strip().split('\n')
+        """
+        The output lines of the tool for text, without empty lines.
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(self.command, stdout = subprocess.PIPE, stdin = subprocess.PIPE, stderr = subprocess.DEVNULL)
+
+        # written from a thread, a long text would fill the pipes when written before reading
+        writer = threading.Thread(target=self.write, args=((text + "\n\n" + END_OF_TEXT + "\n\n").encode(),))
+        writer.start()
+        sentences = []
+        while True:
+            line = self.process.stdout.readline()
+            if not line:
+                writer.join()
+                raise RuntimeError(self.command[-2] + " exited")
+            line = line.decode().strip()
+            if line.endswith(END_OF_TEXT):
+                line = line[:-len(END_OF_TEXT)].strip()
+                if line:
+                    sentences.append(line)
+                break
+            if line:
+                sentences.append(line)
+        writer.join()
 
         return sentences
 
+    def write(self, data):
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+
+sentence_end = re.compile(r'(?<=[.!?])\s+')
+token_regex = re.compile(r"\w+(?=n't\b)|n't\b|'\w+|\w+|[^\w\s]")
+
+def split_sentences(text):
+    """
+    Python fallback of the OpenNLP sentence detector, a sentence ends with . ! or ? before whitespace.
+    """
+    return [sentence for sentence in sentence_end.split(text.replace("\n", " ")) if sentence.strip()]
+
+def tokenize(text):
+    """
+    Python fallback of the OpenNLP tokenizer, a line of space separated tokens per line of text.
+    Punctuation is a token of its own and contractions are split as do n't and it 's.
+    """
+    return [' '.join(token_regex.findall(line)) for line in text.split("\n") if line.strip()]
+
+# the sentence detector and tokenizer of every worker process, by process id
+tools = {}
+
+def nlp_tools():
+    """
+    (split_sentences, tokenize) of this process. The OpenNLP processes are started once per worker
+    and reused for every document, without Java or OpenNLP the Python fallbacks are used.
+    """
+    if os.getpid() not in tools:
+        sent_parser = OpenNLP("opennlp.tools.lang.english.SentenceDetector", OPENNLP_DIR, SENTENCE_MODEL)
+        token_parser = OpenNLP("opennlp.tools.lang.english.Tokenizer", OPENNLP_DIR, TOKEN_MODEL)
+        if sent_parser.available and token_parser.available:
+            tools[os.getpid()] = (sent_parser.parse, token_parser.parse)
+        else:
+            print("OpenNLP not found, using the Python tokenizer")
+            tools[os.getpid()] = (split_sentences, tokenize)
+    return tools[os.getpid()]
+
 def preprocess(content):
-    sent_parser = OpenNLP("opennlp.tools.lang.english.SentenceDetector", "../opennlp-tools-1.4.3", "../opennlp-models/EnglishSD.bin.gz")
-    token_parser = OpenNLP("opennlp.tools.lang.english.Tokenizer", "../opennlp-tools-1.4.3", "../opennlp-models/EnglishTok.bin.gz")
+    sent_parser, token_parser = nlp_tools()
 
     content = unidecode(content)
     content = content.strip()
@@ -50,12 +116,11 @@ def preprocess(content):
 
     content = re.sub(urlregex, '', content)
     content = content + urls
-    content = sent_parser.parse(content)
+    content = sent_parser(content)
+    # one line per sentence, tokenized in a single call
     final_content = ""
-    for sentence in content:
-        sentence = sentence.lower()
-        sentence = token_parser.parse(sentence)
-        final_content += sentence[0]
+    for sentence in token_parser("\n".join(sentence.lower() for sentence in content)):
+        final_content += sentence
         final_content += " "
 
     return final_content
@@ -66,6 +131,7 @@ def map_function(filename):
     print(author_name)
 
     next_doc_id = 0
+    outputs = []
 
     f = open(filename, 'r', encoding='iso-8859-1')
     contents = f.read()
@@ -79,45 +145,165 @@ def map_function(filename):
 
         post = preprocess(post)
 
-
-        outfile = open(destination_path + '/' + author_name + "-" + str(next_doc_id) + '.txt', 'w')
-        outfile.write(post)
-        outfile.close()
+        outputs.append(destination_path + '/' + author_name + "-" + str(next_doc_id) + '.txt')
+        write_atomic(outputs[-1], post)
 
         next_doc_id += 1
 
     f.close()
+    return outputs
+
+# bump when preprocess changes, the manifest then reprocesses every source
+PREPROCESS_VERSION = 1
+# sources finished between two saves of the manifest
+MANIFEST_BATCH = 100
+
+def preprocess_parameters():
+    tokenizer = "opennlp" if all(OpenNLP(tool, OPENNLP_DIR, model).available for tool, model in
+                                 (("opennlp.tools.lang.english.SentenceDetector", SENTENCE_MODEL), ("opennlp.tools.lang.english.Tokenizer", TOKEN_MODEL))) else "python"
+    return {"version": PREPROCESS_VERSION, "tokenizer": tokenizer, "opennlp": OPENNLP_DIR, "models": [SENTENCE_MODEL, TOKEN_MODEL]}
+
+def write_atomic(path, text):
+    # hidden, so a file left by an interrupted run does not look like a document
+    temporary = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    with open(temporary, 'w') as outfile:
+        outfile.write(text)
+    os.replace(temporary, path)
+
+def source_digest(source, task):
+    """
+    sha1 of the content of the file source and the arguments of its task.
+    """
+    digest = hashlib.sha1(repr(task).encode())
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def source_stat(source):
+    stat = os.stat(source)
+    return [stat.st_size, stat.st_mtime_ns]
+
+class Manifest():
+    def __init__(self, path, parameters):
+        """
+        Digest, size and mtime of every preprocessed source file, the function that processed it
+        and the files written for it, saved as JSON to path.
+        The entries of a manifest saved with other parameters are dropped.
+        """
+        self.path = path
+        self.parameters = parameters
+        self.entries = {}
+        self.pending = 0
+        if os.path.isfile(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved["parameters"] == parameters:
+                self.entries = saved["entries"]
+
+    def unchanged(self, source, function, task, stat):
+        """
+        Whether the files of source are up to date. Like make, a source with the size and mtime
+        of the manifest is taken as unchanged without reading it, otherwise its digest decides.
+        """
+        entry = self.entries.get(source)
+        if entry is None or not all(os.path.isfile(output) for output in entry["outputs"]):
+            return False
+        if entry.get("stat") == stat and entry.get("task") == repr(task):
+            return True
+        if entry["digest"] != source_digest(source, task):
+            return False
+        # only touched, the next run takes the fast path
+        entry.update(stat=stat, task=repr(task), function=function)
+        self.pending += 1
+        return True
+
+    def update(self, source, function, task, stat, digest, outputs):
+        # files of the previous version of source that were not written again
+        if source in self.entries:
+            self.remove(set(self.entries[source]["outputs"]) - set(outputs))
+        self.entries[source] = {"digest": digest, "stat": stat, "task": repr(task), "function": function, "outputs": outputs}
+        self.pending += 1
+        if self.pending >= MANIFEST_BATCH:
+            self.save()
+
+    def prune(self, function, sources):
+        """
+        Drop the entries of function whose source is not in sources any more, e.g. deleted
+        source files, and remove the files written for them.
+        """
+        sources = set(sources)
+        stale = [source for source, entry in self.entries.items() if entry.get("function") == function and source not in sources]
+        if stale:
+            print("removing the files of", len(stale), "sources that are gone")
+            outputs = set(output for source in stale for output in self.entries.pop(source)["outputs"])
+            # written again for another source
+            self.remove(outputs - set(output for entry in self.entries.values() for output in entry["outputs"]))
+            self.pending += len(stale)
+
+    def remove(self, outputs):
+        for output in outputs:
+            if os.path.isfile(output):
+                os.remove(output)
+
+    def save(self):
+        write_atomic(self.path, json.dumps({"parameters": self.parameters, "entries": self.entries}))
+        self.pending = 0
+
+def run_indexed(arguments):
+    # the digest is taken before the source is processed, so a later change is seen by the next run
+    function, i, task, source = arguments
+    digest = source_digest(source, task)
+    return (i, digest, function(*task))
+
+def run_incremental(function, tasks, sources):
+    """
+    function(*task) for every task in a process pool, sources[i] is the file task i reads and
+    function returns the files it writes. Tasks whose source and arguments are unchanged since
+    the last run are skipped, and the files of sources of function that are no longer in sources
+    are removed. The manifest is saved next to destination_path.
+    """
+    manifest = Manifest(destination_path.rstrip('/') + '.manifest.json', preprocess_parameters())
+    name = function.__name__
+    manifest.prune(name, sources)
+    stats = [source_stat(source) for source in sources]
+    changed = [i for i, (source, task, stat) in enumerate(zip(sources, tasks, stats)) if not manifest.unchanged(source, name, task, stat)]
+    print(len(tasks) - len(changed), "of", len(tasks), "sources unchanged")
+    try:
+        with Pool(32) as p:
+            for i, digest, outputs in p.imap_unordered(run_indexed, [(function, i, tasks[i], sources[i]) for i in changed]):
+                manifest.update(sources[i], name, tasks[i], stats[i], digest, outputs)
+    finally:
+        manifest.save()
 
 def readblogs(source_path):
     filenames = [source_path + file for file in os.listdir(source_path)]
-    with Pool(32) as p:
-        p.map(map_function, filenames)
+    run_incremental(map_function, [(filename,) for filename in filenames], filenames)
 
 def readjudgment(source_path):
     filenames = [source_path + file for file in os.listdir(source_path)]
-    with Pool(32) as p:
-        p.map(map_judgment, filenames)
+    run_incremental(map_judgment, [(filename,) for filename in filenames], filenames)
 
 def map_judgment(filename):
     quotes = re.compile(r'\".*?\"')
     numbers = re.compile(r'\d+')
-    fileregex = re.compile(r'(\w+)(\d+)')
+    fileregex = re.compile(r'(\D+)(\d+).*')
 
     f = open(filename, 'r')
     contents = f.read()
+    f.close()
     contents = re.sub(quotes, "", contents)
     contents = re.sub(numbers, "", contents)
     contents = preprocess(contents)
-    new_filename = re.sub(fileregex, '\1\-\2\.txt', filename)
-    outfile = open(destination_path + new_filename, 'w')
-    outfile.write(content)
-    outfile.close()
+    new_filename = re.sub(fileregex, r'\1-\2.txt', os.path.basename(filename))
+    write_atomic(destination_path + new_filename, contents)
     print(new_filename)
+    return [destination_path + new_filename]
 
 def readpan11(source_path):
-    filenames = os.listdir(source_path+'training/')
-    with Pool(32) as p:
-        p.starmap(map_pan11_train, zip(list(filenames), repeat(source_path+'training/')))
+    source = source_path + 'training/'
+    tasks = [(author, filename, source) for author in os.listdir(source) for filename in os.listdir(source + author)]
+    run_incremental(map_pan11_train, tasks, [source + author + "/" + filename for author, filename, source in tasks])
 
     ground_file = open(source_path + 'ground-truth.json','r')
     ground_string = ground_file.read()
@@ -125,8 +311,7 @@ def readpan11(source_path):
     ground_json = json.loads(ground_string)
     ground_dict = ground_json['ground-truth']
 
-    with Pool(32) as p:
-        p.starmap(map_pan11_test, zip(ground_dict, repeat(source_path)))
+    run_incremental(map_pan11_test, [(info, source_path) for info in ground_dict], [source_path + "unknown/" + info["unknown-text"] for info in ground_dict])
 
 def map_pan11_test(info, source_path):
     numbers_regex = r'\d+'
@@ -140,28 +325,28 @@ def map_pan11_test(info, source_path):
     contents = preprocess(contents)
     print("true author", candidate_number)
     print("unknown text", file_number)
-    outfile = open(destination_path + 'test/' + candidate_number + '-' + file_number + '.txt', 'w')
-    outfile.write(contents)
-    outfile.close()
+    output = destination_path + 'test/' + candidate_number + '-' + file_number + '.txt'
+    write_atomic(output, contents)
+    return [output]
 
-def map_pan11_train(author, source):
+def map_pan11_train(author, filename, source):
     numbers_regex = r'\d+'
-    filenames = os.listdir(source+author)
     candidate_number = re.search(numbers_regex, author).group()
-    for filename in filenames:
-        file_number = re.search(numbers_regex, filename).group()
-        print("BEGIN" , author + "/" + filename)
-        f = open(source + author + "/" + filename, 'r')
-        contents = f.read()
-        contents = preprocess(contents)
-        outfile = open(destination_path + 'train/' + candidate_number + '-' + file_number + '.txt', 'w')
-        outfile.write(contents)
-        outfile.close()
-        print("END" , author + "/" + filename)
+    file_number = re.search(numbers_regex, filename).group()
+    print("BEGIN" , author + "/" + filename)
+    f = open(source + author + "/" + filename, 'r')
+    contents = f.read()
+    f.close()
+    contents = preprocess(contents)
+    output = destination_path + 'train/' + candidate_number + '-' + file_number + '.txt'
+    write_atomic(output, contents)
+    print("END" , author + "/" + filename)
+    return [output]
 
 # destination_path = '../data/judgmentprocessed'
 destination_path = '../data/pan11processed_new/'
-# readblogs('../data/blogs/')
-# readjudgment('../data/Judgment/used/')
-# readpan11('../data/c10/')
-readpan11('../data/pan11/')
+if __name__ == "__main__":
+    # readblogs('../data/blogs/')
+    # readjudgment('../data/Judgment/used/')
+    # readpan11('../data/c10/')
+    readpan11('../data/pan11/')
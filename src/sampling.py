@@ -0,0 +1,58 @@
+import numpy as np
+
+class Uniforms(object):
+    def __init__(self, block_size=65536):
+        """
+        Uniform random numbers in [0, 1), generated by np.random in blocks
+        of block_size so a single draw does not pay for a numpy call.
+        """
+        self.block_size = block_size
+        self.reset()
+
+    def reset(self):
+        """
+        Drop the buffered numbers, the next block is drawn from the current np.random state.
+        """
+        self.block = []
+        self.position = 0
+
+    def next(self):
+        if self.position >= len(self.block):
+            self.block = np.random.random(self.block_size).tolist()
+            self.position = 0
+        self.position += 1
+        return self.block[self.position - 1]
+
+uniforms = Uniforms()
+
+def reseed(seed):
+    """
+    Seed np.random and drop the buffered uniforms. Forked workers inherit the random state
+    of the parent, so every task of a worker process starts with reseed and a seed of its own.
+    """
+    np.random.seed(seed)
+    uniforms.reset()
+
+def random():
+    return uniforms.next()
+
+def draw(weights, u):
+    """
+    Index of the entry of weights in which u falls, u is between 0 and sum(weights).
+    """
+    return min(int(np.cumsum(weights).searchsorted(u, side='right')), len(weights) - 1)
+
+def sample_index(weights):
+    """
+    Index sampled with probability proportional to weights, weights do not have to be normalised.
+    """
+    cumulative = np.cumsum(weights)
+    return min(int(cumulative.searchsorted(uniforms.next() * cumulative[-1], side='right')), len(weights) - 1)
+
+def sample_rows(weights):
+    """
+    Index sampled from every row of weights with probability proportional to the row.
+    """
+    cumulative = np.cumsum(weights, axis=1)
+    u = np.random.random(len(weights)) * cumulative[:, -1]
+    return np.minimum(np.sum(cumulative <= u[:, np.newaxis], axis=1), weights.shape[1] - 1)
@@ -0,0 +1,100 @@
+import traceback
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+import numpy as np
+import sampling
+import shared
+
+def available_memory():
+    """
+    Memory in bytes available for new processes without swapping (MemAvailable, which counts
+    reclaimable page cache), None where the system does not report it.
+    """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def seeded(function, seed, arguments):
+    sampling.reseed(seed)
+    return function(*arguments)
+
+def run_task(sender, function, seed, arguments):
+    """
+    The body of a worker process, sends (result, None) or (None, error) to the scheduler.
+    """
+    try:
+        message = (seeded(function, seed, arguments), None)
+    except Exception as error:
+        traceback.print_exc()
+        message = (None, error)
+    try:
+        sender.send(message)
+    except Exception:  # a result or error that can not be pickled
+        sender.send((None, RuntimeError(traceback.format_exc())))
+    sender.close()
+
+class Scheduler(object):
+    def __init__(self, workers, memory_limit=None, memory_fraction=0.8):
+        """
+        Runs tasks in worker processes on workers cores. Tasks start in the order they are given,
+        each once its cores are free and its memory estimate fits next to the estimates of the
+        running tasks within memory_limit bytes, by default memory_fraction of the memory available
+        when run starts. A task that does not fit on its own still starts when nothing else runs.
+
+        Every task has a process of its own, which is not daemonic, so a task may run a process pool
+        of up to its number of cores (e.g. dadt.train with processes > 1).
+        """
+        self.workers = workers
+        self.memory_limit = memory_limit
+        self.memory_fraction = memory_fraction
+
+    def run(self, tasks):
+        """
+        tasks: a list of (function, arguments, cores, memory), cores the processes function(*arguments)
+               runs at once and memory the estimated bytes it uses.
+        Yields (index, result) in the order the tasks complete. Every task gets its own np.random seed.
+        """
+        memory_limit = self.memory_limit
+        if memory_limit is None:
+            available = available_memory()
+            memory_limit = np.inf if available is None else self.memory_fraction * available
+        seeds = np.random.randint(2**31 - 1, size=len(tasks))
+        running = {}  # receiver -> (index, process, cores, memory)
+        next_task = 0
+
+        try:
+            while next_task < len(tasks) or running:
+                while next_task < len(tasks):
+                    function, arguments, cores, memory = tasks[next_task]
+                    if running and (sum(task[2] for task in running.values()) + cores > self.workers or
+                                    sum(task[3] for task in running.values()) + memory > memory_limit):
+                        break
+                    receiver, sender = Pipe(duplex=False)
+                    process = shared.process(run_task, (sender, function, seeds[next_task], arguments))
+                    process.start()
+                    sender.close()  # the receiver sees the end of the pipe if the worker dies
+                    running[receiver] = (next_task, process, cores, memory)
+                    next_task += 1
+
+                for receiver in wait(list(running)):
+                    i, process, _, _ = running.pop(receiver)
+                    try:
+                        result, error = receiver.recv()
+                    except EOFError:
+                        process.join()
+                        raise RuntimeError("task %d exited with code %s" % (i, process.exitcode))
+                    receiver.close()
+                    process.join()
+                    if error is not None:
+                        raise error
+                    yield (i, result)
+        finally:
+            for receiver, (_, process, _, _) in running.items():
+                process.terminate()
+                process.join()
+                receiver.close()
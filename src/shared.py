@@ -0,0 +1,82 @@
+import contextlib
+import numpy as np
+from scipy import sparse
+from multiprocessing import Pool, Process, shared_memory, resource_tracker
+
+class SharedArrays(object):
+    def __init__(self, arrays):
+        """
+        Copies of numpy arrays in shared memory, so process pool workers can read them
+        without pickling. arrays is a dict, use as a context manager in the parent process
+        and pass descriptors to the workers, which read the arrays with attached.
+        A scipy sparse matrix is shared as the data, indices and indptr arrays of its CSR form.
+        """
+        self.blocks = []
+        self.descriptors = {}
+        for key, array in arrays.items():
+            if sparse.issparse(array):
+                array = sparse.csr_matrix(array)
+                self.descriptors[key] = ("csr", array.shape, [self.share(part) for part in (array.data, array.indices, array.indptr)])
+            else:
+                self.descriptors[key] = self.share(array)
+
+    def share(self, array):
+        array = np.ascontiguousarray(array)
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+        self.blocks.append(block)
+        return (block.name, array.shape, array.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+@contextlib.contextmanager
+def attached(descriptors):
+    """
+    Read-only views of the arrays of SharedArrays.descriptors, as a dict.
+    The views must not be used after the with block.
+    """
+    blocks = []
+    arrays = {}
+
+    def attach(name, shape, dtype):
+        block = shared_memory.SharedMemory(name=name)
+        blocks.append(block)
+        array = np.ndarray(shape, dtype, buffer=block.buf)
+        array.flags.writeable = False
+        return array
+
+    try:
+        for key, descriptor in descriptors.items():
+            if descriptor[0] == "csr":
+                _, shape, parts = descriptor
+                arrays[key] = sparse.csr_matrix(tuple(attach(*part) for part in parts), shape=shape, copy=False)
+            else:
+                arrays[key] = attach(*descriptor)
+        yield arrays
+    finally:
+        arrays.clear()
+        for block in blocks:
+            block.close()
+
+def pool(processes):
+    """
+    Process pool for workers that attach to SharedArrays. The resource tracker is started
+    first, so the workers share it with the parent instead of each starting their own,
+    which would report the blocks as leaked when the workers exit.
+    """
+    resource_tracker.ensure_running()
+    return Pool(processes)
+
+def process(target, args):
+    """
+    Process for a worker that attaches to SharedArrays, the resource tracker is started first as
+    for pool. Unlike the workers of a pool it is not daemonic, so it can run a pool of its own.
+    """
+    resource_tracker.ensure_running()
+    return Process(target=target, args=args)
@@ -0,0 +1,228 @@
+"""
+Checks of the compiled kernels against the numpy samplers, run with python3 -m pytest test_kernels.py
+
+For every kernel: the same assignments as the numpy code given the same uniform random numbers,
+counts that match a recount of the assignments after the sweeps, and draws that follow the
+conditional of the numpy code.
+"""
+import numpy as np
+import pytest
+from corpus import Corpus
+from benchmark import synthetic_corpus, dadt_parameters
+import kernels
+import sampling
+import dadt
+import at
+import lda
+
+a = "a"
+d = "d"
+
+pytestmark = pytest.mark.skipif(not kernels.available, reason="numba is not installed")
+
+n_docs, vocab_size, doc_length, n_authors = 12, 40, 20, 4
+matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+# some documents with two authors
+doc_authors = [authors + [(authors[0] + 1) % n_authors] if doc % 3 == 0 else authors for doc, authors in enumerate(doc_authors)]
+corpus = Corpus(matrix)
+n_topics, alpha, beta, delta = dadt_parameters(vocab_size, 3, 5)
+sweeps = 3
+# the numpy code takes the uniforms of all sweeps from one block, the kernels one array per sweep
+assert corpus.n_tokens * sweeps <= sampling.uniforms.block_size
+draws = 20000
+
+@pytest.fixture(autouse=True)
+def restore_kernels():
+    yield
+    kernels.enabled = kernels.available
+
+def captured_weights(monkeypatch, module, run):
+    """
+    The normalised weights of the first draw of run(), which draws with module.sample_index.
+    """
+    weights = []
+    sample_index = module.sample_index
+    def capture(distribution):
+        weights.append(np.array(distribution, dtype=float))
+        return sample_index(distribution)
+    monkeypatch.setattr(module, "sample_index", capture)
+    run()
+    monkeypatch.undo()
+    return weights[0] / np.sum(weights[0])
+
+def assert_same_distribution(indices, probabilities):
+    frequencies = np.bincount(indices, minlength=len(probabilities)) / len(indices)
+    assert len(frequencies) == len(probabilities)
+    assert 0.5 * np.sum(np.abs(frequencies - probabilities)) < 0.03
+
+def dadt_state():
+    np.random.seed(0)
+    is_atopic, topic, author = dadt.initialize(corpus, doc_authors, n_topics, delta)
+    counts = dadt.count(corpus, is_atopic, topic, author, n_topics, n_authors)
+    return [is_atopic, topic, author], counts, dadt.count_topic_word(corpus, is_atopic, topic, n_topics)
+
+def dadt_sweeps(enabled, seed, n_sweeps=sweeps):
+    state, counts, cooccurrence_topic_word = dadt_state()
+    np.random.seed(seed)
+    sampling.uniforms.reset()
+    kernels.enabled = enabled
+    for it in range(n_sweeps):
+        dadt.sweep(it, corpus, doc_authors, n_topics, alpha, beta, dadt.beta_mass(beta), delta, *state, counts, cooccurrence_topic_word, None)
+    return state, counts, cooccurrence_topic_word
+
+def assert_counts_equal(counts, recounted):
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    for a_d in (a, d):
+        assert np.array_equal(n_words_per_doc[a_d], recounted[0][a_d])
+        assert np.array_equal(occurrence_topic[a_d], recounted[2][a_d])
+        assert np.array_equal(cooccurrence_authordoc_topic[a_d], recounted[3][a_d])
+
+def test_dadt_sweep_matches_numpy():
+    numpy_state, _, _ = dadt_sweeps(False, 1)
+    kernel_state, counts, cooccurrence_topic_word = dadt_sweeps(True, 1)
+    for numpy_array, kernel_array in zip(numpy_state, kernel_state):
+        assert np.array_equal(numpy_array, kernel_array)
+
+    recounted = dadt.count(corpus, *kernel_state, n_topics, n_authors)
+    assert_counts_equal(counts, recounted)
+    assert np.array_equal(counts[1], recounted[1])
+    for a_d in (a, d):
+        assert np.array_equal(cooccurrence_topic_word[a_d], dadt.count_topic_word(corpus, kernel_state[0], kernel_state[1], n_topics)[a_d])
+
+def dadt_index(is_atopic, author, topic, authors):
+    # position of an assignment in the conditional of sample_topic
+    return n_topics[d] + authors.index(author) * n_topics[a] + topic if is_atopic else topic
+
+def test_dadt_sweep_draws_from_the_conditional(monkeypatch):
+    kernels.enabled = False
+    probabilities = captured_weights(monkeypatch, sampling, lambda: dadt_sweeps(False, 1, 1))
+    kernels.enabled = True
+    np.random.seed(2)
+    indices = []
+    for draw in range(draws):
+        (is_atopic, topic, author), _, _ = dadt_sweeps(True, np.random.randint(2**31 - 1), 1)
+        indices.append(dadt_index(is_atopic[0], author[0], topic[0], doc_authors[0]))
+    assert_same_distribution(indices, probabilities)
+
+phi = {a: np.random.RandomState(3).dirichlet(np.full(vocab_size, 0.1), n_topics[a]),
+       d: np.random.RandomState(4).dirichlet(np.full(vocab_size, 0.1), n_topics[d])}
+
+def classify_sweeps(enabled, seed, n_sweeps=sweeps):
+    np.random.seed(0)
+    # every document has its own fictitious author, as in dadt.classify
+    is_atopic, topic, author = dadt.initialize(corpus, [[doc] for doc in range(n_docs)], n_topics, delta)
+    counts = dadt.count(corpus, is_atopic, topic, author, n_topics, n_docs)
+    np.random.seed(seed)
+    sampling.uniforms.reset()
+    kernels.enabled = enabled
+    for it in range(n_sweeps):
+        dadt.classify_sweep(it, corpus, n_topics, alpha, delta, phi, is_atopic, topic, counts)
+    return (is_atopic, topic), counts
+
+def test_dadt_classify_sweep_matches_numpy():
+    numpy_state, _ = classify_sweeps(False, 1)
+    kernel_state, counts = classify_sweeps(True, 1)
+    for numpy_array, kernel_array in zip(numpy_state, kernel_state):
+        assert np.array_equal(numpy_array, kernel_array)
+
+    # the author of an atopic token is its document, occurrence_author is not kept up to date by
+    # classify, it only scales the atopic half of the conditional, which is normalised
+    is_atopic, topic = kernel_state
+    assert_counts_equal(counts, dadt.count(corpus, is_atopic, topic, corpus.token_docs(), n_topics, n_docs))
+
+def test_dadt_classify_sweep_draws_from_the_conditional(monkeypatch):
+    probabilities = captured_weights(monkeypatch, sampling, lambda: classify_sweeps(False, 1, 1))
+    np.random.seed(2)
+    indices = []
+    for draw in range(draws):
+        (is_atopic, topic), _ = classify_sweeps(True, np.random.randint(2**31 - 1), 1)
+        indices.append(n_topics[d] + topic[0] if is_atopic[0] else topic[0])
+    assert_same_distribution(indices, probabilities)
+
+def assert_topic_counts(sampler, topics):
+    assert np.array_equal(sampler.cooccur_topic_word, dadt.cooccurrence(topics, corpus.words, sampler.n_topics, vocab_size))
+    assert np.array_equal(sampler.occurrence_topic, np.bincount(topics, minlength=sampler.n_topics))
+    assert np.array_equal(sampler.number_words_per_doc, corpus.doc_lengths())
+
+def at_sampler():
+    return at.AtSampler(5, n_authors, 0.1, 0.01)
+
+def test_at_sweep_matches_numpy():
+    states = []
+    for enabled in (False, True):
+        sampler = at_sampler()
+        np.random.seed(1)
+        sampling.uniforms.reset()
+        kernels.enabled = enabled
+        sampler.train(doc_authors, matrix, 0, sweeps, 1)
+        states.append((corpus.flat_state(sampler.topics), corpus.flat_state(sampler.authors)))
+    assert np.array_equal(states[0][0], states[1][0]) and np.array_equal(states[0][1], states[1][1])
+
+    topics, authors = states[1]
+    assert_topic_counts(sampler, topics)
+    assert np.array_equal(sampler.cooccur_author_topic, dadt.cooccurrence(authors, topics, n_authors, sampler.n_topics))
+    assert np.array_equal(sampler.num_words_per_author, np.bincount(authors, minlength=n_authors))
+
+def test_at_sweep_draws_from_the_conditional(monkeypatch):
+    sampler = at_sampler()
+    np.random.seed(0)
+    sampler._initialize(doc_authors, corpus)
+    probabilities = captured_weights(monkeypatch, at, lambda: at_sampler_copy(sampler)._sweep(corpus))
+
+    author_offsets, author_list = kernels.flat_authors(doc_authors)
+    token_docs = corpus.token_docs()
+    alpha = np.full(sampler.n_topics, sampler.alpha)
+    beta = np.full(vocab_size, sampler.beta)
+    np.random.seed(2)
+    indices = []
+    for draw in range(draws):
+        chain = at_sampler_copy(sampler)
+        topics, authors = corpus.flat_state(sampler.topics), corpus.flat_state(sampler.authors)
+        kernels.at_sweep(corpus.words, token_docs, author_offsets, author_list, topics, authors,
+                         chain.cooccur_author_topic, chain.cooccur_topic_word, chain.number_words_per_doc, chain.occurrence_topic,
+                         chain.num_words_per_author, alpha, sampler.alpha_sum, beta, sampler.beta_sum, np.random.random(corpus.n_tokens))
+        indices.append(doc_authors[0].index(authors[0]) * sampler.n_topics + topics[0])
+    assert_same_distribution(indices, probabilities)
+
+def at_sampler_copy(sampler):
+    chain = at_sampler()
+    chain.__dict__.update({key: value.copy() if hasattr(value, "copy") else value for key, value in sampler.__dict__.items()})
+    return chain
+
+def test_lda_sweep_matches_numpy():
+    states = []
+    for enabled in (False, True):
+        sampler = lda.LDA(5, 0.1, 0.01)
+        np.random.seed(1)
+        sampling.uniforms.reset()
+        kernels.enabled = enabled
+        sampler.train(matrix, 0, sweeps, 1)
+        states.append(corpus.flat_state(sampler.topics))
+    assert np.array_equal(states[0], states[1])
+
+    assert_topic_counts(sampler, states[1])
+    assert np.array_equal(sampler.cooccur_doc_topic, dadt.cooccurrence(corpus.token_docs(), states[1], n_docs, sampler.n_topics))
+
+def test_lda_sweep_draws_from_the_conditional(monkeypatch):
+    sampler = lda.LDA(5, 0.1, 0.01)
+    np.random.seed(0)
+    sampler._initialize(corpus)
+
+    def copy():
+        chain = lda.LDA(5, 0.1, 0.01)
+        chain.__dict__.update({key: value.copy() if hasattr(value, "copy") else value for key, value in sampler.__dict__.items()})
+        return chain
+    probabilities = captured_weights(monkeypatch, lda, lambda: copy()._sweep(corpus))
+
+    token_docs = corpus.token_docs()
+    alpha = np.full(sampler.n_topics, sampler.alpha)
+    beta = np.full(vocab_size, sampler.beta)
+    np.random.seed(2)
+    indices = []
+    for draw in range(draws):
+        chain = copy()
+        topics = corpus.flat_state(sampler.topics)
+        kernels.lda_sweep(corpus.words, token_docs, topics, chain.cooccur_doc_topic, chain.cooccur_topic_word, chain.number_words_per_doc,
+                          chain.occurrence_topic, alpha, np.sum(alpha), beta, np.sum(beta), np.random.random(corpus.n_tokens))
+        indices.append(topics[0])
+    assert_same_distribution(indices, probabilities)
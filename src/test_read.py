@@ -0,0 +1,130 @@
+"""
+Checks of the OpenNLP framing and the incremental preprocessing of read.py, run with python3 -m pytest test_read.py
+"""
+import sys, os, json, threading
+import pytest
+
+pytest.importorskip("unidecode")
+import read
+
+# stand-in with the buffering of opennlp.tools.lang.english.SentenceDetector: the lines of a
+# paragraph are collected until an empty line or the end of the input, then its sentences are written
+PARAGRAPH_DETECTOR = r"""
+import re, sys
+paragraph = []
+def flush():
+    if paragraph:
+        for sentence in re.split(r'(?<=[.!?])\s+', ' '.join(paragraph)):
+            print(sentence)
+        print()
+        sys.stdout.flush()
+        del paragraph[:]
+for line in sys.stdin:
+    if line.strip():
+        paragraph.append(line.strip())
+    else:
+        flush()
+flush()
+"""
+
+# stand-in of opennlp.tools.lang.english.Tokenizer, which writes every line as soon as it is read
+LINE_TOKENIZER = r"""
+import re, sys
+for line in sys.stdin:
+    print(' '.join(re.findall(r"\w+|[^\w\s]", line)))
+    sys.stdout.flush()
+"""
+
+def stand_in(script):
+    tool = read.OpenNLP("stand-in", read.OPENNLP_DIR, read.SENTENCE_MODEL)
+    tool.command = [sys.executable, "-c", script]
+    return tool
+
+def parse(tool, text, timeout=10):
+    """
+    tool.parse(text), failing instead of blocking if the output of text does not end.
+    """
+    result = []
+    parser = threading.Thread(target=lambda: result.append(tool.parse(text)), daemon=True)
+    parser.start()
+    parser.join(timeout)
+    assert result, "no end of text from the tool"
+    return result[0]
+
+def test_sentence_detector_ends_every_text():
+    detector = stand_in(PARAGRAPH_DETECTOR)
+    try:
+        assert parse(detector, "First one. Second one!\nStill second?\n\nNew paragraph.") == \
+               ["First one.", "Second one!", "Still second?", "New paragraph."]
+        # the same process is reused for the next text
+        process = detector.process
+        assert parse(detector, "Another text.") == ["Another text."]
+        assert detector.process is process
+    finally:
+        detector.process.kill()
+
+def test_tokenizer_ends_every_text():
+    tokenizer = stand_in(LINE_TOKENIZER)
+    try:
+        assert parse(tokenizer, "it's here.\nand there") == ["it ' s here .", "and there"]
+        assert parse(tokenizer, "again") == ["again"]
+    finally:
+        tokenizer.process.kill()
+
+def upper_copy(source, output, log):
+    with open(log, "a") as f:
+        f.write(os.path.basename(source) + "\n")
+    with open(source) as f:
+        read.write_atomic(output, f.read().upper())
+    return [output]
+
+def preprocess_folder(folder, output, log, function=upper_copy):
+    sources = sorted(str(path) for path in folder.iterdir())
+    read.run_incremental(function, [(source, str(output / os.path.basename(source)), str(log)) for source in sources], sources)
+
+def processed(log):
+    names = log.read_text().split() if log.exists() else []
+    log.write_text("")
+    return sorted(names)
+
+def test_unchanged_sources_are_skipped_without_reading(tmp_path, monkeypatch):
+    source, output, log = tmp_path / "source", tmp_path / "output", tmp_path / "log"
+    source.mkdir(), output.mkdir()
+    monkeypatch.setattr(read, "destination_path", str(output) + "/")
+    for name in ("a.txt", "b.txt", "c.txt"):
+        (source / name).write_text("text " + name)
+
+    preprocess_folder(source, output, log)
+    assert processed(log) == ["a.txt", "b.txt", "c.txt"]
+
+    (source / "a.txt").write_text("changed")
+    os.utime(source / "b.txt", ns=(0, 0))  # touched only
+    preprocess_folder(source, output, log)
+    assert processed(log) == ["a.txt"]
+    assert (output / "a.txt").read_text() == "CHANGED"
+
+    digests = []
+    monkeypatch.setattr(read, "source_digest", lambda *arguments: digests.append(arguments))
+    preprocess_folder(source, output, log)
+    assert processed(log) == [] and digests == []
+
+def upper_copy_too(source, output, log):
+    return upper_copy(source, output, log)
+
+def test_files_of_deleted_sources_are_removed(tmp_path, monkeypatch):
+    source, others, output, log = tmp_path / "source", tmp_path / "others", tmp_path / "output", tmp_path / "log"
+    for folder in (source, others, output):
+        folder.mkdir()
+    monkeypatch.setattr(read, "destination_path", str(output) + "/")
+    for name in ("a.txt", "b.txt"):
+        (source / name).write_text("text " + name)
+    (others / "x.txt").write_text("other")
+    preprocess_folder(source, output, log)
+    # a second pipeline sharing the manifest, as the train and test files of readpan11
+    preprocess_folder(others, output, log, upper_copy_too)
+
+    (source / "b.txt").unlink()
+    preprocess_folder(source, output, log)
+    assert sorted(os.listdir(output)) == ["a.txt", "x.txt"]
+    with open(read.destination_path.rstrip("/") + ".manifest.json") as f:
+        assert sorted(os.path.basename(path) for path in json.load(f)["entries"]) == ["a.txt", "x.txt"]
@@ -0,0 +1,84 @@
+"""
+Checks that the sparse and alias samplers of dadt.train draw from the conditional of
+dadt.sample_topic, run with python3 -m pytest test_samplers.py
+"""
+import numpy as np
+from corpus import Corpus
+from benchmark import synthetic_corpus, dadt_parameters
+import sampling
+import dadt
+
+a = "a"
+d = "d"
+
+n_docs, vocab_size, doc_length, n_authors = 12, 40, 20, 4
+matrix, doc_authors = synthetic_corpus(n_docs, vocab_size, doc_length, n_authors)
+# the first document has two authors
+doc_authors[0] = doc_authors[0] + [(doc_authors[0][0] + 1) % n_authors]
+corpus = Corpus(matrix)
+n_topics, alpha, beta, delta = dadt_parameters(vocab_size, 3, 5)
+draws = 20000
+
+def first_token_removed():
+    """
+    Counts of a random initial state without the first token, and the word of the first token.
+    """
+    np.random.seed(0)
+    is_atopic, topic, author = dadt.initialize(corpus, doc_authors, n_topics, delta)
+    counts = dadt.count(corpus, is_atopic, topic, author, n_topics, n_authors)
+    cooccurrence_topic_word = dadt.count_topic_word(corpus, is_atopic, topic, n_topics)
+    word = corpus.words[0]
+    state = (int(is_atopic[0]), int(author[0]), int(topic[0]))
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    if state[0]:
+        cooccurrence_topic_word[a][state[2], word] -= 1
+        cooccurrence_authordoc_topic[a][state[1], state[2]] -= 1
+        occurrence_topic[a][state[2]] -= 1
+        occurrence_author[state[1]] -= 1
+        n_words_per_doc[a][0] -= 1
+    else:
+        cooccurrence_topic_word[d][state[2], word] -= 1
+        cooccurrence_authordoc_topic[d][0, state[2]] -= 1
+        occurrence_topic[d][state[2]] -= 1
+        n_words_per_doc[d][0] -= 1
+    return word, state, counts, cooccurrence_topic_word
+
+def sample_topic_probabilities(monkeypatch, word, counts, cooccurrence_topic_word):
+    (n_words_per_doc, occurrence_author, occurrence_topic, cooccurrence_authordoc_topic) = counts
+    weights = []
+    def capture(distribution):
+        weights.append(np.array(distribution))
+        return 0
+    monkeypatch.setattr(sampling, "sample_index", capture)
+    dadt.sample_topic(0, word, n_topics, doc_authors, cooccurrence_topic_word, occurrence_topic, cooccurrence_authordoc_topic,
+                      occurrence_author, n_words_per_doc, alpha, beta, dadt.beta_mass(beta), delta)
+    monkeypatch.undo()
+    return weights[0] / np.sum(weights[0])
+
+def state_index(is_atopic, author, topic):
+    # position of a state in the conditional of sample_topic
+    return n_topics[d] + doc_authors[0].index(author) * n_topics[a] + topic if is_atopic else topic
+
+def assert_same_distribution(states, probabilities):
+    frequencies = np.bincount([state_index(*state) for state in states], minlength=len(probabilities)) / len(states)
+    assert len(frequencies) == len(probabilities)
+    assert 0.5 * np.sum(np.abs(frequencies - probabilities)) < 0.03
+
+def test_sparse_buckets_draw_from_the_conditional(monkeypatch):
+    word, state, counts, cooccurrence_topic_word = first_token_removed()
+    probabilities = sample_topic_probabilities(monkeypatch, word, counts, cooccurrence_topic_word)
+    buckets = dadt.SparseBuckets(corpus, doc_authors, n_topics, alpha, beta, counts, cooccurrence_topic_word)
+    buckets.begin_document(0)
+    np.random.seed(1)
+    sampling.uniforms.reset()
+    assert_same_distribution([buckets.sample(word) for draw in range(draws)], probabilities)
+
+def test_alias_sampler_converges_to_the_conditional(monkeypatch):
+    word, state, counts, cooccurrence_topic_word = first_token_removed()
+    probabilities = sample_topic_probabilities(monkeypatch, word, counts, cooccurrence_topic_word)
+    # enough Metropolis-Hastings steps for the chain of a token to forget its start
+    alias = dadt.AliasSampler(corpus, doc_authors, n_topics, alpha, beta, delta, counts, cooccurrence_topic_word, mh_steps=30)
+    alias.begin_document(0)
+    np.random.seed(1)
+    sampling.uniforms.reset()
+    assert_same_distribution([alias.sample(word, state) for draw in range(draws)], probabilities)
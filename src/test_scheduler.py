@@ -0,0 +1,68 @@
+"""
+Checks of scheduler.Scheduler, run with python3 -m pytest test_scheduler.py
+"""
+import os, time
+import numpy as np
+import pytest
+from corpus import Corpus
+from scheduler import Scheduler
+from benchmark import synthetic_authored_corpus, dadt_parameters
+import dadt
+import at
+
+def interval(duration):
+    start = time.time()
+    time.sleep(duration)
+    return (start, time.time())
+
+def most_at_once(intervals):
+    return max(sum(start <= moment < end for start, end in intervals) for moment, _ in intervals)
+
+def run_all(scheduler, tasks):
+    results = [None] * len(tasks)
+    for i, result in scheduler.run(tasks):
+        results[i] = result
+    return results
+
+def test_cores_and_memory_bound_the_running_tasks():
+    assert most_at_once(run_all(Scheduler(3, memory_limit=np.inf), [(interval, (0.3,), 1, 0)] * 6)) == 3
+    assert most_at_once(run_all(Scheduler(3, memory_limit=np.inf), [(interval, (0.3,), 2, 0)] * 4)) == 1
+    assert most_at_once(run_all(Scheduler(3, memory_limit=100), [(interval, (0.3,), 1, 50)] * 4)) == 2
+    # too big to fit on its own, runs alone
+    assert most_at_once(run_all(Scheduler(3, memory_limit=100), [(interval, (0.3,), 5, 500)] * 2)) == 1
+
+def test_tasks_get_their_own_seeds():
+    np.random.seed(0)
+    draws = run_all(Scheduler(2), [(np.random.random, (), 1, 0)] * 4)
+    assert len(set(draws)) == 4
+
+def fail():
+    raise ValueError("task failed")
+
+def test_errors_reach_the_caller():
+    with pytest.raises(ValueError):
+        run_all(Scheduler(2), [(fail, (), 1, 0)])
+    with pytest.raises(RuntimeError):
+        run_all(Scheduler(2), [(os._exit, (3,), 1, 0)])
+
+def dadt_task(corpus, test_corpus, doc_authors, n_authors, vocab_size, processes):
+    num_topics, alpha, beta, delta = dadt_parameters(vocab_size, 4, 6)
+    theta, phi, pi_sampled, chi_sampled = dadt.train(corpus, None, doc_authors, num_topics, n_authors, alpha, beta, delta, 1, 2, 2, 1,
+                                                     processes=processes)
+    theta_test, pi_test = dadt.classify(test_corpus, 1, 2, 1, num_topics, alpha, beta, delta, 1, phi, processes=processes)
+    return dadt.dadt_p(test_corpus, n_authors, theta, phi, pi_test, chi_sampled)
+
+def at_fa_p2_task(test_matrix, n_authors, vocab_size, processes):
+    n_topics = 4
+    theta = np.random.dirichlet(np.full(n_topics, 0.1), n_authors)
+    phi = np.random.dirichlet(np.full(vocab_size, 0.1), n_topics)
+    return at.AtSampler(n_topics, n_authors, 0.1, 0.1).at_fa_p2(phi, theta, test_matrix, 2, 1, 1, batch_size=2, processes=processes)
+
+def test_tasks_run_process_pools():
+    vocab_size, n_authors = 200, 4
+    matrix, test_matrix, doc_authors, _ = synthetic_authored_corpus(40, vocab_size, 30, n_authors)
+    corpus, test_corpus = Corpus(matrix), Corpus(test_matrix)
+    dadt_probabilities, at_probabilities = run_all(Scheduler(2), [(dadt_task, (corpus, test_corpus, doc_authors, n_authors, vocab_size, 2), 2, 0),
+                                                                  (at_fa_p2_task, (test_matrix, n_authors, vocab_size, 2), 2, 0)])
+    assert dadt_probabilities.shape == (test_corpus.n_docs, n_authors) and np.all(np.isfinite(dadt_probabilities))
+    assert at_probabilities.shape == (test_corpus.n_docs, n_authors) and np.all(at_probabilities >= 0)